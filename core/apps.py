@@ -1,4 +1,10 @@
+import logging
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+
+logger = logging.getLogger(__name__)
 
 
 class CoreConfig(AppConfig):
@@ -7,8 +13,10 @@ class CoreConfig(AppConfig):
 
     def ready(self):
         import core.signals
-        print("CoreConfig ready. Scheduler should be started via 'manage.py run_scheduler'.")
-        pass
+        if settings.METRICS_DB_QUERIES:
+            from core.metrics import instrument_connection
+            connection_created.connect(instrument_connection, dispatch_uid='core.metrics.instrument_connection')
+        logger.debug("CoreConfig ready. Scheduler should be started via 'manage.py run_scheduler'.")
 
 
 
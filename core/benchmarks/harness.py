@@ -0,0 +1,91 @@
+import threading
+import time
+from contextlib import contextmanager
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+# Counts the SQL queries run on every database connection it is attached to
+class QueryCounter:
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+
+# Counts the queries of the body, including those of threads it starts: the counter
+# is attached to this thread's connections and to every connection opened meanwhile
+@contextmanager
+def count_queries():
+    counter = QueryCounter()
+    attached = []
+
+    def attach(sender, connection, **kwargs):
+        if counter not in connection.execute_wrappers:
+            connection.execute_wrappers.append(counter)
+            attached.append(connection)
+
+    for connection in connections.all():
+        attach(None, connection)
+    connection_created.connect(attach, weak=False)
+    try:
+        yield counter
+    finally:
+        connection_created.disconnect(attach)
+        for connection in attached:
+            if counter in connection.execute_wrappers:
+                connection.execute_wrappers.remove(counter)
+
+
+# The process's peak resident set size so far, in MB (a high-water mark: it never
+# goes down, so run a scenario on its own to see its peak)
+def peak_rss_mb():
+    if resource is None:
+        return None
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def percentile(ordered, pct):
+    if not ordered:
+        return 0.0
+    return ordered[max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))]
+
+
+# Throughput and latency percentiles of operations that took `latencies` seconds
+# each and `elapsed` seconds in all
+def latency_summary(latencies, elapsed):
+    ordered = sorted(latencies)
+    return {
+        'operations': len(ordered),
+        'seconds': round(elapsed, 3),
+        'per_second': round(len(ordered) / elapsed, 1) if elapsed > 0 else 0.0,
+        'latency_p50_ms': round(percentile(ordered, 50) * 1000, 2),
+        'latency_p95_ms': round(percentile(ordered, 95) * 1000, 2),
+        'latency_p99_ms': round(percentile(ordered, 99) * 1000, 2),
+        'latency_max_ms': round(ordered[-1] * 1000, 2) if ordered else 0.0,
+    }
+
+
+# Wraps a handler so every call's duration is appended to latencies (thread-safe)
+def timed(handler, latencies):
+    lock = threading.Lock()
+
+    def run(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            with lock:
+                latencies.append(time.perf_counter() - started)
+
+    return run
@@ -0,0 +1,189 @@
+import random
+import time
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import Client
+from django.urls import reverse
+from core import tasks
+from core.dispatch import UpdateDispatcher
+from core.models import OutboundMessage, UserProfile, Vocabulary, VocabularyImage
+from core.pagination import vocab_page
+from core.polling import UpdatePoller, dispatch_update
+from .harness import count_queries, latency_summary, peak_rss_mb, timed
+
+
+# Scenarios run against a seeded database and a FakeTelegramServer (see the
+# run_benchmarks command). Each takes the server and the benchmark options and
+# returns a JSON-serializable dict of measurements.
+
+
+def _update_id_source():
+    counter = iter(range(1, 10 ** 9))
+    return lambda: next(counter)
+
+
+# Random (chat_id, vocab_id, image_id) cards of linked users
+def _sample_cards(count, rng):
+    profiles = list(UserProfile.objects.filter(chat_id__isnull=False).values_list('id', 'chat_id'))
+    chats = dict(profiles)
+    vocabs = list(Vocabulary.objects.filter(user_id__in=chats).values_list('id', 'user_id')[:20_000])
+    images = dict(VocabularyImage.objects.filter(vocabulary_id__in=[vocab_id for vocab_id, _ in vocabs]).values_list('vocabulary_id', 'id'))
+    picks = [rng.choice(vocabs) for _ in range(count)]
+    return [(chats[user_id], vocab_id, images.get(vocab_id)) for vocab_id, user_id in picks]
+
+
+def callback_update(update_id, chat_id, vocab_id, image_id, message_id, action='knew'):
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': f"cb-{update_id}",
+            'from': {'id': chat_id},
+            'data': f"{action}:{vocab_id}:{image_id or 'none'}",
+            'message': {'message_id': message_id, 'chat': {'id': chat_id}},
+        },
+    }
+
+
+def text_update(update_id, chat_id, text='hello'):
+    return {
+        'update_id': update_id,
+        'message': {'message_id': update_id, 'chat': {'id': chat_id}, 'from': {'id': chat_id}, 'text': text},
+    }
+
+
+# The daily batch: plans every user's cards, queues them in the outbox and sends them
+# through the delivery engine
+def bench_send_vocabulary_batch(telegram, options):
+    OutboundMessage.objects.all().delete()
+    injected_before = dict(telegram.injected)
+    started = time.perf_counter()
+    with count_queries() as queries:
+        totals = tasks.send_vocabulary_batch()
+    elapsed = time.perf_counter() - started
+    engine = totals['engine']
+    return {
+        'seconds': round(elapsed, 3),
+        'messages_queued': OutboundMessage.objects.count(),
+        'messages_sent': totals['sent'],
+        'messages_per_second': round(totals['sent'] / elapsed, 1) if elapsed > 0 else 0.0,
+        'retrying': totals['retrying'],
+        'dead': totals['dead'],
+        'send_latency_p50_ms': engine['latency_p50_ms'],
+        'send_latency_p95_ms': engine['latency_p95_ms'],
+        'send_latency_p99_ms': engine['latency_p99_ms'],
+        'rate_limited': engine['rate_limited'],
+        'injected_errors': {str(code): count - injected_before.get(code, 0) for code, count in telegram.injected.items()},
+        'queries': queries.count,
+        'queries_per_message': round(queries.count / totals['sent'], 2) if totals['sent'] else None,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+# The getUpdates loop: a backlog of answers and chat messages is fetched and handled
+# by one poller, 100 updates per call
+def bench_polling(telegram, options):
+    rng = random.Random(options['seed'])
+    next_id = _update_id_source()
+    count = options['updates']
+    for index, (chat_id, vocab_id, image_id) in enumerate(_sample_cards(count, rng)):
+        update_id = next_id()
+        if index % 4 == 3:
+            telegram.push_update(text_update(update_id, chat_id))
+        else:
+            telegram.push_update(callback_update(update_id, chat_id, vocab_id, image_id, message_id=update_id))
+
+    latencies = []
+    poller = UpdatePoller(timeout=0, limit=100, handler=timed(dispatch_update, latencies))
+    polls = 0
+    started = time.perf_counter()
+    with count_queries() as queries:
+        while len(latencies) < count:
+            polls += 1
+            if not poller.poll():
+                break
+    elapsed = time.perf_counter() - started
+    return {
+        **latency_summary(latencies, elapsed),
+        'get_updates_calls': polls,
+        'queries': queries.count,
+        'queries_per_update': round(queries.count / len(latencies), 2) if latencies else None,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+# Many users answering at once: a burst of callback queries handed to the update
+# dispatcher's worker threads
+def bench_callback_burst(telegram, options):
+    rng = random.Random(options['seed'] + 1)
+    next_id = _update_id_source()
+    updates = [
+        callback_update(next_id(), chat_id, vocab_id, image_id, message_id=10 ** 6 + index, action=rng.choice(['knew', 'didnt_know']))
+        for index, (chat_id, vocab_id, image_id) in enumerate(_sample_cards(options['burst'], rng))
+    ]
+    latencies = []
+    dispatcher = UpdateDispatcher(
+        handler=timed(tasks.handle_callback_query, latencies), workers=settings.UPDATE_WORKERS, queue_size=len(updates),
+    )
+    started = time.perf_counter()
+    with count_queries() as queries:
+        dispatcher.start()
+        for update in updates:
+            dispatcher.submit(update)
+        dispatcher.join()
+    elapsed = time.perf_counter() - started
+    return {
+        **latency_summary(latencies, elapsed),
+        'workers': dispatcher.workers,
+        'queries': queries.count,
+        'queries_per_update': round(queries.count / len(latencies), 2) if latencies else None,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+# The web pages of a few users with a full vocabulary, each requested
+# options['requests'] times
+def bench_web_views(telegram, options):
+    rng = random.Random(options['seed'] + 2)
+    user_ids = list(User.objects.filter(userprofile__vocabs__isnull=False).distinct().values_list('id', flat=True))
+    users = User.objects.filter(id__in=rng.sample(user_ids, min(5, len(user_ids)))).select_related('userprofile')
+    results = {}
+    client = Client()
+    for user in users:
+        client.force_login(user)
+        vocab = Vocabulary.objects.filter(user=user.userprofile).order_by('id').first()
+        cursor = vocab_page(user.userprofile.vocabs.all(), page_size=settings.VOCAB_PAGE_SIZE).next_cursor
+        pages = {
+            'home': (reverse('home'), {}),
+            'allvocabs': (reverse('allvocabs'), {}),
+            'allvocabs_next_page': (reverse('allvocabs_page'), {'after': cursor} if cursor else {}),
+            'search': (reverse('home'), {'q': vocab.word[:4]}),
+            'search_json': (reverse('search_vocabs'), {'q': vocab.word[:4]}),
+            'vocab_detail': (reverse('vocab_detail', args=[vocab.id]), {}),
+        }
+        for name, (url, params) in pages.items():
+            result = results.setdefault(name, {'latencies': [], 'queries': [], 'elapsed': 0.0})
+            for _ in range(options['requests']):
+                started = time.perf_counter()
+                with count_queries() as queries:
+                    response = client.get(url, params)
+                took = time.perf_counter() - started
+                if response.status_code != 200:
+                    raise RuntimeError(f"GET {url} returned {response.status_code}")
+                result['latencies'].append(took)
+                result['elapsed'] += took
+                result['queries'].append(queries.count)
+    return {
+        name: {
+            **latency_summary(result['latencies'], result['elapsed']),
+            'queries_per_request': max(result['queries']),
+        }
+        for name, result in results.items()
+    }
+
+
+SCENARIOS = {
+    'send_vocabulary_batch': bench_send_vocabulary_batch,
+    'polling': bench_polling,
+    'callback_burst': bench_callback_burst,
+    'web_views': bench_web_views,
+}
@@ -0,0 +1,69 @@
+import random
+from contextlib import contextmanager
+from datetime import timedelta
+from django.contrib.auth.models import User
+from django.db import connection
+from django.utils import timezone
+from core.models import UserProfile, Vocabulary, VocabularyImage, UserVocabularyProgress
+
+
+# Runs the body against a throwaway test database, so seeding never touches real data
+@contextmanager
+def benchmark_database():
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+
+# Fills the database with users x words_per_user words, images_per_word images per word
+# and progress rows for reviewed_ratio of the words (next_review spread over +-30 days).
+# Uses bulk_create throughout, so model signals don't fire.
+def seed_dataset(users, words_per_user, images_per_word=1, reviewed_ratio=0.6, batch_size=5000, seed=0):
+    rng = random.Random(seed)
+    now = timezone.now()
+    # A prefix per call, so seeding twice doesn't collide
+    prefix = f"bench{User.objects.count()}-"
+
+    User.objects.bulk_create(
+        [User(username=f"{prefix}{i}", password='!') for i in range(users)],
+        batch_size=batch_size,
+    )
+    user_rows = list(User.objects.filter(username__startswith=prefix).order_by('id'))
+    UserProfile.objects.bulk_create(
+        [UserProfile(user=user, chat_id=10_000 + user.id) for user in user_rows],
+        batch_size=batch_size,
+    )
+    profiles = list(UserProfile.objects.filter(user__username__startswith=prefix).order_by('id'))
+
+    counts = {'users': len(profiles), 'words': 0, 'images': 0, 'progress': 0}
+    for profile in profiles:
+        vocabs = Vocabulary.objects.bulk_create(
+            [Vocabulary(user=profile, word=f"word{profile.id}-{i}", meaning=f"meaning {i}", description='')
+             for i in range(words_per_user)],
+            batch_size=batch_size,
+        )
+        images = [
+            VocabularyImage(vocabulary=vocab, image=f"img/bench-{vocab.id}-{k}.jpg", flag=rng.random() < 0.5)
+            for vocab in vocabs for k in range(images_per_word)
+        ]
+        progress = [
+            UserVocabularyProgress(
+                user=profile,
+                vocabulary=vocab,
+                next_review=now + timedelta(days=rng.uniform(-30, 30)),
+                interval=rng.randint(1, 60),
+                ease_factor=rng.uniform(1.3, 3.0),
+                appeared_count=1,
+            )
+            for vocab in vocabs if rng.random() < reviewed_ratio
+        ]
+        VocabularyImage.objects.bulk_create(images, batch_size=batch_size)
+        UserVocabularyProgress.objects.bulk_create(progress, batch_size=batch_size)
+        counts['words'] += len(vocabs)
+        counts['images'] += len(images)
+        counts['progress'] += len(progress)
+    return counts
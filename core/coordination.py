@@ -0,0 +1,67 @@
+import os
+import socket
+import uuid
+from datetime import timedelta
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.functions import Abs
+from django.utils import timezone
+from .models import SchedulerLease
+
+
+# Lease of the one process allowed to call getUpdates
+POLLER_LEASE = 'update-poller'
+
+
+# Identifies this process as a lease holder (unique even for two processes with the
+# same pid on different hosts or after a restart)
+def process_identity():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+# Takes or renews the named lease for ttl seconds. Succeeds if the lease is free,
+# expired, or already held by holder; the check and the write are one UPDATE, so
+# two processes can't both take it. Returns the lease, or None if someone else holds it.
+def acquire_lease(name, holder, ttl, value=None):
+    now = timezone.now()
+    changes = {'holder': holder, 'expires_at': now + timedelta(seconds=ttl)}
+    if value is not None:
+        changes['value'] = value
+    taken = SchedulerLease.objects.filter(name=name).filter(Q(holder=holder) | Q(expires_at__lte=now)).update(
+        # A new holder starts its term now; a renewal keeps acquired_at
+        acquired_at=Case(When(holder=holder, then=F('acquired_at')), default=Value(now)),
+        **changes,
+    )
+    if not taken:
+        try:
+            with transaction.atomic():
+                SchedulerLease.objects.create(name=name, acquired_at=now, **changes)
+        except IntegrityError:
+            # Another process created it first
+            return None
+    return SchedulerLease.objects.filter(name=name, holder=holder).first()
+
+
+# Gives the lease up early (on shutdown), so another process can take over at once
+def release_lease(name, holder, value=None):
+    changes = {'expires_at': timezone.now()}
+    if value is not None:
+        changes['value'] = value
+    return SchedulerLease.objects.filter(name=name, holder=holder).update(**changes)
+
+
+# One process's share of the rows: those whose |field| modulo count is index (chat
+# ids of groups are negative). shard is an (index, count) pair; None means all rows.
+def shard_filter(queryset, field, shard):
+    if shard is None:
+        return queryset
+    index, count = shard
+    if count <= 1:
+        return queryset
+    return queryset.alias(shard_key=Abs(F(field)) % count).filter(shard_key=index)
+
+
+def validate_shard(index, count):
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Shard index must be in [0, {count}) and the count positive, got {index}/{count}.")
+    return (index, count) if count > 1 else None
@@ -0,0 +1,137 @@
+import uuid
+from datetime import datetime, time, timedelta
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+from .metrics import registry
+from .models import UserVocabularyProgress, Vocabulary
+from .pagination import first_image_prefetch
+
+
+# Per-user cache of the dashboard fragments (Django's cache framework, see CACHES).
+# Every user has a version token per scope of data; a fragment's key holds the
+# tokens of the scopes it is built from, so a write only has to replace the
+# token of its scope (see invalidate) and the stale entries are never read again.
+# They age out through the cache's timeout and culling.
+#   vocabulary: the user's words and their images
+#   progress:   the user's review progress
+# A global token covers bulk writes that touch every user.
+SCOPES = ('vocabulary', 'progress')
+
+# Scopes written by other processes than the web server's: answers are recorded by
+# run_scheduler when it polls. Their invalidations can't reach a cache that lives in
+# one process (locmem), so fragments built from them are only cached in a backend
+# the processes share (file, db).
+SHARED_CACHE_SCOPES = {'progress'}
+
+DASHBOARD_CACHE = registry.counter(
+    'vocabbot_dashboard_cache_total', 'Dashboard cache lookups by fragment and result (hit, miss, or uncached).', ('fragment', 'result'),
+)
+DASHBOARD_INVALIDATIONS = registry.counter(
+    'vocabbot_dashboard_invalidations_total', 'Dashboard cache version bumps by scope.', ('scope',),
+)
+
+_missing = object()
+
+
+def get_cache():
+    return caches[settings.DASHBOARD_CACHE]
+
+
+def is_process_local(cache):
+    return isinstance(cache, LocMemCache)
+
+
+def version_key(scope, user_id=None):
+    if user_id is None:
+        return f"dashboard:{scope}:version"
+    return f"dashboard:{user_id}:{scope}:version"
+
+
+def _new_token():
+    return uuid.uuid4().hex[:12]
+
+
+# The current version tokens of keys, creating the missing ones (add() keeps the
+# token of a concurrent creator)
+def _versions(cache, keys):
+    found = cache.get_many(keys)
+    for key in keys:
+        if key not in found:
+            cache.add(key, _new_token(), timeout=None)
+            found[key] = cache.get(key)
+    return [found[key] for key in keys]
+
+
+def _bump(keys):
+    get_cache().set_many({key: _new_token() for key in keys}, timeout=None)
+
+
+# Invalidates the user's fragments built from the given scopes. The tokens are
+# replaced right away and again once the transaction commits: a fragment rebuilt
+# in between could have read the data from before the commit.
+def invalidate(user_id, *scopes):
+    scopes = scopes or SCOPES
+    keys = [version_key(scope, user_id) for scope in scopes]
+    _bump(keys)
+    transaction.on_commit(lambda: _bump(keys))
+    for scope in scopes:
+        DASHBOARD_INVALIDATIONS.inc(scope=scope)
+
+
+# Invalidates every user's fragments, for writes that skip the signals and touch
+# many users (e.g. recompute_schedules)
+def invalidate_all():
+    keys = [version_key('global')]
+    _bump(keys)
+    transaction.on_commit(lambda: _bump(keys))
+    DASHBOARD_INVALIDATIONS.inc(scope='global')
+
+
+# Returns the fragment from the cache, or builds it with build() and caches it for
+# DASHBOARD_CACHE_TIMEOUT seconds. key_suffix tells variants of a fragment apart.
+# Fragments of SHARED_CACHE_SCOPES are always built when the cache is process-local.
+def cached_fragment(user_id, fragment, scopes, build, key_suffix=''):
+    cache = get_cache()
+    if is_process_local(cache) and SHARED_CACHE_SCOPES.intersection(scopes):
+        DASHBOARD_CACHE.inc(fragment=fragment, result='uncached')
+        return build()
+    tokens = _versions(cache, [version_key('global')] + [version_key(scope, user_id) for scope in scopes])
+    key = f"dashboard:{user_id}:{fragment}{key_suffix}:{':'.join(tokens)}"
+    value = cache.get(key, _missing)
+    if value is not _missing:
+        DASHBOARD_CACHE.inc(fragment=fragment, result='hit')
+        return value
+    DASHBOARD_CACHE.inc(fragment=fragment, result='miss')
+    value = build()
+    cache.set(key, value, timeout=settings.DASHBOARD_CACHE_TIMEOUT)
+    return value
+
+
+# The user's newest words with their cover images
+def latest_words(user_profile, count=3):
+    def build():
+        return list(
+            Vocabulary.objects.filter(user=user_profile).order_by('-date_added')
+            .prefetch_related(first_image_prefetch())[:count]
+        )
+    return cached_fragment(user_profile.id, 'latest_words', ('vocabulary',), build, key_suffix=f":{count}")
+
+
+# How many words the user has, how many were never reviewed and how many reviews
+# are due by the end of `day` (today by default; the day is part of the key)
+def review_counts(user_profile, day=None):
+    day = day or timezone.localdate()
+    end_of_day = timezone.make_aware(datetime.combine(day + timedelta(days=1), time.min))
+
+    def build():
+        words = Vocabulary.objects.filter(user=user_profile).count()
+        progress = UserVocabularyProgress.objects.filter(user=user_profile).aggregate(
+            reviewed=Count('id', filter=Q(appeared_count__gt=0)),
+            due=Count('id', filter=Q(appeared_count__gt=0, next_review__lt=end_of_day)),
+        )
+        return {'words': words, 'new': words - progress['reviewed'], 'due': progress['due']}
+    return cached_fragment(user_profile.id, 'review_counts', ('vocabulary', 'progress'), build, key_suffix=f":{day}")
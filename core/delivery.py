@@ -0,0 +1,222 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+
+# A thread-safe token bucket. rate is tokens per second, capacity is the burst size
+class TokenBucket:
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1, rate))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated_at
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated_at = now
+
+    # Blocks until a token is available, then consumes it
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    # Stops handing out tokens for the given number of seconds (used on 429 responses)
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+
+# One message to deliver. photo_path is only set for sendPhoto requests, image_id
+# when the photo is a VocabularyImage. dedupe_key identifies the message in the
+# outbox; outbox_id is set on jobs loaded from it.
+class DeliveryJob:
+
+    def __init__(self, chat_id, method, payload, photo_path=None, dedupe_key=None, outbox_id=None, image_id=None):
+        self.chat_id = chat_id
+        self.method = method
+        self.payload = payload
+        self.photo_path = photo_path
+        self.dedupe_key = dedupe_key
+        self.outbox_id = outbox_id
+        self.image_id = image_id
+
+    def __repr__(self):
+        return f"DeliveryJob({self.method} -> {self.chat_id})"
+
+
+
+# The response reported for a job whose photo file doesn't exist. No request was
+# made and sending the job again can't succeed, so it isn't retried.
+def missing_file_response(path):
+    return {'ok': False, 'error_code': None, 'description': f"Image file not found: {path}", 'missing_file': True}
+
+
+
+# Counters and per-request latencies collected during one delivery run
+class DeliveryStats:
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.latencies = []
+        self.started_at = None
+        self.finished_at = None
+        self.lock = threading.Lock()
+
+    def record(self, ok, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            if ok:
+                self.sent += 1
+            else:
+                self.failed += 1
+
+    def percentile(self, pct):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+        return ordered[index]
+
+    @property
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        end = self.finished_at if self.finished_at is not None else time.monotonic()
+        return end - self.started_at
+
+    @property
+    def throughput(self):
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self):
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'rate_limited': self.rate_limited,
+            'elapsed_seconds': round(self.elapsed, 3),
+            'messages_per_second': round(self.throughput, 2),
+            'latency_p50_ms': round(self.percentile(50) * 1000, 1),
+            'latency_p95_ms': round(self.percentile(95) * 1000, 1),
+            'latency_p99_ms': round(self.percentile(99) * 1000, 1),
+        }
+
+
+
+# Sends DeliveryJobs concurrently on a bounded thread pool.
+# send(job) must perform one Bot API call and return the decoded JSON response (or None
+# on a network error). Jobs for the same chat are expected to arrive consecutively: they
+# are delivered in order by a single worker, throttled by a per-chat bucket, while every
+# request also takes a token from the shared global bucket.
+class DeliveryEngine:
+
+    def __init__(self, send, workers=16, global_rate=30, chat_rate=1, max_retries=3, on_result=None):
+        self.send = send
+        self.workers = workers
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.max_retries = max_retries
+        self.on_result = on_result
+        self.stats = DeliveryStats()
+
+    # Delivers every job from the iterable and returns the run's DeliveryStats
+    def run(self, jobs):
+        self.stats.started_at = time.monotonic()
+        # Bounds the number of queued chat groups so the job iterable is consumed lazily
+        slots = threading.BoundedSemaphore(self.workers * 2)
+
+        def release(_future):
+            slots.release()
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='delivery') as executor:
+            for group in self._group_by_chat(jobs):
+                slots.acquire()
+                future = executor.submit(self._deliver_chat, group)
+                future.add_done_callback(release)
+
+        self.stats.finished_at = time.monotonic()
+        return self.stats
+
+    @staticmethod
+    def _group_by_chat(jobs):
+        group = []
+        for job in jobs:
+            if group and group[-1].chat_id != job.chat_id:
+                yield group
+                group = []
+            group.append(job)
+        if group:
+            yield group
+
+    def _deliver_chat(self, group):
+        chat_bucket = TokenBucket(self.chat_rate, capacity=1)
+        for job in group:
+            try:
+                result = self._deliver(job, chat_bucket)
+            except Exception:
+                logger.exception("Delivery of %s raised", job)
+                result = None
+            if self.on_result:
+                self.on_result(job, result)
+
+    # Sends one job, retrying on 429 (after retry_after) and on network errors.
+    # Other errors, a missing photo file included, are final. A 429 pauses the
+    # buckets even on the last attempt, so the other workers hold off too.
+    def _deliver(self, job, chat_bucket):
+        response = None
+        for attempt in range(self.max_retries + 1):
+            chat_bucket.acquire()
+            self.global_bucket.acquire()
+            started = time.monotonic()
+            response = self.send(job)
+            latency = time.monotonic() - started
+
+            if response is not None and response.get('ok'):
+                self.stats.record(True, latency)
+                return response
+
+            last_attempt = attempt == self.max_retries
+            if response is not None and response.get('error_code') == 429:
+                retry_after = response.get('parameters', {}).get('retry_after', 1)
+                with self.stats.lock:
+                    self.stats.rate_limited += 1
+                    if not last_attempt:
+                        self.stats.retried += 1
+                # Telegram's flood limit is per bot, so every worker holds off, not just this chat
+                self.global_bucket.pause(retry_after)
+                chat_bucket.pause(retry_after)
+            elif response is not None:
+                # Other API errors (blocked bot, bad request, ...) won't succeed on retry
+                break
+            elif not last_attempt:
+                # Network failure: back off a little before trying again
+                with self.stats.lock:
+                    self.stats.retried += 1
+                time.sleep(min(2 ** attempt, 10))
+            if last_attempt:
+                break
+
+        self.stats.record(False, latency)
+        return response
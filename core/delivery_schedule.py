@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError, available_timezones
+from django.conf import settings
+
+
+# Fractional part of the golden ratio. Multiples of it modulo 1 are spread evenly
+# over [0, 1) for consecutive user ids (a Weyl sequence), unlike a plain hash.
+GOLDEN_RATIO_FRACTION = 0.6180339887498949
+
+
+def timezone_choices():
+    return [(name, name) for name in sorted(available_timezones())]
+
+
+# The user's zone, or the server's if the stored name is unknown
+def profile_zone(profile):
+    try:
+        return ZoneInfo(profile.timezone)
+    except (ZoneInfoNotFoundError, ValueError):
+        return ZoneInfo(settings.TIME_ZONE)
+
+
+# Where in a delivery window of window_minutes this user's cards go out. Fixed per
+# user, so a user gets their cards at the same time every day, and users sharing a
+# window are spread evenly across it.
+def delivery_offset(user_id, window_minutes):
+    return timedelta(seconds=int((user_id * GOLDEN_RATIO_FRACTION) % 1 * window_minutes * 60))
+
+
+# The local date of the window `slot` belongs to (a slot can fall after midnight)
+def delivery_day(profile, slot):
+    offset = delivery_offset(profile.id, profile.delivery_window_minutes)
+    return (slot - offset).astimezone(profile_zone(profile)).date()
+
+
+# The user's first delivery slot strictly after `after`: their preferred local time
+# plus their offset in the window. Returned in UTC. The offset is added in absolute
+# time, so a window spanning a DST change is still delivered once per day. Days up to
+# profile.last_delivery_date are skipped, so moving the window later on a day that
+# was already delivered doesn't deliver again that day.
+def next_delivery_time(profile, after):
+    zone = profile_zone(profile)
+    offset = delivery_offset(profile.id, profile.delivery_window_minutes)
+    # Yesterday's window may still be open (it can run past midnight)
+    day = after.astimezone(zone).date() - timedelta(days=1)
+    if profile.last_delivery_date:
+        day = max(day, profile.last_delivery_date + timedelta(days=1))
+    while True:
+        start = datetime.combine(day, profile.delivery_time, tzinfo=zone)
+        slot = start.astimezone(dt_timezone.utc) + offset
+        if slot > after:
+            return slot
+        day += timedelta(days=1)
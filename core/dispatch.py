@@ -0,0 +1,155 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from django.conf import settings
+from django.db import close_old_connections
+from .polling import dispatch_update
+
+
+logger = logging.getLogger(__name__)
+
+
+# Returns the chat an update belongs to, used to keep each chat's updates in order
+def update_chat_id(update):
+    if 'callback_query' in update:
+        query = update['callback_query']
+        if query.get('message'):
+            return query['message'].get('chat', {}).get('id')
+        return query.get('from', {}).get('id')
+    if 'message' in update:
+        return update['message'].get('chat', {}).get('id')
+    return None
+
+
+def update_kind(update):
+    for kind in ('callback_query', 'message'):
+        if kind in update:
+            return kind
+    return 'other'
+
+
+
+# Handler latencies over the most recent updates
+class LatencyWindow:
+
+    def __init__(self, size=1000):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.errors = 0
+
+    def add(self, seconds, failed=False):
+        self.samples.append(seconds)
+        self.count += 1
+        if failed:
+            self.errors += 1
+
+    def summary(self):
+        ordered = sorted(self.samples)
+        def pct(p):
+            if not ordered:
+                return 0.0
+            return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000, 1)
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'p50_ms': pct(50),
+            'p95_ms': pct(95),
+            'max_ms': round(ordered[-1] * 1000, 1) if ordered else 0.0,
+        }
+
+
+
+# An in-process producer/consumer pipeline for Telegram updates. Producers (the poller
+# or the webhook view) only enqueue; N worker threads run the handlers.
+# Every worker owns a bounded queue and updates are routed by chat id, so one chat's
+# updates are handled in order while different chats proceed in parallel. submit()
+# blocks when the target queue is full, which pushes back on the producer.
+class UpdateDispatcher:
+
+    def __init__(self, handler=dispatch_update, workers=1, queue_size=100):
+        self.handler = handler
+        self.workers = workers
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.threads = []
+        self.latencies = {}
+        self.stats_lock = threading.Lock()
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return self
+            for index, work_queue in enumerate(self.queues):
+                thread = threading.Thread(target=self._work, args=(work_queue,), name=f"update-worker-{index}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        return self
+
+    def _queue_for(self, update):
+        chat_id = update_chat_id(update)
+        key = chat_id if chat_id is not None else update.get('update_id', 0)
+        return self.queues[hash(key) % self.workers]
+
+    # Queues an update. Blocks while the chat's queue is full; with a timeout,
+    # raises queue.Full if no room frees up in time.
+    def submit(self, update, timeout=None):
+        self._queue_for(update).put(update, timeout=timeout)
+
+    # Blocks until every queued update has been handled
+    def join(self):
+        for work_queue in self.queues:
+            work_queue.join()
+
+    @property
+    def depth(self):
+        return sum(work_queue.qsize() for work_queue in self.queues)
+
+    def stats(self):
+        with self.stats_lock:
+            handlers = {kind: window.summary() for kind, window in self.latencies.items()}
+        return {
+            'queue_depth': self.depth,
+            'queue_depth_per_worker': [work_queue.qsize() for work_queue in self.queues],
+            'handlers': handlers,
+        }
+
+    def _record(self, update, seconds, failed):
+        with self.stats_lock:
+            window = self.latencies.setdefault(update_kind(update), LatencyWindow())
+            window.add(seconds, failed)
+
+    def _work(self, work_queue):
+        while True:
+            update = work_queue.get()
+            started = time.monotonic()
+            failed = False
+            try:
+                close_old_connections()
+                self.handler(update)
+            except Exception:
+                failed = True
+                logger.exception("Handling update %s failed", update.get('update_id'))
+            finally:
+                self._record(update, time.monotonic() - started, failed)
+                close_old_connections()
+                work_queue.task_done()
+
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+# Returns the process-wide dispatcher, starting its workers on first use
+def get_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = UpdateDispatcher(
+                    workers=settings.UPDATE_WORKERS,
+                    queue_size=settings.UPDATE_QUEUE_SIZE,
+                ).start()
+    return _dispatcher
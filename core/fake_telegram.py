@@ -0,0 +1,182 @@
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+
+# An in-process stand-in for the Telegram Bot API, used by the tests and benchmarks.
+# Point TELEGRAM_API_URL at server.url. getUpdates honours the long-poll timeout:
+# it blocks until push_update() is called or the timeout expires.
+# Every call takes `latency` seconds more; calls other than getUpdates fail at random
+# with a 429 (and retry_after) at rate_limit_rate, or with a 502 at failure_rate.
+class FakeTelegramServer:
+
+    def __init__(self, latency=0.0, rate_limit_rate=0.0, failure_rate=0.0, retry_after=1, seed=None):
+        self.latency = latency
+        self.rate_limit_rate = rate_limit_rate
+        self.failure_rate = failure_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.requests = []
+        self.method_counts = Counter()
+        # Errors returned on purpose, by status code
+        self.injected = Counter()
+        self.updates = []
+        self.condition = threading.Condition()
+        self.next_message_id = 1
+        # file_ids issued for uploaded photos; sendPhoto with any other id gets a 400
+        self.file_ids = set()
+        self.uploads = 0
+        # Error code getUpdates answers with while set (e.g. 409 for a conflicting poller)
+        self.updates_error = None
+        # TCP connections accepted, to check that clients reuse them
+        self.connections = 0
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self.condition:
+            self.condition.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    # Queues an update for the next getUpdates call and wakes any waiting long poll
+    def push_update(self, update):
+        with self.condition:
+            self.updates.append(update)
+            self.condition.notify_all()
+
+    def count(self, method):
+        return self.method_counts[method]
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset', 0) or 0)
+        timeout = float(params.get('timeout', 0) or 0)
+        limit = int(params.get('limit', 100) or 100)
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            # Confirm everything below the offset, like Telegram does
+            self.updates = [u for u in self.updates if u['update_id'] >= offset]
+            while not self.updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.updates[:limit]
+
+    def _message(self, params):
+        with self.condition:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+        return {'message_id': message_id, 'chat': {'id': params.get('chat_id')}, 'date': int(time.time())}
+
+    def _send_photo(self, params, uploaded):
+        if len(params.get('caption', '')) > 1024:
+            return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: message caption is too long'}
+        with self.condition:
+            if uploaded:
+                self.uploads += 1
+                file_id = f"photo-{self.uploads}"
+                self.file_ids.add(file_id)
+            else:
+                file_id = params.get('photo')
+                if file_id not in self.file_ids:
+                    return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: wrong file identifier/HTTP URL specified'}
+        message = self._message(params)
+        message['photo'] = [{'file_id': f"{file_id}-thumb"}, {'file_id': file_id}]
+        return 200, {'ok': True, 'result': message}
+
+    def _result(self, method, params):
+        if method == 'getUpdates':
+            return self._get_updates(params)
+        if method == 'sendMessage':
+            return self._message(params)
+        return True
+
+    # The error to answer with instead of handling the call, if one is drawn
+    def _injected_error(self):
+        with self.condition:
+            draw = self.random.random()
+            if draw < self.rate_limit_rate:
+                self.injected[429] += 1
+                return 429, {
+                    'ok': False, 'error_code': 429,
+                    'description': f"Too Many Requests: retry after {self.retry_after}",
+                    'parameters': {'retry_after': self.retry_after},
+                }
+            if draw < self.rate_limit_rate + self.failure_rate:
+                self.injected[502] += 1
+                return 502, {'ok': False, 'error_code': 502, 'description': 'Bad Gateway'}
+        return None
+
+    def _handle(self, path, content_type, body):
+        method = path.rsplit('/', 1)[-1]
+        params = {}
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            params = {k: v[-1] for k, v in parse_qs(body.decode()).items()}
+        uploaded = content_type.startswith('multipart/form-data')
+        with self.condition:
+            self.requests.append((method, params))
+            self.method_counts[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if method == 'getUpdates' and self.updates_error:
+            return self.updates_error, {'ok': False, 'error_code': self.updates_error, 'description': 'Injected getUpdates error'}
+        if method != 'getUpdates':
+            error = self._injected_error()
+            if error:
+                return error
+        if method == 'sendPhoto':
+            return self._send_photo(params, uploaded)
+        return 200, {'ok': True, 'result': self._result(method, params)}
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Buffer each response and send it in one write (flushed after every
+            # request). Unbuffered, the headers and the body go out as two packets and
+            # Nagle's algorithm holds the second until the client's delayed ACK, ~40 ms.
+            wbufsize = -1
+
+            def setup(self):
+                super().setup()
+                with server.condition:
+                    server.connections += 1
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length)
+                status, data = server._handle(self.path, self.headers.get('Content-Type', ''), body)
+                out = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -3,6 +3,9 @@ from .models import Vocabulary, UserProfile, VocabularyImage
 from django.contrib.auth.forms import AuthenticationForm
 from django.contrib.auth.models import User
 from django.forms import inlineformset_factory
+from django.conf import settings
+from .delivery_schedule import timezone_choices
+from .importers import FORMATS, detect_format
 
 
 class CustomRegistrationForm(forms.Form):
@@ -83,14 +86,47 @@ class AdminUserProfileForm(forms.ModelForm):
 
 
 
+# Time zone and time of day the user gets their daily words
+class DeliveryPreferencesForm(forms.ModelForm):
+    timezone = forms.ChoiceField(choices=timezone_choices, widget=forms.Select(attrs={'class': 'form-control'}))
 
+    class Meta:
+        model = UserProfile
+        fields = ['timezone', 'delivery_time', 'delivery_window_minutes']
+        widgets = {
+            'delivery_time': forms.TimeInput(attrs={'class': 'form-control', 'type': 'time'}, format='%H:%M'),
+            'delivery_window_minutes': forms.NumberInput(attrs={'class': 'form-control', 'min': 1, 'max': 720}),
+        }
 
+    def clean_delivery_window_minutes(self):
+        minutes = self.cleaned_data.get('delivery_window_minutes')
+        if not 1 <= minutes <= 720:
+            raise forms.ValidationError("The window must be between 1 and 720 minutes.")
+        return minutes
 
-
-
-
-
-
-
-
-
+    # Saves the preferences and moves the next delivery into the new window, on the
+    # first day that hasn't been delivered yet
+    def save(self, commit=True):
+        profile = super().save(commit=False)
+        profile.schedule_next_delivery()
+        if commit:
+            profile.save()
+        return profile
+
+
+
+# A vocabulary file to import: CSV, TSV, JSON, JSON Lines or an Anki package
+class VocabularyImportForm(forms.Form):
+    file = forms.FileField(widget=forms.ClearableFileInput(attrs={
+        'class': 'form-control', 'accept': ','.join(FORMATS),
+    }))
+
+    def clean_file(self):
+        upload = self.cleaned_data.get('file')
+        if upload.size > settings.IMPORT_MAX_UPLOAD_MB * 1024 * 1024:
+            raise forms.ValidationError(f"The file is larger than {settings.IMPORT_MAX_UPLOAD_MB} MB.")
+        try:
+            self.cleaned_data['format'] = detect_format(upload.name)
+        except ValueError as e:
+            raise forms.ValidationError(str(e))
+        return upload
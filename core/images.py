@@ -0,0 +1,106 @@
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps
+from .dashboard import invalidate
+from .models import VocabularyImage
+
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = {'JPEG': 'jpg', 'WEBP': 'webp'}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+# Re-encodes an image file: applies the EXIF orientation, fits it in a
+# max_dimension square (never upscaling) and saves it as fmt at the given quality.
+# EXIF and other metadata are not written. Returns the encoded bytes.
+def render_image(source, max_dimension, fmt='JPEG', quality=82):
+    with Image.open(source) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ('RGB', 'L'):
+            # JPEG has no alpha channel: flatten transparent images onto white
+            rgba = image.convert('RGBA')
+            image = Image.new('RGB', rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.getchannel('A'))
+        image.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+        output = io.BytesIO()
+        if fmt == 'JPEG':
+            image.save(output, 'JPEG', quality=quality, optimize=True, progressive=True)
+        else:
+            image.save(output, fmt, quality=quality)
+        return output.getvalue()
+
+
+def rendition_name(name, suffix=''):
+    stem = os.path.splitext(os.path.basename(name))[0]
+    return f"{stem}{suffix}.{EXTENSIONS.get(settings.IMAGE_FORMAT, 'jpg')}"
+
+
+# Replaces an uploaded image with its downscaled, recompressed and EXIF-free
+# rendition and creates its thumbnail. Only the image, thumbnail and processed
+# columns are written (with an UPDATE, so the flag rotation isn't disturbed and no
+# signal fires). Returns False if there was nothing to do.
+def process_image(image_id):
+    vocab_image = VocabularyImage.objects.filter(id=image_id, processed=False).select_related('vocabulary').first()
+    if vocab_image is None or not vocab_image.image:
+        return False
+    fmt = settings.IMAGE_FORMAT
+    source_name = vocab_image.image.name
+    with vocab_image.image.open('rb') as source:
+        data = source.read()
+    full = render_image(io.BytesIO(data), settings.IMAGE_MAX_DIMENSION, fmt, settings.IMAGE_QUALITY)
+    thumbnail = render_image(io.BytesIO(data), settings.THUMBNAIL_DIMENSION, fmt, settings.IMAGE_QUALITY)
+
+    storage = vocab_image.image.storage
+    old_thumbnail = vocab_image.thumbnail.name if vocab_image.thumbnail else None
+    vocab_image.image.save(rendition_name(source_name), ContentFile(full), save=False)
+    vocab_image.thumbnail.save(rendition_name(source_name, '-thumb'), ContentFile(thumbnail), save=False)
+    updated = VocabularyImage.objects.filter(id=image_id, image=source_name).update(
+        image=vocab_image.image.name, thumbnail=vocab_image.thumbnail.name, processed=True,
+    )
+    if not updated:
+        # The row changed or went away meanwhile: drop what we wrote
+        storage.delete(vocab_image.image.name)
+        storage.delete(vocab_image.thumbnail.name)
+        return False
+    storage.delete(source_name)
+    if old_thumbnail:
+        storage.delete(old_thumbnail)
+    # The update sends no signal; the word's pages show the new rendition
+    invalidate(vocab_image.vocabulary.user_id, 'vocabulary')
+    return True
+
+
+def _process_in_background(image_id):
+    close_old_connections()
+    try:
+        process_image(image_id)
+    except Exception:
+        logger.exception("Processing image %s failed", image_id)
+    finally:
+        close_old_connections()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.IMAGE_PROCESSING_WORKERS, thread_name_prefix='images')
+        return _executor
+
+
+# Processes the image once the current transaction commits, on a background thread
+# so the upload request doesn't wait for it (inline if IMAGE_PROCESSING_ASYNC is off)
+def schedule_processing(image_id):
+    if settings.IMAGE_PROCESSING_ASYNC:
+        transaction.on_commit(lambda: get_executor().submit(_process_in_background, image_id))
+    else:
+        transaction.on_commit(lambda: process_image(image_id))
@@ -0,0 +1,474 @@
+import csv
+import html
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from .dashboard import invalidate
+from .images import schedule_processing
+from .models import UserVocabularyProgress, Vocabulary, VocabularyImage, VocabularyImport
+from .search import index_vocabularies, normalize
+from .stats import rebuild_stats
+
+
+logger = logging.getLogger(__name__)
+
+# File extensions of the supported formats
+FORMATS = {
+    '.csv': 'csv', '.tsv': 'tsv', '.txt': 'tsv',
+    '.json': 'json', '.jsonl': 'jsonl', '.ndjson': 'jsonl',
+    '.apkg': 'apkg', '.colpkg': 'apkg',
+}
+
+WORD_MAX_LENGTH = 250
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+# One word read from an import file. images are (file name, load) pairs where
+# load() returns the file's bytes, so images are only read when the word is saved.
+# progress holds UserVocabularyProgress fields when the source has review history.
+class ImportRecord:
+
+    def __init__(self, word, meaning, description='', images=(), progress=None):
+        self.word = (word or '').strip()
+        self.meaning = (meaning or '').strip()
+        self.description = (description or '').strip()
+        self.images = list(images)
+        self.progress = progress
+        # Meanings longer than the column are kept whole in the description
+        if len(self.meaning) > WORD_MAX_LENGTH:
+            self.description = f"{self.meaning}\n\n{self.description}".strip()
+            self.meaning = self.meaning[:WORD_MAX_LENGTH - 1] + '…'
+
+    def is_valid(self):
+        return bool(self.word and self.meaning) and len(self.word) <= WORD_MAX_LENGTH
+
+    # Words are duplicates if they're equal once case and Persian spelling are folded
+    def key(self):
+        return ' '.join(normalize(self.word).split())
+
+
+class ImportStats:
+
+    def __init__(self):
+        self.rows_read = 0
+        self.created = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.images = 0
+
+    def as_dict(self):
+        return {
+            'rows_read': self.rows_read, 'created': self.created, 'duplicates': self.duplicates,
+            'invalid': self.invalid, 'images': self.images,
+        }
+
+
+def detect_format(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in FORMATS:
+        raise ValueError(f"Unsupported file type {extension or filename!r}; use CSV, TSV, JSON, JSON Lines or an Anki .apkg.")
+    return FORMATS[extension]
+
+
+# Review history given as interval (days), ease_factor and next_review (ISO date)
+# columns, as UserVocabularyProgress fields; None if the row has none
+def _progress_from_mapping(row):
+    if not any(row.get(name) not in (None, '') for name in ('interval', 'ease_factor', 'next_review')):
+        return None
+    progress = {}
+    if row.get('interval') not in (None, ''):
+        progress['interval'] = max(0, int(float(row['interval'])))
+    if row.get('ease_factor') not in (None, ''):
+        progress['ease_factor'] = max(1.3, float(row['ease_factor']))
+    if row.get('next_review') not in (None, ''):
+        next_review = datetime.fromisoformat(str(row['next_review']))
+        if timezone.is_naive(next_review):
+            next_review = timezone.make_aware(next_review)
+        progress['next_review'] = next_review
+    return progress
+
+
+def _record_from_mapping(row):
+    row = {str(key).strip().lower(): value for key, value in row.items() if key is not None}
+    try:
+        progress = _progress_from_mapping(row)
+    except (TypeError, ValueError):
+        progress = None
+    return ImportRecord(
+        str(row.get('word') or ''), str(row.get('meaning') or ''), str(row.get('description') or ''), progress=progress,
+    )
+
+
+# CSV or TSV rows. With a header row naming a word column the columns are matched
+# by name (word, meaning, description, interval, ease_factor, next_review, like the
+# keys of JSON objects); otherwise they are word, meaning, description.
+def parse_delimited(stream, delimiter=','):
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    reader = csv.reader(text, delimiter=delimiter)
+    header = None
+    first = True
+    for row in reader:
+        if not any(cell.strip() for cell in row):
+            continue
+        # Anki's text export starts with "#separator:tab"-style lines
+        if first and row[0].startswith('#') and ':' in row[0]:
+            continue
+        if first:
+            first = False
+            names = [cell.strip().lower() for cell in row]
+            if 'word' in names:
+                header = names
+                continue
+        if header:
+            yield _record_from_mapping(dict(zip(header, row)))
+        else:
+            yield ImportRecord(*(row + ['', ''])[:3])
+    text.detach()
+
+
+# Objects of a top-level JSON array, decoded one at a time as the file is read, so
+# a large file is never held in memory whole. An entry longer than max_item_size
+# characters (IMPORT_MAX_RECORD_KB by default) is refused rather than buffered, which
+# also stops a malformed file from being read to the end.
+def _iter_json_array(stream, chunk_size=64 * 1024, max_item_size=None):
+    max_item_size = max_item_size or settings.IMPORT_MAX_RECORD_KB * 1024
+    decoder = json.JSONDecoder()
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig')
+    # Detached at the end, so the caller's stream isn't closed with the wrapper
+    try:
+        buffer = ''
+        position = 0
+        started = eof = False
+        while True:
+            while position < len(buffer) and (buffer[position].isspace() or (started and buffer[position] == ',')):
+                position += 1
+            need_more = position == len(buffer)
+            if not need_more:
+                if not started:
+                    if buffer[position] != '[':
+                        raise ValueError("A JSON import must be an array of objects.")
+                    started = True
+                    position += 1
+                    continue
+                if buffer[position] == ']':
+                    break
+                try:
+                    item, end = decoder.raw_decode(buffer, position)
+                    # A value ending the buffer (a number) may go on in the next chunk
+                    need_more = end == len(buffer) and not eof
+                except json.JSONDecodeError:
+                    need_more = True
+                if not need_more:
+                    yield item
+                    position = end
+                    continue
+            if eof:
+                raise ValueError("The JSON file is malformed or truncated.")
+            if len(buffer) - position > max_item_size:
+                raise ValueError(f"The JSON file is malformed or has an entry longer than {max_item_size // 1024} KB.")
+            chunk = text.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+    finally:
+        text.detach()
+
+
+def parse_json(stream):
+    for item in _iter_json_array(stream):
+        if isinstance(item, dict):
+            yield _record_from_mapping(item)
+        else:
+            yield ImportRecord('', '')
+
+
+def parse_json_lines(stream):
+    for line in io.TextIOWrapper(stream, encoding='utf-8-sig'):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError:
+            item = None
+        yield _record_from_mapping(item) if isinstance(item, dict) else ImportRecord('', '')
+
+
+IMG_RE = re.compile(r'<img[^>]*\ssrc=["\']?([^"\'>\s]+)', re.IGNORECASE)
+SOUND_RE = re.compile(r'\[sound:[^\]]*\]')
+BREAK_RE = re.compile(r'<br\s*/?>|</(?:div|p|li)>', re.IGNORECASE)
+TAG_RE = re.compile(r'<[^>]+>')
+
+
+# Text of an Anki field: HTML tags and sound references removed, entities decoded
+def anki_field_text(field):
+    text = BREAK_RE.sub('\n', SOUND_RE.sub('', field))
+    text = html.unescape(TAG_RE.sub('', text))
+    return '\n'.join(line.strip() for line in text.splitlines() if line.strip())
+
+
+# SM2 state of an Anki card, as UserVocabularyProgress fields. Review cards (type 2)
+# are due `due` days after the collection's creation; learning cards (type 1 and 3)
+# at the `due` timestamp. New cards have no history.
+def anki_progress(card_type, due, interval, factor, reps, lapses, created):
+    if card_type not in (1, 2, 3) or not reps:
+        return None
+    if card_type == 2:
+        next_review = datetime.fromtimestamp(created, dt_timezone.utc) + timedelta(days=due)
+    else:
+        next_review = datetime.fromtimestamp(due, dt_timezone.utc)
+    return {
+        'interval': max(0, interval),
+        'ease_factor': max(1.3, factor / 1000) if factor else 2.5,
+        'next_review': next_review,
+        'appeared_count': reps,
+        'didnt_know_count': lapses,
+        'knew_count': max(0, reps - lapses),
+    }
+
+
+# Notes of an Anki package (.apkg / .colpkg). The first field is the word, the
+# second the meaning and the others the description; images referenced in any field
+# are imported with the word. Each note's first card gives its review history.
+def parse_apkg(stream):
+    # Left open: the images are read from it when their chunk is saved, possibly after
+    # the last record was yielded. It doesn't own the stream, the caller closes that.
+    package = zipfile.ZipFile(stream)
+    with tempfile.TemporaryDirectory() as workdir:
+        names = set(package.namelist())
+        collection = next((name for name in ('collection.anki21', 'collection.anki2') if name in names), None)
+        if collection is None or ('collection.anki21b' in names and collection == 'collection.anki2'):
+            # Packages from Anki 2.1.50+ use a compressed format we can't read; the
+            # collection.anki2 they also carry is only a placeholder
+            raise ValueError("This Anki package uses the new format; export it again with \"Support older Anki versions\" checked.")
+        media = {}
+        if 'media' in names:
+            try:
+                media = {filename: member for member, filename in json.loads(package.read('media')).items()}
+            except (ValueError, AttributeError):
+                media = {}
+        limit = settings.IMPORT_MAX_COLLECTION_MB * 1024 * 1024
+        # zipfile stops reading a member at its stated size, so this bounds the copy
+        if package.getinfo(collection).file_size > limit:
+            raise ValueError(f"The Anki collection is larger than {settings.IMPORT_MAX_COLLECTION_MB} MB.")
+        database = os.path.join(workdir, 'collection.sqlite3')
+        with package.open(collection) as source, open(database, 'wb') as target:
+            shutil.copyfileobj(source, target)
+
+        def loader(member):
+            return lambda: package.read(member)
+
+        connection = sqlite3.connect(database)
+        try:
+            created = connection.execute('SELECT crt FROM col').fetchone()[0]
+            rows = connection.execute(
+                'SELECT notes.flds, cards.type, cards.due, cards.ivl, cards.factor, cards.reps, cards.lapses '
+                'FROM notes LEFT JOIN cards ON cards.id = '
+                '(SELECT id FROM cards WHERE cards.nid = notes.id ORDER BY ord LIMIT 1) ORDER BY notes.id'
+            )
+            for fields, card_type, due, interval, factor, reps, lapses in rows:
+                fields = fields.split('\x1f')
+                images = []
+                for field in fields:
+                    for filename in IMG_RE.findall(field):
+                        filename = html.unescape(filename)
+                        if filename in media and filename.lower().endswith(IMAGE_EXTENSIONS):
+                            images.append((os.path.basename(filename), loader(media[filename])))
+                texts = [anki_field_text(field) for field in fields]
+                yield ImportRecord(
+                    texts[0] if texts else '',
+                    texts[1] if len(texts) > 1 else '',
+                    '\n\n'.join(text for text in texts[2:] if text),
+                    images=images,
+                    progress=anki_progress(card_type, due or 0, interval or 0, factor, reps or 0, lapses or 0, created),
+                )
+        finally:
+            connection.close()
+
+
+# ImportRecords of an open binary file in the given format
+def parse_file(stream, fmt):
+    if fmt == 'csv':
+        return parse_delimited(stream, ',')
+    if fmt == 'tsv':
+        return parse_delimited(stream, '\t')
+    if fmt == 'json':
+        return parse_json(stream)
+    if fmt == 'jsonl':
+        return parse_json_lines(stream)
+    if fmt == 'apkg':
+        return parse_apkg(stream)
+    raise ValueError(f"Unsupported import format {fmt!r}.")
+
+
+# Inserts one chunk of new words with their images and review history: one
+# bulk_create per table. Image files are written first and removed again if the
+# insert fails.
+def _insert_chunk(user_profile, records, stats):
+    saved_files = []
+    try:
+        images = []
+        with transaction.atomic():
+            vocabs = Vocabulary.objects.bulk_create([
+                Vocabulary(user_id=user_profile.id, word=record.word, meaning=record.meaning, description=record.description)
+                for record in records
+            ])
+            # bulk_create sends no signals: index the new words and invalidate the
+            # user's dashboard here
+            index_vocabularies(vocabs)
+            invalidate(user_profile.id)
+            UserVocabularyProgress.objects.bulk_create([
+                UserVocabularyProgress(user_id=user_profile.id, vocabulary_id=vocab.id, **record.progress)
+                for vocab, record in zip(vocabs, records)
+                if record.progress
+            ])
+            for vocab, record in zip(vocabs, records):
+                for filename, load in record.images:
+                    path = default_storage.save(f"img/{filename}", ContentFile(load()))
+                    saved_files.append(path)
+                    images.append(VocabularyImage(vocabulary_id=vocab.id, image=path))
+            VocabularyImage.objects.bulk_create(images)
+            for image in images:
+                schedule_processing(image.id)
+    except Exception:
+        for path in saved_files:
+            default_storage.delete(path)
+        raise
+    stats.created += len(vocabs)
+    stats.images += len(images)
+
+
+# Adds the records to the user's vocabulary, chunk_size words per transaction.
+# Words the user already has (or that appear earlier in the file) and rows without
+# a word or meaning are skipped. Only one chunk of records is held at a time (plus
+# the keys of the user's words). on_progress(stats) is called after every chunk.
+# Imported review history is added to the user's stats at the end.
+def import_records(user_profile, records, chunk_size=None, on_progress=None):
+    chunk_size = chunk_size or settings.IMPORT_CHUNK_SIZE
+    stats = ImportStats()
+    seen = {
+        ' '.join(normalize(word).split())
+        for word in Vocabulary.objects.filter(user=user_profile).values_list('word', flat=True).iterator()
+    }
+    chunk = []
+    with_history = False
+    for record in records:
+        stats.rows_read += 1
+        if not record.is_valid():
+            stats.invalid += 1
+            continue
+        key = record.key()
+        if key in seen:
+            stats.duplicates += 1
+            continue
+        seen.add(key)
+        chunk.append(record)
+        with_history = with_history or bool(record.progress)
+        if len(chunk) >= chunk_size:
+            _insert_chunk(user_profile, chunk, stats)
+            chunk = []
+            if on_progress:
+                on_progress(stats)
+    if chunk:
+        _insert_chunk(user_profile, chunk, stats)
+    if with_history:
+        rebuild_stats([user_profile.id])
+    if on_progress:
+        on_progress(stats)
+    return stats
+
+
+# Runs an uploaded VocabularyImport, recording its progress and outcome on the row.
+# The uploaded file is deleted afterwards.
+def run_import(import_id):
+    vocabulary_import = VocabularyImport.objects.select_related('user').get(id=import_id)
+    started = VocabularyImport.objects.filter(id=import_id, status=VocabularyImport.PENDING).update(
+        status=VocabularyImport.RUNNING, progress_at=timezone.now(),
+    )
+    if not started:
+        return None
+
+    def on_progress(stats):
+        VocabularyImport.objects.filter(id=import_id).update(
+            rows_read=stats.rows_read, created_count=stats.created, duplicate_count=stats.duplicates,
+            invalid_count=stats.invalid, image_count=stats.images, progress_at=timezone.now(),
+        )
+
+    try:
+        with vocabulary_import.file.open('rb') as stream:
+            stats = import_records(vocabulary_import.user, parse_file(stream, vocabulary_import.format), on_progress=on_progress)
+    except Exception as e:
+        VocabularyImport.objects.filter(id=import_id).update(
+            status=VocabularyImport.FAILED, error=str(e) if isinstance(e, ValueError) else 'The file could not be imported.',
+            finished_at=timezone.now(),
+        )
+        if not isinstance(e, ValueError):
+            logger.exception("Import %s failed", import_id)
+        stats = None
+    else:
+        VocabularyImport.objects.filter(id=import_id).update(status=VocabularyImport.DONE, finished_at=timezone.now())
+    vocabulary_import.file.storage.delete(vocabulary_import.file.name)
+    return stats
+
+
+# Marks the running imports that reported no progress for IMPORT_STALE_MINUTES as
+# failed: the process running them stopped (a crash or a restart) and nothing else
+# will finish them. Their uploads are deleted. Returns the number of imports failed.
+def fail_stale_imports(user_profile=None, now=None):
+    cutoff = (now or timezone.now()) - timedelta(minutes=settings.IMPORT_STALE_MINUTES)
+    stale = VocabularyImport.objects.filter(
+        Q(progress_at__lt=cutoff) | Q(progress_at__isnull=True, created_at__lt=cutoff), status=VocabularyImport.RUNNING,
+    )
+    if user_profile is not None:
+        stale = stale.filter(user=user_profile)
+    failed = 0
+    for vocabulary_import in stale:
+        failed += VocabularyImport.objects.filter(id=vocabulary_import.id, status=VocabularyImport.RUNNING).update(
+            status=VocabularyImport.FAILED, error='The import was interrupted; please upload the file again.',
+            finished_at=timezone.now(),
+        )
+        vocabulary_import.file.storage.delete(vocabulary_import.file.name)
+    return failed
+
+
+def _run_in_background(import_id):
+    close_old_connections()
+    try:
+        run_import(import_id)
+    finally:
+        close_old_connections()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # One import at a time: SQLite has a single writer anyway
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='imports')
+        return _executor
+
+
+# Runs the import once the current transaction commits, on a background thread
+# (inline if IMPORT_ASYNC is off)
+def schedule_import(import_id):
+    if settings.IMPORT_ASYNC:
+        transaction.on_commit(lambda: get_executor().submit(_run_in_background, import_id))
+    else:
+        transaction.on_commit(lambda: run_import(import_id))
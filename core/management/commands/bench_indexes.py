@@ -0,0 +1,106 @@
+import json
+import random
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+from core.benchmarks.seed import benchmark_database, seed_dataset
+from core.models import UserProfile, Vocabulary, VocabularyImage, UserVocabularyProgress
+from core.planner import scheduled_candidates
+
+
+# Models whose Meta.indexes are compared
+INDEXED_MODELS = (UserVocabularyProgress, Vocabulary, VocabularyImage)
+
+
+#Seeds a throwaway database and compares query plans and timings of the review
+#scheduling queries with and without the composite/partial indexes
+class Command(BaseCommand):
+    help = 'Benchmark the review-scheduling queries with and without the scheduling indexes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--words', type=int, default=100, help='Words per user.')
+        parser.add_argument('--images', type=int, default=2, help='Images per word.')
+        parser.add_argument('--samples', type=int, default=50, help='Users sampled per query shape.')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            started = time.monotonic()
+            counts = seed_dataset(options['users'], options['words'], options['images'])
+            self.stderr.write(f"Seeded {counts} in {time.monotonic() - started:.1f} s")
+
+            rng = random.Random(1)
+            user_ids = list(UserProfile.objects.values_list('id', flat=True))
+            sample = rng.sample(user_ids, min(options['samples'], len(user_ids)))
+
+            self.analyze()
+            with_indexes = self.run_queries(sample)
+            self.drop_indexes()
+            self.analyze()
+            without_indexes = self.run_queries(sample)
+
+        results = {
+            'dataset': counts,
+            'queries': {
+                name: {'with_indexes': with_indexes[name], 'without_indexes': without_indexes[name]}
+                for name in with_indexes
+            },
+        }
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        for name, result in results['queries'].items():
+            before = result['without_indexes']
+            after = result['with_indexes']
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            self.stdout.write(f"  without indexes: {before['avg_ms']:.3f} ms  plan: {before['plan']}")
+            self.stdout.write(f"  with indexes:    {after['avg_ms']:.3f} ms  plan: {after['plan']}")
+
+    # The query shapes of the scheduling hot paths, one queryset per sampled user
+    def query_shapes(self, user_id):
+        now = timezone.now()
+        vocab_ids = list(Vocabulary.objects.filter(user_id=user_id).values_list('id', flat=True)[:5])
+        return {
+            'due_cards_per_user': UserVocabularyProgress.objects.filter(
+                user_id=user_id, next_review__lte=now).order_by('next_review')[:5],
+            'latest_words_per_user': Vocabulary.objects.filter(user_id=user_id).order_by('-date_added')[:3],
+            'unflagged_images_per_vocab': VocabularyImage.objects.filter(vocabulary_id__in=vocab_ids, flag=False),
+            'planner_candidates': scheduled_candidates([user_id], 5, now),
+        }
+
+    def run_queries(self, sample):
+        timings = {}
+        plans = {}
+        for user_id in sample:
+            for name, queryset in self.query_shapes(user_id).items():
+                plans.setdefault(name, self.query_plan(queryset))
+                started = time.perf_counter()
+                list(queryset)
+                timings.setdefault(name, []).append(time.perf_counter() - started)
+        return {
+            name: {'avg_ms': sum(values) / len(values) * 1000, 'plan': plans[name]}
+            for name, values in timings.items()
+        }
+
+    # QuerySet.explain() can't handle the window-filter subquery on SQLite, so the
+    # plan is asked for directly
+    def query_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+                return ' | '.join(row[-1] for row in cursor.fetchall())
+            cursor.execute(f"EXPLAIN {sql}", params)
+            return ' | '.join(str(row[0]).strip() for row in cursor.fetchall())
+
+    def drop_indexes(self):
+        with connection.schema_editor() as schema_editor:
+            for model in INDEXED_MODELS:
+                for index in model._meta.indexes:
+                    schema_editor.remove_index(model, index)
+
+    def analyze(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
@@ -0,0 +1,112 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+from core.benchmarks.seed import benchmark_database, seed_dataset
+from core.fake_telegram import FakeTelegramServer
+from core.models import OutboundMessage, UserProfile
+
+
+#Runs the daily delivery with 1, 2, 4, ... scheduler processes against a local fake
+#Telegram server and reports throughput and duplicate sends per shard count
+class Command(BaseCommand):
+    help = 'Benchmark sharded delivery: run_scheduler --once in N processes against a fake Telegram server.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=300)
+        parser.add_argument('--words', type=int, default=5, help='Cards per user.')
+        parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+        parser.add_argument('--workers', type=int, default=4, help='Delivery threads per process.')
+        parser.add_argument('--latency', type=float, default=0.05, help='Fake Bot API latency per request (s).')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+
+    def handle(self, *args, **options):
+        workdir = tempfile.TemporaryDirectory()
+        # Cards without images are sent with the default image, relative to the cwd
+        os.makedirs(os.path.join(workdir.name, 'media', 'img'))
+        with open(os.path.join(workdir.name, 'media', 'img', 'immg.jpg'), 'wb') as image_file:
+            image_file.write(b'bench image')
+        database = os.path.join(workdir.name, 'bench.sqlite3')
+        # A file database, so the scheduler processes share it
+        connection.settings_dict.setdefault('TEST', {})['NAME'] = database
+
+        results = []
+        with benchmark_database(), FakeTelegramServer(latency=options['latency']) as telegram:
+            counts = seed_dataset(options['users'], options['words'], images_per_word=0, reviewed_ratio=0)
+            self.stderr.write(f"Seeded {counts}")
+            expected = counts['users'] * options['words']
+            for shard_count in options['shards']:
+                result = self.run_shards(shard_count, database, workdir.name, telegram, options)
+                result['expected'] = expected
+                results.append(result)
+                self.stderr.write(f"{shard_count} processes: {result}")
+        workdir.cleanup()
+
+        base = results[0]['messages_per_second'] / results[0]['processes'] if results else 0
+        for result in results:
+            result['speedup_per_process'] = round(result['messages_per_second'] / base / result['processes'], 2) if base else 0.0
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(f"{'processes':>10} {'seconds':>9} {'msg/s':>8} {'sent':>6} {'duplicates':>11} {'efficiency':>11}")
+        for result in results:
+            self.stdout.write(
+                f"{result['processes']:>10} {result['seconds']:>9} {result['messages_per_second']:>8} "
+                f"{result['sent']:>6} {result['duplicates']:>11} {result['speedup_per_process']:>11}"
+            )
+
+    # Makes every user due, starts one run_scheduler --once per shard and waits for all
+    def run_shards(self, shard_count, database, workdir, telegram, options):
+        OutboundMessage.objects.all().delete()
+        UserProfile.objects.update(next_delivery_at=timezone.now() - timedelta(minutes=1))
+        requests_before = len(telegram.requests)
+        env = {
+            **os.environ,
+            'DATABASE_NAME': database,
+            'TELEGRAM_API_URL': telegram.url,
+            'API_KEY': os.environ.get('API_KEY', 'bench'),
+            'SECRET_KEY': os.environ.get('SECRET_KEY', 'bench'),
+            'TELEGRAM_RETRIES': '0',
+            'DELIVERY_WORKERS': str(options['workers']),
+            # The fake server has no rate limits; measure the processes, not the throttle
+            'TELEGRAM_GLOBAL_RATE': '100000',
+            'TELEGRAM_CHAT_RATE': '100000',
+        }
+        manage = os.path.join(settings.BASE_DIR, 'manage.py')
+        started = time.monotonic()
+        processes = [
+            subprocess.Popen(
+                [sys.executable, manage, 'run_scheduler', '--once', '--shard-index', str(index), '--shard-count', str(shard_count)],
+                cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            )
+            for index in range(shard_count)
+        ]
+        failures = []
+        for process in processes:
+            _, stderr = process.communicate()
+            if process.returncode:
+                failures.append(stderr.decode()[-500:])
+        seconds = time.monotonic() - started
+        for failure in failures:
+            self.stderr.write(self.style.ERROR(failure))
+
+        # Uploads are multipart, so their chat_id isn't recorded; they are counted all the same
+        photos = [params.get('chat_id') for method, params in telegram.requests[requests_before:] if method == 'sendPhoto']
+        # Every sent outbox row should account for exactly one request
+        sent_rows = OutboundMessage.objects.filter(status=OutboundMessage.SENT).count()
+        return {
+            'processes': shard_count,
+            'seconds': round(seconds, 2),
+            'sent': len(photos),
+            'messages_per_second': round(len(photos) / seconds, 1),
+            'chats': len(set(photos) - {None}),
+            'duplicates': len(photos) - sent_rows,
+            'failed_processes': len(failures),
+        }
@@ -0,0 +1,81 @@
+import json
+import time
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from core.simulation import CardState, simulate
+
+
+#Forecasts the review load of the coming days from the current UserVocabularyProgress
+#rows and compares it with a per-user daily cap and with load-balanced due dates
+class Command(BaseCommand):
+    help = ('Simulate the SM2 schedule of every card forward and print the forecast due/reviewed/backlog '
+            'per day, suggested per-user daily caps, and the effect of --cap and --fuzz.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30)
+        parser.add_argument('--cap', type=int,
+            help='Cards a user reviews per day at most; the rest stays due (backlog).')
+        parser.add_argument('--recall', type=float, default=0.85,
+            help='Probability that a reviewed card is remembered.')
+        parser.add_argument('--fuzz', type=float, default=0.0,
+            help='Spread new due dates over +-this fraction of the interval, towards lighter days.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+
+    def handle(self, *args, **options):
+        days = options['days']
+        if days <= 0:
+            raise CommandError('--days must be positive.')
+        if not 0 <= options['recall'] <= 1:
+            raise CommandError('--recall must be between 0 and 1.')
+        if options['cap'] is not None and options['cap'] <= 0:
+            raise CommandError('--cap must be positive.')
+        if options['fuzz'] < 0:
+            raise CommandError('--fuzz can not be negative.')
+
+        started = time.monotonic()
+        state, profile_ids = CardState.from_database()
+        self.stderr.write(f"Loaded {len(state)} cards of {len(profile_ids)} users in {time.monotonic() - started:.1f} s")
+
+        def run(**kwargs):
+            return simulate(state, days, recall=options['recall'], seed=options['seed'], **kwargs)[0]
+
+        # Caps are suggested from the uncapped run: a capped run counts the same
+        # backlog card again on every day it waits
+        baseline = run()
+        results = {'cards': len(state), 'users': len(profile_ids), 'baseline': baseline.summary()}
+        caps = baseline.suggested_caps()
+        results['suggested_caps'] = self.distribution(caps) if len(caps) else {}
+        if options['cap'] is not None:
+            results['capped'] = run(daily_cap=options['cap']).summary()
+        if options['fuzz'] > 0:
+            results['fuzzed'] = run(daily_cap=options['cap'], fuzz=options['fuzz']).summary()
+        results['seconds'] = round(time.monotonic() - started, 2)
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.print_table(results)
+
+    def distribution(self, caps):
+        return {
+            'p50': int(np.percentile(caps, 50)),
+            'p90': int(np.percentile(caps, 90)),
+            'p99': int(np.percentile(caps, 99)),
+            'max': int(caps.max()),
+        }
+
+    def print_table(self, results):
+        runs = [name for name in ('baseline', 'capped', 'fuzzed') if name in results]
+        header = ['day'] + [f"{name} {column}" for name in runs for column in ('reviewed', 'backlog')]
+        self.stdout.write('  '.join(f"{title:>17}" for title in header))
+        for day in range(results['baseline']['days']):
+            row = [day]
+            for name in runs:
+                row += [results[name]['reviewed_per_day'][day], results[name]['backlog_per_day'][day]]
+            self.stdout.write('  '.join(f"{value:>17}" for value in row))
+        for name in runs:
+            self.stdout.write(f"{name}: peak {results[name]['peak_reviews']} reviews/day, mean {results[name]['mean_reviews']}")
+        if results['suggested_caps']:
+            self.stdout.write(f"Suggested daily caps per user: {results['suggested_caps']}")
+        self.stdout.write(self.style.SUCCESS(f"Simulated {results['cards']} cards in {results['seconds']} s."))
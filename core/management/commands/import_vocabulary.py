@@ -0,0 +1,42 @@
+import time
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from core.importers import detect_format, import_records, parse_file
+
+
+#Imports words for a user from a CSV, TSV, JSON, JSON Lines or Anki .apkg file,
+#printing progress after every chunk
+class Command(BaseCommand):
+    help = 'Import vocabulary from a file into a user\'s words.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'tsv', 'json', 'jsonl', 'apkg'], help='Default: from the file extension.')
+        parser.add_argument('--chunk-size', type=int, default=None)
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(username=options['username']).select_related('userprofile').first()
+        if user is None:
+            raise CommandError(f"No user named {options['username']!r}.")
+        try:
+            fmt = options['format'] or detect_format(options['path'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        started = time.monotonic()
+
+        def on_progress(stats):
+            self.stdout.write(
+                f"{stats.rows_read} rows read, {stats.created} added, {stats.duplicates} duplicates, "
+                f"{stats.invalid} skipped ({time.monotonic() - started:.1f} s)"
+            )
+
+        try:
+            with open(options['path'], 'rb') as stream:
+                stats = import_records(user.userprofile, parse_file(stream, fmt), options['chunk_size'], on_progress)
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(
+            f"Done: {stats.created} words and {stats.images} images added in {time.monotonic() - started:.1f} s."
+        ))
@@ -0,0 +1,44 @@
+import json
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from core.models import OutboundMessage
+from core.outbox import outbox_stats
+
+
+#Shows the health of the outbound message queue and manages its dead letters
+class Command(BaseCommand):
+    help = 'Show outbox counts, dead letters and delivery latency; optionally requeue dead letters or purge sent rows.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=float, default=24, help='Latency window in hours.')
+        parser.add_argument('--requeue-dead', action='store_true',
+            help='Give every dead letter a fresh set of attempts.')
+        parser.add_argument('--purge-sent-days', type=int,
+            help='Delete sent rows older than this many days.')
+        parser.add_argument('--json', action='store_true', help='Print the stats as JSON.')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        if options['requeue_dead']:
+            requeued = OutboundMessage.objects.filter(status=OutboundMessage.DEAD).update(
+                status=OutboundMessage.PENDING, attempts=0, next_attempt_at=now, last_error='',
+            )
+            self.stderr.write(f"Requeued {requeued} dead letters.")
+        if options['purge_sent_days'] is not None:
+            if options['purge_sent_days'] < 0:
+                raise CommandError('--purge-sent-days can not be negative.')
+            purged, _ = OutboundMessage.objects.filter(
+                status=OutboundMessage.SENT, sent_at__lt=now - timedelta(days=options['purge_sent_days']),
+            ).delete()
+            self.stderr.write(f"Purged {purged} sent rows.")
+
+        stats = outbox_stats(now, timedelta(hours=options['hours']))
+        if options['json']:
+            self.stdout.write(json.dumps(stats, indent=2))
+            return
+        for name, value in stats.items():
+            self.stdout.write(f"{name:>22}: {value}")
+        recent_dead = OutboundMessage.objects.filter(status=OutboundMessage.DEAD).order_by('-id')[:5]
+        for message in recent_dead:
+            self.stdout.write(self.style.WARNING(f"dead #{message.id} {message.method} -> {message.chat_id}: {message.last_error}"))
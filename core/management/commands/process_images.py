@@ -0,0 +1,34 @@
+import time
+from django.core.management.base import BaseCommand
+from core.images import process_image
+from core.models import VocabularyImage
+
+
+#Downscales, recompresses and thumbnails the images uploaded before the pipeline
+#existed (or whose background processing failed)
+class Command(BaseCommand):
+    help = 'Process every vocabulary image that has not been processed yet.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=200)
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        processed = failed = 0
+        last_id = 0
+        while True:
+            ids = list(
+                VocabularyImage.objects.filter(processed=False, id__gt=last_id)
+                .exclude(image='').order_by('id').values_list('id', flat=True)[:options['chunk_size']]
+            )
+            if not ids:
+                break
+            last_id = ids[-1]
+            for image_id in ids:
+                try:
+                    processed += process_image(image_id)
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(self.style.ERROR(f"Image {image_id}: {type(e).__name__} - {e}"))
+            self.stdout.write(f"{processed} processed, {failed} failed ({time.monotonic() - started:.1f} s)")
+        self.stdout.write(self.style.SUCCESS(f"Done: {processed} images processed, {failed} failed."))
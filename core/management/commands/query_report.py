@@ -0,0 +1,66 @@
+import json
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from core.profiling import read_profiles, summarize
+
+
+SORT_FIELDS = ('queries_p95', 'queries_max', 'duplicates_max', 'render_queries_max', 'db_ms_p95', 'render_ms_p95', 'total_ms_p95')
+
+
+#Ranks the web endpoints by the request profiles the query profiler wrote to
+#QUERY_PROFILER_FILE over the last --hours. With a --max-* budget it fails (exit
+#status 1) when an endpoint went over it, e.g. in CI after running the test suite.
+class Command(BaseCommand):
+    help = 'Rank endpoints by query count, duplicate queries, DB and render time from the query profiler file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', default=settings.QUERY_PROFILER_FILE,
+            help='Profile file written by the query profiler (default: QUERY_PROFILER_FILE).')
+        parser.add_argument('--hours', type=float, default=24, help='Only read profiles from the last this many hours.')
+        parser.add_argument('--sort', choices=SORT_FIELDS, default='queries_p95')
+        parser.add_argument('--limit', type=int, default=20, help='Endpoints to show.')
+        parser.add_argument('--max-queries', type=int, help='Fail if an endpoint ran more queries in one request.')
+        parser.add_argument('--max-duplicates', type=int, help='Fail if an endpoint repeated more queries in one request.')
+        parser.add_argument('--max-db-ms', type=float, help='Fail if an endpoint p95 DB time is higher.')
+        parser.add_argument('--json', action='store_true', help='Print the summaries as JSON.')
+
+    def handle(self, *args, **options):
+        if not options['file']:
+            raise CommandError('No profile file: set QUERY_PROFILER_FILE or pass --file.')
+        since = timezone.now() - timedelta(hours=options['hours'])
+        try:
+            summaries = summarize(read_profiles(options['file'], since), sort=options['sort'])
+        except FileNotFoundError:
+            raise CommandError(f"{options['file']} does not exist; enable QUERY_PROFILER and make some requests first.")
+
+        if options['json']:
+            self.stdout.write(json.dumps(summaries[:options['limit']], indent=2))
+        else:
+            self.stdout.write(f"{'endpoint':<28}{'reqs':>6}{'q p50':>7}{'q p95':>7}{'q max':>7}{'dups':>6}{'in tpl':>8}{'db p95':>9}{'tpl p95':>9}{'p95 ms':>9}")
+            for summary in summaries[:options['limit']]:
+                self.stdout.write(
+                    f"{summary['endpoint']:<28}{summary['requests']:>6}{summary['queries_p50']:>7}{summary['queries_p95']:>7}"
+                    f"{summary['queries_max']:>7}{summary['duplicates_max']:>6}{summary['render_queries_max']:>8}"
+                    f"{summary['db_ms_p95']:>9}{summary['render_ms_p95']:>9}{summary['total_ms_p95']:>9}"
+                )
+                if summary['worst_repeated']:
+                    signature, count = summary['worst_repeated']
+                    self.stdout.write(self.style.WARNING(f"    {count}x {signature[:160]}"))
+
+        over_budget = [
+            f"{summary['endpoint']}: {problem}"
+            for summary in summaries
+            for problem in self.over_budget(summary, options)
+        ]
+        if over_budget:
+            raise CommandError('Over budget:\n' + '\n'.join(over_budget))
+
+    def over_budget(self, summary, options):
+        if options['max_queries'] is not None and summary['queries_max'] > options['max_queries']:
+            yield f"{summary['queries_max']} queries > {options['max_queries']}"
+        if options['max_duplicates'] is not None and summary['duplicates_max'] > options['max_duplicates']:
+            yield f"{summary['duplicates_max']} duplicate queries > {options['max_duplicates']}"
+        if options['max_db_ms'] is not None and summary['db_ms_p95'] > options['max_db_ms']:
+            yield f"p95 DB time {summary['db_ms_p95']} ms > {options['max_db_ms']} ms"
@@ -0,0 +1,20 @@
+import time
+from django.core.management.base import BaseCommand
+from core.search import fts_available, rebuild_index
+
+
+#Rebuilds the full-text index of the vocabulary from scratch, e.g. after words were
+#written without signals or after changing how text is normalized
+class Command(BaseCommand):
+    help = 'Rebuild the vocabulary full-text search index (SQLite FTS5).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        if not fts_available():
+            self.stdout.write('This database is searched directly; there is no index to rebuild.')
+            return
+        started = time.monotonic()
+        indexed = rebuild_index(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f"Indexed {indexed} words in {time.monotonic() - started:.1f} s."))
@@ -0,0 +1,26 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from core.models import UserProfile
+from core.stats import rebuild_stats
+
+
+#Recomputes the UserStats rows from the progress rows and the daily history, e.g.
+#after bulk edits of the progress or if the incremental updates drifted
+class Command(BaseCommand):
+    help = 'Rebuild the per-user learning statistics from the review progress, in bulk.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='*', help='Only rebuild these users (default: everyone).')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Users per query and upsert.')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] <= 0:
+            raise CommandError('--chunk-size must be positive.')
+        profile_ids = None
+        if options['usernames']:
+            profile_ids = list(UserProfile.objects.filter(user__username__in=options['usernames']).values_list('id', flat=True))
+            if len(profile_ids) != len(set(options['usernames'])):
+                raise CommandError('Unknown username.')
+        started = time.monotonic()
+        rebuilt = rebuild_stats(profile_ids, chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt the stats of {rebuilt} users in {time.monotonic() - started:.1f} s."))
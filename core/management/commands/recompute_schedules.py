@@ -0,0 +1,131 @@
+import time
+from datetime import timezone as dt_timezone
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from core.dashboard import invalidate_all
+from core.models import UserVocabularyProgress
+from core.scheduling import (
+    FAIL_EASE_PENALTY, FIRST_INTERVAL, MIN_EASE, PASS_QUALITY, SECOND_INTERVAL, next_review_batch, sm2_replay,
+)
+
+
+def to_microseconds(values):
+    return np.array([v.astimezone(dt_timezone.utc).replace(tzinfo=None) for v in values], dtype='datetime64[us]').astype(np.int64)
+
+
+def from_microseconds(values):
+    return [v.replace(tzinfo=dt_timezone.utc) for v in values.astype('datetime64[us]').astype(object)]
+
+
+
+#Recomputes SM2 schedules of UserVocabularyProgress rows in bulk, chunk by chunk.
+#Only the schedule (interval, ease_factor, next_review) is written: the review history
+#(last_appeared and the answer counts) is never touched.
+class Command(BaseCommand):
+    help = ('Recompute next_review from last_appeared + interval (clamping ease factors to --min-ease), '
+            'or rebuild every reviewed card\'s schedule with --apply-quality and the given SM2 constants.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=20000)
+        parser.add_argument('--min-ease', type=float, default=MIN_EASE,
+            help='Ease factors below this are raised to it.')
+        parser.add_argument('--apply-quality', type=int, choices=range(6),
+            help='Rebuild the interval and ease of every selected reviewed card by replaying its appeared_count '
+                 'answers as SM2 steps of this quality (0-5) from a new card, due from its last review; e.g. to '
+                 're-tune the constants. Running it again with the same options changes nothing.')
+        parser.add_argument('--fail-penalty', type=float, default=FAIL_EASE_PENALTY,
+            help='With --apply-quality: ease lost by a failed answer.')
+        parser.add_argument('--first-interval', type=int, default=FIRST_INTERVAL,
+            help='With --apply-quality: interval in days after a first or failed answer.')
+        parser.add_argument('--second-interval', type=int, default=SECOND_INTERVAL,
+            help='With --apply-quality: interval in days after the second passed answer.')
+        parser.add_argument('--pass-quality', type=int, default=PASS_QUALITY, choices=range(6),
+            help='With --apply-quality: lowest quality that counts as remembered.')
+        parser.add_argument('--due-only', action='store_true',
+            help='Only touch cards whose next_review has passed.')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        if chunk_size <= 0:
+            raise CommandError('--chunk-size must be positive.')
+        if options['first_interval'] < 1 or options['second_interval'] < 1:
+            raise CommandError('--first-interval and --second-interval must be at least 1 day.')
+        now = timezone.now()
+        rows = UserVocabularyProgress.objects.all()
+        if options['due_only']:
+            rows = rows.filter(next_review__lte=now)
+
+        started = time.monotonic()
+        scanned = updated = 0
+        last_id = 0
+        while True:
+            chunk = list(
+                rows.filter(id__gt=last_id).order_by('id').values_list(
+                    'id', 'interval', 'ease_factor', 'last_appeared', 'next_review', 'appeared_count',
+                )[:chunk_size]
+            )
+            if not chunk:
+                break
+            last_id = chunk[-1][0]
+            scanned += len(chunk)
+            changed = self.recompute_chunk(chunk, now, options)
+            if not options['dry_run'] and changed:
+                with transaction.atomic():
+                    UserVocabularyProgress.objects.bulk_update(changed, ['interval', 'ease_factor', 'next_review'], batch_size=1000)
+                    # bulk_update sends no signals
+                    invalidate_all()
+            updated += len(changed)
+            self.stdout.write(f"{scanned} rows scanned, {updated} to update ({time.monotonic() - started:.1f} s)")
+
+        verb = 'would be updated' if options['dry_run'] else 'updated'
+        self.stdout.write(self.style.SUCCESS(
+            f"Done: {scanned} rows scanned, {updated} {verb} in {time.monotonic() - started:.1f} s."
+        ))
+
+    # Returns the unsaved UserVocabularyProgress objects whose schedule changed.
+    # Never-reviewed cards keep their schedule.
+    def recompute_chunk(self, chunk, now, options):
+        ids, intervals, eases, last_appeared, next_reviews, appeared = zip(*chunk)
+        ids = np.array(ids)
+        interval = np.array(intervals, dtype=np.int64)
+        ease = np.array(eases, dtype=np.float64)
+        next_review = to_microseconds(next_reviews)
+        has_review = np.array([value is not None for value in last_appeared])
+        reviewed = to_microseconds([value or now for value in last_appeared])
+
+        quality = options['apply_quality']
+        if quality is not None:
+            # Replayed from the stored answer count, not from the current schedule,
+            # which a previous run may already have written
+            new_interval, new_ease = sm2_replay(
+                appeared, quality, UserVocabularyProgress._meta.get_field('ease_factor').default,
+                min_ease=options['min_ease'], fail_penalty=options['fail_penalty'],
+                first_interval=options['first_interval'], second_interval=options['second_interval'],
+                pass_quality=options['pass_quality'],
+            )
+            new_interval = np.where(has_review, new_interval, interval)
+            new_ease = np.where(has_review, new_ease, ease)
+        else:
+            new_interval = interval
+            new_ease = np.where(ease < options['min_ease'], options['min_ease'], ease)
+        # Rebuild next_review from the last review
+        new_next_review = np.where(has_review, next_review_batch(reviewed, new_interval), next_review)
+        # next_review is compared to the second: rows written by older versions of
+        # sm2() are off from last_appeared + interval by a few microseconds
+        moved = new_next_review // 1_000_000 != next_review // 1_000_000
+        changed = (new_interval != interval) | (new_ease != ease) | moved
+
+        index = np.flatnonzero(changed)
+        next_review_values = from_microseconds(new_next_review[index])
+        return [
+            UserVocabularyProgress(
+                id=int(ids[i]),
+                interval=int(new_interval[i]),
+                ease_factor=float(new_ease[i]),
+                next_review=next_review_values[n],
+            )
+            for n, i in enumerate(index)
+        ]
@@ -0,0 +1,111 @@
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from core.benchmarks.harness import peak_rss_mb
+from core.benchmarks.scenarios import SCENARIOS
+from core.benchmarks.seed import benchmark_database, seed_dataset
+from core.fake_telegram import FakeTelegramServer
+from core.models import VocabularyImage
+from core.search import rebuild_index
+from core.telegram_client import reset_client
+
+
+#Seeds a throwaway database with users x words x images and runs the benchmark
+#scenarios against a local fake Telegram Bot API, printing the results as JSON
+#(throughput, latency percentiles, query counts, peak RSS) for regression tracking
+class Command(BaseCommand):
+    help = 'Run the benchmark scenarios against a seeded database and a fake Telegram server; prints JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--words', type=int, default=20, help='Words per user.')
+        parser.add_argument('--images', type=int, default=1, help='Images per word.')
+        parser.add_argument('--updates', type=int, default=1000, help='Updates in the polling backlog.')
+        parser.add_argument('--burst', type=int, default=500, help='Callback queries in the burst.')
+        parser.add_argument('--requests', type=int, default=20, help='Requests per page and user in web_views.')
+        parser.add_argument('--latency', type=float, default=0.02, help='Fake Bot API latency per request (s).')
+        parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='Share of calls answered with a 429.')
+        parser.add_argument('--failure-rate', type=float, default=0.0, help='Share of calls answered with a 502.')
+        parser.add_argument('--retry-after', type=int, default=1, help='retry_after of the injected 429s (s).')
+        parser.add_argument('--real-rate-limits', action='store_true',
+                            help='Keep the TELEGRAM_*_RATE throttles (by default they are lifted to measure the code).')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Also write the JSON results to this file.')
+
+    def handle(self, *args, **options):
+        if not 0 <= options['rate_limit_rate'] + options['failure_rate'] <= 1:
+            raise CommandError('--rate-limit-rate and --failure-rate must add up to at most 1.')
+        workdir = tempfile.TemporaryDirectory()
+        media_root = os.path.join(workdir.name, 'media')
+        # Cards without images are sent with the default image, relative to the cwd
+        os.makedirs(os.path.join(media_root, 'img'))
+        with open(os.path.join(media_root, 'img', 'immg.jpg'), 'wb') as image_file:
+            image_file.write(b'bench image')
+        # A file database: the delivery and dispatcher threads write concurrently
+        connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(workdir.name, 'bench.sqlite3')
+
+        overrides = {'MEDIA_ROOT': media_root, 'IMAGE_PROCESSING_ASYNC': False}
+        if not options['real_rate_limits']:
+            overrides.update(TELEGRAM_GLOBAL_RATE=100_000, TELEGRAM_CHAT_RATE=100_000)
+        telegram = FakeTelegramServer(
+            latency=options['latency'], rate_limit_rate=options['rate_limit_rate'],
+            failure_rate=options['failure_rate'], retry_after=options['retry_after'], seed=options['seed'],
+        )
+        results = {'environment': self.environment(), 'options': self.recorded_options(options), 'scenarios': {}}
+        cwd = os.getcwd()
+        try:
+            os.chdir(workdir.name)
+            with benchmark_database(), telegram, override_settings(TELEGRAM_API_URL=telegram.url, **overrides):
+                reset_client()
+                started = time.monotonic()
+                results['dataset'] = seed_dataset(options['users'], options['words'], options['images'], seed=options['seed'])
+                self.write_image_files(media_root)
+                rebuild_index()
+                results['dataset']['seconds'] = round(time.monotonic() - started, 2)
+                self.stderr.write(f"Seeded {results['dataset']}")
+                for name in options['scenarios']:
+                    self.stderr.write(f"Running {name}...")
+                    results['scenarios'][name] = SCENARIOS[name](telegram, options)
+                    self.stderr.write(f"  {results['scenarios'][name]}")
+        finally:
+            os.chdir(cwd)
+            reset_client()
+            workdir.cleanup()
+        results['peak_rss_mb'] = peak_rss_mb()
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                output_file.write(output + '\n')
+        self.stdout.write(output)
+
+    # The seeded image rows point at files that don't exist; sendPhoto uploads them
+    def write_image_files(self, media_root):
+        for name in VocabularyImage.objects.values_list('image', flat=True).iterator():
+            path = os.path.join(media_root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as image_file:
+                image_file.write(b'bench image')
+
+    def environment(self):
+        return {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'argv': sys.argv[1:],
+        }
+
+    def recorded_options(self, options):
+        names = ('users', 'words', 'images', 'updates', 'burst', 'requests', 'latency', 'rate_limit_rate',
+                 'failure_rate', 'retry_after', 'real_rate_limits', 'seed')
+        return {name: options[name] for name in names}
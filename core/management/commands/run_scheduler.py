@@ -1,54 +1,144 @@
 import json
+import queue
 import schedule
+import threading
 import time
-import requests
 import traceback
-from django.core.management.base import BaseCommand
-from core.tasks import get_updates, handle_callback_query, send_vocabulary_batch, handle_message
+from django.conf import settings
+from django.db import connection
+from django.core.management.base import BaseCommand, CommandError
+from core.tasks import deliver_due_profiles
+from core.outbox import outbox_stats
+from core.polling import UpdatePoller, ALLOWED_UPDATES
+from core.dispatch import UpdateDispatcher
+from core.coordination import POLLER_LEASE, acquire_lease, process_identity, release_lease, validate_shard
+from core.metrics import write_metrics_file
+from core.telegram_client import TelegramAPIError
 
 
 #Starts the telegram bot scheduler and update poller
 class Command(BaseCommand):
 
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-timeout', type=int, default=25,
+            help='Long-polling timeout in seconds for getUpdates (0 falls back to short polling every 0.5 s).')
+        parser.add_argument('--limit', type=int, default=100,
+            help='Maximum number of updates fetched per getUpdates call (1-100).')
+        parser.add_argument('--allowed-updates', nargs='*', default=list(ALLOWED_UPDATES),
+            help='Update types to receive from Telegram.')
+        parser.add_argument('--workers', type=int, default=settings.UPDATE_WORKERS,
+            help='Number of threads handling updates. Updates of one chat are always handled in order.')
+        parser.add_argument('--queue-size', type=int, default=settings.UPDATE_QUEUE_SIZE,
+            help='Capacity of each worker queue; polling pauses while a queue is full.')
+        parser.add_argument('--no-polling', action='store_true',
+            help='Only run the scheduled jobs; use this when updates arrive through the webhook.')
+        parser.add_argument('--shard-index', type=int, default=0,
+            help='Which share of the users this process delivers to (0 .. shard count - 1).')
+        parser.add_argument('--shard-count', type=int, default=1,
+            help='Number of scheduler processes the deliveries are split across; run one per shard index.')
+        parser.add_argument('--once', action='store_true',
+            help="Deliver this shard's due cards and drain its outbox once, then exit.")
+
     def handle(self, *args, **options):
+        try:
+            shard = validate_shard(options['shard_index'], options['shard_count'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        poll_timeout = options['poll_timeout']
+        lease_seconds = settings.SCHEDULER_LEASE_SECONDS
+        # Only the poller holds the lease across a getUpdates call
+        polling = not options['no_polling'] and not options['once']
+        if polling and lease_seconds <= poll_timeout + 10:
+            raise CommandError('SCHEDULER_LEASE_SECONDS must be more than 10 s longer than --poll-timeout.')
+        if options['once']:
+            delivered = deliver_due_profiles(shard=shard)
+            self.stdout.write(self.style.SUCCESS(f"Delivered to {delivered} users."))
+            return
+
         self.stdout.write(self.style.SUCCESS('Starting scheduler and update poller...'))
-        schedule.every().day.at("10:00").do(send_vocabulary_batch)
-        self.stdout.write(f"Scheduled 'send_vocabulary_batch' to run daily at 10:00 AM.")
+        if shard:
+            self.stdout.write(f"Delivering to shard {shard[0]} of {shard[1]}.")
+        # Each user has a delivery slot in their own window; every tick sends to the
+        # users whose slot has come. Slots missed while stopped are caught up first.
+        tick = settings.DELIVERY_TICK_SECONDS
+        schedule.every(tick).seconds.do(deliver_due_profiles, shard=shard)
+        self.stdout.write(f"Scheduled 'deliver_due_profiles' to run every {tick} seconds.")
+        schedule.every(5).minutes.do(lambda: self.stdout.write(f"Outbox stats: {outbox_stats()}"))
+        if settings.METRICS_FILE:
+            # This process's metrics, for node_exporter's textfile collector
+            schedule.every(settings.METRICS_FILE_INTERVAL).seconds.do(write_metrics_file, settings.METRICS_FILE)
+            self.stdout.write(f"Writing metrics to {settings.METRICS_FILE} every {settings.METRICS_FILE_INTERVAL} seconds.")
+        if options['no_polling']:
+            self.catch_up(shard)
+            self.run_scheduler_only()
+            return
+        # The deliveries and the outbox drain run on their own thread, so a long drain
+        # neither holds up polling nor lets the poller lease expire
+        stop_jobs = threading.Event()
+        jobs = threading.Thread(target=self.run_jobs, args=(shard, stop_jobs), name='scheduler-jobs', daemon=True)
+        # The poller only enqueues; handlers run on the dispatcher's worker threads
+        self.dispatcher = dispatcher = UpdateDispatcher(workers=options['workers'], queue_size=options['queue_size']).start()
+        self.poller = poller = UpdatePoller(
+            timeout=poll_timeout,
+            limit=options['limit'],
+            allowed_updates=options['allowed_updates'],
+            handler=self.submit_update,
+        )
+        schedule.every(5).minutes.do(lambda: self.stdout.write(f"Update dispatcher stats: {dispatcher.stats()}"))
+        jobs.start()
+        if poll_timeout:
+            self.stdout.write(f"Long polling getUpdates with a {poll_timeout} s timeout.")
         self.stdout.write('Running scheduler and poller loop. Press CTRL+C to exit.')
-        update_offset = None
+        # Only the holder of the poller lease calls getUpdates; the other processes
+        # just run their jobs and take over if the holder stops renewing
+        self.holder = holder = process_identity()
+        self.lease_seconds = lease_seconds
+        leading = False
         while True:
             try:
-                updates = get_updates(offset=update_offset)
-                if updates:
-                    self.stdout.write(self.style.NOTICE(f"\n--- NEW UPDATES RECEIVED ---"))
-                    for update in updates:
-                        if 'callback_query' in update:
-                            self.stdout.write(f"Processing callback query update ID: {update['update_id']}")
-                            handle_callback_query(update)
-                        elif 'message' in update:
-                            self.stdout.write(f"Processing message update ID: {update['update_id']}")
-                            handle_message(update)
+                # Renewals also store the offset, so the next leader continues from it
+                lease = acquire_lease(POLLER_LEASE, holder, lease_seconds, value=poller.offset if leading else None)
+                if lease and not leading:
+                    poller.offset = lease.value
+                    self.stdout.write(self.style.NOTICE(f"\nElected as the update poller (offset {poller.offset})."))
+                elif leading and not lease:
+                    self.stdout.write(self.style.WARNING('\nLost the update poller lease; standing by.'))
+                leading = bool(lease)
+
+                if leading:
+                    self.lease_lost = False
+                    try:
+                        # Blocks for up to poll_timeout seconds while the bot is idle
+                        updates = poller.poll()
+                    except TelegramAPIError as e:
+                        self.poll_failed(e, poller)
+                    else:
+                        if updates and not self.lease_lost:
+                            # Store the offset past this batch at once, so a process
+                            # taking over doesn't handle the batch again
+                            self.lease_lost = not acquire_lease(POLLER_LEASE, holder, lease_seconds, value=poller.offset)
+                        if updates:
+                            self.stdout.write(self.style.NOTICE(f"\n--- {len(updates)} UPDATES QUEUED (depth {dispatcher.depth}) ---"))
                         else:
-                            self.stdout.write(f"Ignoring update type: {list(update.keys())} for update ID: {update.get('update_id', 'Not Available')}")
-                        update_offset = update['update_id'] + 1
+                            self.stdout.write(".", ending="") 
+                            self.stdout.flush()
+                    if self.lease_lost:
+                        self.stdout.write(self.style.WARNING('\nLost the update poller lease; standing by.'))
+                        leading = False
                 else:
-                    self.stdout.write(".", ending="") 
-                    self.stdout.flush()
+                    time.sleep(5)
 
-                schedule.run_pending()
-                time.sleep(0.5)
+                if leading and not poll_timeout:
+                    time.sleep(0.5)
 
             except KeyboardInterrupt:
-                self.stdout.write(self.style.WARNING('\nScheduler stopped (KeyboardInterrupt).'))
+                self.stdout.write(self.style.WARNING('\nScheduler stopped (KeyboardInterrupt). Finishing queued updates...'))
+                self.shut_down(stop_jobs, jobs, leading)
                 break
 
-            except requests.exceptions.ConnectionError as e:
-                 self.stderr.write(self.style.ERROR(f"Network Connection Error: {e}. Retrying in 15 seconds..."))
-                 time.sleep(15)
-
-            except requests.exceptions.Timeout as e:
-                self.stderr.write(self.style.ERROR(f"Request Timed Out: {e}. Retrying in 5 seconds..."))
-                time.sleep(5)
+            except CommandError:
+                self.shut_down(stop_jobs, jobs, leading)
+                raise
 
             except Exception as e:
                 self.stderr.write(self.style.ERROR(f"Error in main loop: {type(e).__name__} - {e}"))
@@ -58,24 +148,73 @@ class Command(BaseCommand):
 
         self.stdout.write(self.style.SUCCESS('Scheduler finished.'))
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    # Hands an update to the dispatcher. While the chat's queue is full the lease is
+    # renewed with the offset reached so far, so slow handlers don't cost the lease.
+    # Once the lease is lost the rest of the batch is left to the new holder, which
+    # resumes from that offset.
+    def submit_update(self, update):
+        while not self.lease_lost:
+            try:
+                self.dispatcher.submit(update, timeout=settings.UPDATE_QUEUE_PUT_TIMEOUT)
+                return
+            except queue.Full:
+                self.lease_lost = not acquire_lease(POLLER_LEASE, self.holder, self.lease_seconds, value=self.poller.offset)
+
+    # Waits for the running job and the queued updates, then gives up the lease
+    def shut_down(self, stop_jobs, jobs, leading):
+        stop_jobs.set()
+        jobs.join()
+        self.dispatcher.join()
+        if leading:
+            release_lease(POLLER_LEASE, self.holder, value=self.poller.offset)
+
+    # Reports a failed getUpdates and waits out the poller's backoff. A rejected bot
+    # token won't fix itself, so it stops the command.
+    def poll_failed(self, error, poller):
+        if error.error_code == 401:
+            raise CommandError(f"Telegram rejected the bot token: {error}")
+        delay = poller.backoff(error)
+        hint = ''
+        if error.error_code == 409:
+            hint = ' A webhook is set (see set_update_mode) or another process is polling with this token.'
+        self.stderr.write(self.style.ERROR(f"\n{error}.{hint} Retrying in {delay:.1f} seconds..."))
+        time.sleep(delay)
+
+    def catch_up(self, shard=None):
+        try:
+            delivered = deliver_due_profiles(shard=shard)
+            self.stdout.write(f"Caught up {delivered} due deliveries.")
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f"Catch-up delivery failed: {type(e).__name__} - {e}"))
+            self.stderr.write(traceback.format_exc())
+
+    # Catches up the missed deliveries, then runs the scheduled jobs until stop is set.
+    # Runs on its own thread next to the poller.
+    def run_jobs(self, shard, stop):
+        try:
+            self.catch_up(shard)
+            while not stop.wait(1):
+                try:
+                    schedule.run_pending()
+                except Exception as e:
+                    self.stderr.write(self.style.ERROR(f"Error in scheduler loop: {type(e).__name__} - {e}"))
+                    self.stderr.write(traceback.format_exc())
+                    stop.wait(5)
+        finally:
+            connection.close()
+
+    # Webhook mode: updates are handled by the web workers, this process only runs the jobs
+    def run_scheduler_only(self):
+        self.stdout.write('Running scheduler loop without polling. Press CTRL+C to exit.')
+        while True:
+            try:
+                schedule.run_pending()
+                time.sleep(1)
+            except KeyboardInterrupt:
+                self.stdout.write(self.style.WARNING('\nScheduler stopped (KeyboardInterrupt).'))
+                break
+            except Exception as e:
+                self.stderr.write(self.style.ERROR(f"Error in scheduler loop: {type(e).__name__} - {e}"))
+                self.stderr.write(traceback.format_exc())
+                time.sleep(5)
+        self.stdout.write(self.style.SUCCESS('Scheduler finished.'))
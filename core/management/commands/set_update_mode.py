@@ -0,0 +1,55 @@
+import json
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+from core.polling import ALLOWED_UPDATES
+from core.tasks import send_telegram_request
+
+
+#Switches the bot between webhook delivery of updates and getUpdates polling
+class Command(BaseCommand):
+    help = "Switch how the bot receives updates: 'webhook' (setWebhook) or 'polling' (deleteWebhook)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('mode', choices=['webhook', 'polling'])
+        parser.add_argument('--url',
+            help='Public HTTPS base URL of the site, e.g. https://vocab.example.com. Defaults to TELEGRAM_WEBHOOK_URL.')
+        parser.add_argument('--max-connections', type=int, default=40,
+            help='Maximum simultaneous HTTPS connections Telegram opens to the webhook (1-100).')
+        parser.add_argument('--drop-pending-updates', action='store_true',
+            help='Discard updates that are waiting to be delivered.')
+
+    def handle(self, *args, **options):
+        if options['mode'] == 'webhook':
+            self.enable_webhook(options)
+        else:
+            self.enable_polling(options)
+
+    def enable_webhook(self, options):
+        base_url = options['url'] or settings.TELEGRAM_WEBHOOK_URL
+        if not base_url:
+            raise CommandError('Pass --url or set TELEGRAM_WEBHOOK_URL.')
+        if not base_url.startswith('https://'):
+            raise CommandError('Telegram only delivers webhooks over HTTPS.')
+        if not settings.TELEGRAM_WEBHOOK_SECRET:
+            raise CommandError('Set TELEGRAM_WEBHOOK_SECRET so the webhook can verify incoming updates.')
+
+        webhook_url = base_url.rstrip('/') + reverse('telegram_webhook')
+        payload = {
+            'url': webhook_url,
+            'secret_token': settings.TELEGRAM_WEBHOOK_SECRET,
+            'allowed_updates': json.dumps(list(ALLOWED_UPDATES)),
+            'max_connections': options['max_connections'],
+            'drop_pending_updates': options['drop_pending_updates'],
+        }
+        if send_telegram_request('setWebhook', payload) is None:
+            raise CommandError('setWebhook failed, see the error above.')
+        self.stdout.write(self.style.SUCCESS(f"Webhook mode enabled: {webhook_url}"))
+        self.stdout.write("Run 'manage.py run_scheduler --no-polling' so the daily batch keeps running without polling.")
+
+    def enable_polling(self, options):
+        payload = {'drop_pending_updates': options['drop_pending_updates']}
+        if send_telegram_request('deleteWebhook', payload) is None:
+            raise CommandError('deleteWebhook failed, see the error above.')
+        self.stdout.write(self.style.SUCCESS("Polling mode enabled. Start 'manage.py run_scheduler' to receive updates."))
+
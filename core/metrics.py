@@ -0,0 +1,248 @@
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+
+
+logger = logging.getLogger(__name__)
+
+
+# Latency buckets in seconds, from a fast SQL query to a slow Bot API call
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+# A metric with a fixed set of label names; each combination of label values is
+# its own series. Updates take a lock, so metrics can be shared between threads.
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes the labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def reset(self):
+        with self.lock:
+            self.series.clear()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            series = sorted(self.series.items())
+            lines.extend(self._render_series(key, value) for key, value in series)
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.series.get(self._key(labels), 0)
+
+    def _render_series(self, key, value):
+        return f"{self.name}{_format_labels(zip(self.labels, key))} {_format_value(value)}"
+
+
+# Counts observations per bucket (cumulative in the output, like Prometheus
+# histograms) along with their sum
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {'buckets': [0] * len(self.buckets), 'count': 0, 'sum': 0.0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][index] += 1
+                    break
+            series['count'] += 1
+            series['sum'] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        series = self.series.get(self._key(labels))
+        return series['count'] if series else 0
+
+    def _render_series(self, key, series):
+        pairs = list(zip(self.labels, key))
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, series['buckets']):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{_format_labels(pairs + [('le', _format_value(bound))])} {cumulative}")
+        lines.append(f"{self.name}_bucket{_format_labels(pairs + [('le', '+Inf')])} {series['count']}")
+        lines.append(f"{self.name}_sum{_format_labels(pairs)} {series['sum']!r}")
+        lines.append(f"{self.name}_count{_format_labels(pairs)} {series['count']}")
+        return '\n'.join(lines)
+
+
+# The metrics of this process. They live in memory: the web process serves its own
+# at /metrics/, and the scheduler writes its own to METRICS_FILE (see write_metrics_file).
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _register(self, metric):
+        with self.lock:
+            existing = self.metrics.setdefault(metric.name, metric)
+        if type(existing) is not type(metric):
+            raise ValueError(f"Metric {metric.name} is already registered as a {existing.kind}")
+        return existing
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def reset(self):
+        for metric in list(self.metrics.values()):
+            metric.reset()
+
+    # The Prometheus text exposition format
+    def render(self):
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+registry = Registry()
+
+TELEGRAM_REQUESTS = registry.counter(
+    'vocabbot_telegram_requests_total', 'Bot API calls by method and outcome (ok, an error code, or network_error).',
+    ('method', 'outcome'),
+)
+TELEGRAM_LATENCY = registry.histogram(
+    'vocabbot_telegram_request_seconds', 'Duration of Bot API calls, retries included.', ('method',),
+)
+UPDATES = registry.counter(
+    'vocabbot_updates_total', 'Telegram updates handled, by update kind and outcome.', ('kind', 'outcome'),
+)
+UPDATE_LATENCY = registry.histogram(
+    'vocabbot_update_handler_seconds', 'Duration of the update handlers, by update kind.', ('kind',),
+)
+DB_QUERY_LATENCY = registry.histogram(
+    'vocabbot_db_query_seconds', 'Duration of SQL queries, grouped by statement and table.', ('group',),
+)
+SPAN_LATENCY = registry.histogram(
+    'vocabbot_span_seconds', 'Duration of the pipeline stages (spans), by span path.', ('span',),
+)
+
+
+_spans = threading.local()
+
+
+# Times a stage of a pipeline. Spans nest per thread and are named by their path,
+# e.g. send_vocabulary_batch/deliver/send, which is also the label of their histogram.
+# Every finished span is logged at DEBUG.
+@contextmanager
+def span(name):
+    stack = getattr(_spans, 'stack', None)
+    if stack is None:
+        stack = _spans.stack = []
+    path = f"{stack[-1]}/{name}" if stack else name
+    stack.append(path)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        stack.pop()
+        SPAN_LATENCY.observe(elapsed, span=path)
+        logger.debug("span %s took %.1f ms", path, elapsed * 1000)
+
+
+# Outcome label of a Bot API response
+def telegram_outcome(response):
+    if response is None:
+        return 'network_error'
+    if response.get('ok'):
+        return 'ok'
+    return str(response.get('error_code', 'error'))
+
+
+QUERY_VERB_RE = re.compile(r'^\s*(\w+)', re.IGNORECASE)
+QUERY_TABLE_RE = re.compile(r'\b(?:FROM|INTO|UPDATE|JOIN)\s+["`]?(\w+)', re.IGNORECASE)
+
+
+# Groups a SQL statement by its verb and first table, e.g. "SELECT core_vocabulary".
+# Statements repeat, so the result is cached.
+@lru_cache(maxsize=1024)
+def query_group(sql):
+    verb = QUERY_VERB_RE.match(sql)
+    table = QUERY_TABLE_RE.search(sql)
+    verb = verb.group(1).upper() if verb else 'OTHER'
+    return f"{verb} {table.group(1)}" if table else verb
+
+
+# A database execute wrapper timing every query into DB_QUERY_LATENCY
+def observe_query(execute, sql, params, many, context):
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        DB_QUERY_LATENCY.observe(time.perf_counter() - started, group=query_group(sql))
+
+
+# connection_created receiver installing observe_query on every new connection
+# (see CoreConfig.ready; enabled by METRICS_DB_QUERIES)
+def instrument_connection(sender, connection, **kwargs):
+    if observe_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(observe_query)
+
+
+# Writes the registry to path atomically, in the format node_exporter's textfile
+# collector reads
+def write_metrics_file(path, metrics=registry):
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp', delete=False) as metrics_file:
+        metrics_file.write(metrics.render())
+    os.replace(metrics_file.name, path)
@@ -0,0 +1,25 @@
+# Generated by Django 5.2 on 2026-10-18 12:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_telegramfile'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='uservocabularyprogress',
+            index=models.Index(fields=['user', 'next_review'], name='progress_user_next_review_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vocabulary',
+            index=models.Index(fields=['user', 'date_added'], name='vocab_user_date_added_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vocabularyimage',
+            index=models.Index(condition=models.Q(('flag', False)), fields=['vocabulary'], name='vocabimage_unflagged_idx'),
+        ),
+    ]
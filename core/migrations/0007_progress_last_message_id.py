@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 12:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_review_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uservocabularyprogress',
+            name='last_message_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
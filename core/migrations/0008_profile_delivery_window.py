@@ -0,0 +1,35 @@
+# Generated by Django 5.2 on 2026-10-18 12:38
+
+import core.models
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_progress_last_message_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='delivery_time',
+            field=models.TimeField(default=datetime.time(10, 0)),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='delivery_window_minutes',
+            field=models.PositiveSmallIntegerField(default=60),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='next_delivery_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='timezone',
+            field=models.CharField(default=core.models.default_timezone, max_length=64),
+        ),
+    ]
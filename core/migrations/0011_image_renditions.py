@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-18 12:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_scheduler_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vocabularyimage',
+            name='processed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='vocabularyimage',
+            name='thumbnail',
+            field=models.ImageField(blank=True, upload_to='img/thumbs/'),
+        ),
+    ]
@@ -0,0 +1,60 @@
+import unicodedata
+from django.db import migrations
+
+
+# A frozen copy of core.search.normalize as of this migration, so later changes to
+# core.search don't change what it does ('manage.py rebuild_search_index' re-indexes
+# with the current one)
+PERSIAN_FOLDING = str.maketrans({
+    'ي': 'ی', 'ى': 'ی', 'ك': 'ک', 'ۀ': 'ه', 'ة': 'ه', 'أ': 'ا', 'إ': 'ا', 'ٱ': 'ا',
+    '‌': '', '‍': '', 'ـ': '',
+    **{chr(code): '' for code in range(0x064B, 0x0660)}, 'ٰ': '',
+})
+
+
+def normalize(text):
+    return unicodedata.normalize('NFKC', text or '').casefold().translate(PERSIAN_FOLDING)
+
+
+# Full-text index of the vocabulary (see core.search). SQLite only: other databases
+# search the vocabulary table directly.
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS core_vocabulary_fts USING fts5("
+        "word, meaning, description, "
+        "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+    )
+    Vocabulary = apps.get_model('core', 'Vocabulary')
+    vocabularies = Vocabulary.objects.using(connection.alias).order_by('id').values_list('id', 'word', 'meaning', 'description')
+    last_id = 0
+    with connection.cursor() as cursor:
+        while True:
+            chunk = list(vocabularies.filter(id__gt=last_id)[:2000])
+            if not chunk:
+                break
+            cursor.executemany(
+                "INSERT INTO core_vocabulary_fts (rowid, word, meaning, description) VALUES (%s, %s, %s, %s)",
+                [(vocab_id, normalize(word), normalize(meaning), normalize(description)) for vocab_id, word, meaning, description in chunk],
+            )
+            last_id = chunk[-1][0]
+        cursor.execute("INSERT INTO core_vocabulary_fts (core_vocabulary_fts) VALUES ('optimize')")
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute("DROP TABLE IF EXISTS core_vocabulary_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_image_renditions'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 5.2 on 2026-10-18 13:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+
+# Totals of the existing users from their progress rows, as core.stats.rebuild_stats
+# computes them (there is no daily history yet, so streaks start with the next answer)
+def build_stats(apps, schema_editor):
+    db = schema_editor.connection.alias
+    UserProfile = apps.get_model('core', 'UserProfile')
+    UserStats = apps.get_model('core', 'UserStats')
+    UserVocabularyProgress = apps.get_model('core', 'UserVocabularyProgress')
+    last_id = 0
+    while True:
+        ids = list(UserProfile.objects.using(db).filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:1000])
+        if not ids:
+            break
+        last_id = ids[-1]
+        totals = {
+            row['user_id']: row
+            for row in UserVocabularyProgress.objects.using(db).filter(user_id__in=ids).values('user_id').annotate(
+                knew=Sum('knew_count'), didnt_know=Sum('didnt_know_count'),
+                cards=Count('id', filter=Q(appeared_count__gt=0)),
+            ).order_by()
+        }
+        rows = []
+        for user_id in ids:
+            total = totals.get(user_id, {})
+            knew = total.get('knew') or 0
+            didnt_know = total.get('didnt_know') or 0
+            rows.append(UserStats(
+                user_id=user_id, reviews=knew + didnt_know, knew=knew, didnt_know=didnt_know,
+                cards_reviewed=total.get('cards') or 0,
+            ))
+        UserStats.objects.using(db).bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_vocabulary_import'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reviews', models.PositiveIntegerField(default=0)),
+                ('knew', models.PositiveIntegerField(default=0)),
+                ('didnt_know', models.PositiveIntegerField(default=0)),
+                ('cards_reviewed', models.PositiveIntegerField(default=0)),
+                ('current_streak', models.PositiveIntegerField(default=0)),
+                ('longest_streak', models.PositiveIntegerField(default=0)),
+                ('last_review_date', models.DateField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='core.userprofile')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserStatsDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('reviews', models.PositiveIntegerField(default=0)),
+                ('knew', models.PositiveIntegerField(default=0)),
+                ('didnt_know', models.PositiveIntegerField(default=0)),
+                ('new_cards', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='core.userprofile')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'day'), name='stats_daily_user_day_uniq')],
+            },
+        ),
+        migrations.RunPython(build_stats, migrations.RunPython.noop),
+    ]
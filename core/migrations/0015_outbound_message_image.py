@@ -0,0 +1,36 @@
+# Generated by Django 5.2 on 2026-10-18 13:42
+
+import os
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+# Links the queued flashcards to their images by the stored path (MEDIA_ROOT/<image name>)
+def link_images(apps, schema_editor):
+    OutboundMessage = apps.get_model('core', 'OutboundMessage')
+    VocabularyImage = apps.get_model('core', 'VocabularyImage')
+    db = schema_editor.connection.alias
+    media_root = os.path.join(os.path.abspath(settings.MEDIA_ROOT), '')
+    queued = list(OutboundMessage.objects.using(db).filter(status__in=['pending', 'sending'], photo_path__startswith=media_root))
+    names = {message.photo_path[len(media_root):] for message in queued}
+    images = dict(VocabularyImage.objects.using(db).filter(image__in=names).values_list('image', 'id'))
+    for message in queued:
+        message.image_id = images.get(message.photo_path[len(media_root):])
+    OutboundMessage.objects.using(db).bulk_update([m for m in queued if m.image_id], ['image'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_user_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboundmessage',
+            name='image',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='core.vocabularyimage'),
+        ),
+        migrations.RunPython(link_images, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 13:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_outbound_message_image'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='last_delivery_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 14:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_last_delivery_date'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vocabularyimport',
+            name='progress_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -6,6 +6,13 @@ from django.dispatch import receiver
 import requests
 from datetime import timedelta
 import uuid
+from datetime import time
+from django.conf import settings
+from .delivery_schedule import next_delivery_time
+
+
+def default_timezone():
+    return settings.TIME_ZONE
 
 
 class UserProfile(models.Model):
@@ -13,6 +20,14 @@ class UserProfile(models.Model):
     chat_id = models.BigIntegerField(null = True)
     telegram_verification_token = models.CharField(max_length=64, unique = True, null = True)
     telegram_token_expiry = models.DateTimeField(blank=True, null=True)
+    # Daily delivery window: starts at delivery_time in the user's time zone
+    timezone = models.CharField(max_length=64, default=default_timezone)
+    delivery_time = models.TimeField(default=time(10, 0))
+    delivery_window_minutes = models.PositiveSmallIntegerField(default=60)
+    # Next slot the scheduler sends to this user (UTC); null until first scheduled
+    next_delivery_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    # Local date of the last window the scheduler delivered to this user
+    last_delivery_date = models.DateField(null=True, blank=True)
 
     def __str__(self):
         return f"{self.user.username}"
@@ -29,6 +44,12 @@ class UserProfile(models.Model):
         self.telegram_token_expiry = None
         self.save()
 
+    # Moves next_delivery_at to the first slot after `after` (now by default).
+    # Doesn't save.
+    def schedule_next_delivery(self, after=None):
+        self.next_delivery_at = next_delivery_time(self, after or timezone.now())
+        return self.next_delivery_at
+
     
 
 class Vocabulary(models.Model):
@@ -37,10 +58,24 @@ class Vocabulary(models.Model):
     meaning = models.CharField(max_length = 250)
     description = models.TextField(blank = True)
     date_added = models.DateTimeField(auto_now_add = True)
+
+    class Meta:
+        indexes = [
+            # A user's words by age: new-word selection and the vocabulary pages
+            models.Index(fields=['user', 'date_added'], name='vocab_user_date_added_idx'),
+        ]
     
     def __str__(self):
         return f"{self.word}"
 
+    # The word's first image, or None. Uses the images loaded by
+    # core.pagination.first_image_prefetch if present, otherwise queries.
+    @property
+    def cover_image(self):
+        if hasattr(self, 'first_images'):
+            return self.first_images[0] if self.first_images else None
+        return self.images.order_by('id').first()
+
 
 
 class VocabularyImage(models.Model):
@@ -48,10 +83,27 @@ class VocabularyImage(models.Model):
     image = models.ImageField(upload_to = 'img/')
     caption = models.CharField(max_length=255, blank=True)
     flag = models.BooleanField(default = 0)
+    # Small rendition for the vocabulary pages, and whether core.images has already
+    # downscaled and recompressed `image` (see core.images.process_image)
+    thumbnail = models.ImageField(upload_to='img/thumbs/', blank=True)
+    processed = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            # Only images still to be shown (flag=0) are looked up per vocabulary
+            models.Index(fields=['vocabulary'], condition=models.Q(flag=False), name='vocabimage_unflagged_idx'),
+        ]
 
     def __str__(self):
         return f"Image for {self.vocabulary.word} ({self.id})"
 
+    # URL to show in lists: the thumbnail once it exists, the full image before that
+    @property
+    def display_url(self):
+        if self.thumbnail:
+            return self.thumbnail.url
+        return self.image.url if self.image else ''
+
   
 # This model tracks the user's journey with a specific word
 class UserVocabularyProgress(models.Model):
@@ -66,15 +118,171 @@ class UserVocabularyProgress(models.Model):
     interval = models.IntegerField(default=0) 
     # SM2 ease factor (starts at 2.5)
     ease_factor = models.FloatField(default=2.5) 
+    # Telegram message of the last recorded answer, so repeated clicks count once
+    last_message_id = models.BigIntegerField(null=True, blank=True)
 
     class Meta:
         unique_together = ('user', 'vocabulary')
+        indexes = [
+            # Due cards per user, ordered by next_review
+            models.Index(fields=['user', 'next_review'], name='progress_user_next_review_idx'),
+        ]
 
     def __str__(self):
         return f"Progress for '{self.vocabulary.word}' by {self.user}"
 
 
 
+# Telegram file_id of a photo we already uploaded. Sending the file_id instead of the
+# bytes avoids re-uploading the same image on every review. size and modified_at
+# fingerprint the file on disk; if either changes the photo is uploaded again.
+class TelegramFile(models.Model):
+    path = models.CharField(max_length=500, unique=True)
+    file_id = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    modified_at = models.FloatField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.path} -> {self.file_id}"
+
+
+
+
+# Outbox of Bot API calls to make. Deliveries are written here first (in the same
+# transaction that claims the delivery slot) and sent by core.outbox.drain, so a
+# crash mid-batch doesn't lose them; a message that was in flight during the crash
+# is sent again (at least once, see core.outbox.recover_stale). dedupe_key keeps
+# re-planned messages from being queued twice.
+class OutboundMessage(models.Model):
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    DEAD = 'dead'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (SENDING, 'Sending'), (SENT, 'Sent'), (DEAD, 'Dead')]
+
+    chat_id = models.BigIntegerField()
+    method = models.CharField(max_length=32)
+    payload = models.JSONField()
+    photo_path = models.CharField(max_length=500, blank=True)
+    # The flashcard's image: its file is looked up when the row is claimed, since
+    # core.images may have replaced the file at photo_path by then
+    image = models.ForeignKey(VocabularyImage, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    dedupe_key = models.CharField(max_length=128, unique=True, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    # Token of the drain that claimed the row, and when (to recover rows of crashed drains)
+    claim_token = models.CharField(max_length=32, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Pending rows by due time: what core.outbox.drain claims
+            models.Index(fields=['next_attempt_at', 'id'], condition=models.Q(status='pending'), name='outbox_pending_idx'),
+            # Claimed rows, to find the ones left behind by a crashed drain
+            models.Index(fields=['claimed_at'], condition=models.Q(status='sending'), name='outbox_sending_idx'),
+            models.Index(fields=['status', 'sent_at'], name='outbox_status_sent_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.method} -> {self.chat_id} ({self.status})"
+
+
+
+# A named, expiring lease held by one scheduler process (see core.coordination).
+# Used to elect the single process that polls getUpdates; value carries the
+# holder's state over to the next holder (the poller's getUpdates offset).
+class SchedulerLease(models.Model):
+    name = models.CharField(max_length=64, unique=True)
+    holder = models.CharField(max_length=128)
+    expires_at = models.DateTimeField()
+    acquired_at = models.DateTimeField()
+    value = models.BigIntegerField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.name} held by {self.holder} until {self.expires_at}"
+
+
+
+# A vocabulary file uploaded for import (see core.importers). Runs in the
+# background; the counters are updated after every chunk so the page can show progress.
+class VocabularyImport(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    user = models.ForeignKey(UserProfile, related_name='imports', on_delete=models.CASCADE)
+    file = models.FileField(upload_to='imports/')
+    format = models.CharField(max_length=10)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    rows_read = models.PositiveIntegerField(default=0)
+    created_count = models.PositiveIntegerField(default=0)
+    duplicate_count = models.PositiveIntegerField(default=0)
+    invalid_count = models.PositiveIntegerField(default=0)
+    image_count = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    # Last time the running import reported progress (see core.importers.fail_stale_imports)
+    progress_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Import of {self.file.name} by {self.user} ({self.status})"
+
 
 
+# Running totals of a user's reviews, kept up to date by every answer (see
+# core.stats) so the stats page and the bot's /stats read one row. Can be rebuilt
+# from the progress rows with 'manage.py rebuild_stats'.
+class UserStats(models.Model):
+    user = models.OneToOneField(UserProfile, related_name='stats', on_delete=models.CASCADE)
+    reviews = models.PositiveIntegerField(default=0)
+    knew = models.PositiveIntegerField(default=0)
+    didnt_know = models.PositiveIntegerField(default=0)
+    # Words answered at least once
+    cards_reviewed = models.PositiveIntegerField(default=0)
+    # Consecutive days (in the user's time zone) with at least one answer, up to last_review_date
+    current_streak = models.PositiveIntegerField(default=0)
+    longest_streak = models.PositiveIntegerField(default=0)
+    last_review_date = models.DateField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
+    def __str__(self):
+        return f"Stats of {self.user}"
+
+    # Share of answers that were "I knew it", in percent
+    @property
+    def retention(self):
+        return round(100 * self.knew / self.reviews, 1) if self.reviews else None
+
+    # The streak as of `day`: it is broken once a whole day passed without answers
+    def streak_on(self, day):
+        if self.last_review_date and day - self.last_review_date <= timedelta(days=1):
+            return self.current_streak
+        return 0
+
+
+
+# One user's answers on one day (in their time zone), for the stats history
+class UserStatsDaily(models.Model):
+    user = models.ForeignKey(UserProfile, related_name='daily_stats', on_delete=models.CASCADE)
+    day = models.DateField()
+    reviews = models.PositiveIntegerField(default=0)
+    knew = models.PositiveIntegerField(default=0)
+    didnt_know = models.PositiveIntegerField(default=0)
+    # Words answered for the first time that day
+    new_cards = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'day'], name='stats_daily_user_day_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} on {self.day}: {self.reviews} reviews"
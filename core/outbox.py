@@ -0,0 +1,255 @@
+import random
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+from .delivery import DeliveryJob
+from .models import OutboundMessage, VocabularyImage
+from .telegram_files import file_cache
+from .coordination import shard_filter
+from .metrics import span
+
+
+# Bot API error codes that may succeed later: rate limiting and Telegram-side errors.
+# Other errors (blocked bot, chat not found, bad request) are dead letters right away.
+RETRYABLE_ERROR_CODES = {429, 500, 502, 503, 504}
+
+
+# Writes DeliveryJobs to the outbox in batches. Jobs whose dedupe_key is already
+# queued are skipped, so planning the same delivery twice doesn't send it twice.
+def enqueue(jobs, batch_size=500):
+    queued = 0
+    batch = []
+    for job in jobs:
+        batch.append(OutboundMessage(
+            chat_id=job.chat_id,
+            method=job.method,
+            payload=job.payload,
+            photo_path=job.photo_path or '',
+            image_id=job.image_id,
+            dedupe_key=job.dedupe_key,
+        ))
+        if len(batch) >= batch_size:
+            OutboundMessage.objects.bulk_create(batch, ignore_conflicts=True)
+            queued += len(batch)
+            batch = []
+    if batch:
+        OutboundMessage.objects.bulk_create(batch, ignore_conflicts=True)
+        queued += len(batch)
+    return queued
+
+
+# Claims up to limit pending rows that are due and returns them ordered by chat.
+# With a shard only that shard's chats are claimed, so one chat's messages are
+# always sent by the same process, in order and within its rate limit.
+# On databases with SKIP LOCKED (PostgreSQL) concurrent drains lock disjoint rows.
+# SQLite has no row locks but serializes writes, so the conditional UPDATE only
+# takes rows that are still pending and a drain that lost the race gets fewer rows.
+def claim_batch(limit, now=None, shard=None):
+    now = now or timezone.now()
+    token = uuid.uuid4().hex
+    due = OutboundMessage.objects.filter(status=OutboundMessage.PENDING, next_attempt_at__lte=now)
+    due = shard_filter(due, 'chat_id', shard).order_by('next_attempt_at', 'id')
+    with transaction.atomic():
+        if connection.features.has_select_for_update_skip_locked:
+            due = due.select_for_update(skip_locked=True)
+        ids = list(due.values_list('id', flat=True)[:limit])
+        OutboundMessage.objects.filter(id__in=ids, status=OutboundMessage.PENDING).update(
+            status=OutboundMessage.SENDING, claim_token=token, claimed_at=now,
+        )
+    return list(
+        OutboundMessage.objects.filter(claim_token=token, status=OutboundMessage.SENDING)
+        .select_related('image').order_by('chat_id', 'id')
+    )
+
+
+# Puts rows back to pending whose drain died after claiming them (sending state for
+# longer than OUTBOX_CLAIM_TIMEOUT_SECONDS). A message whose request did reach
+# Telegram before the crash is sent again: delivery is at least once.
+def recover_stale(now=None):
+    now = now or timezone.now()
+    cutoff = now - timedelta(seconds=settings.OUTBOX_CLAIM_TIMEOUT_SECONDS)
+    return OutboundMessage.objects.filter(status=OutboundMessage.SENDING, claimed_at__lt=cutoff).update(
+        status=OutboundMessage.PENDING, claim_token='', claimed_at=None,
+    )
+
+
+# Deletes sent rows sent more than OUTBOX_RETENTION_DAYS ago and dead rows queued
+# that long ago, chunk_size rows per DELETE so the table isn't locked for long.
+# Returns the number of rows deleted.
+def prune(now=None, chunk_size=1000):
+    if settings.OUTBOX_RETENTION_DAYS <= 0:
+        return 0
+    cutoff = (now or timezone.now()) - timedelta(days=settings.OUTBOX_RETENTION_DAYS)
+    expired = (
+        OutboundMessage.objects.filter(status=OutboundMessage.SENT, sent_at__lt=cutoff),
+        OutboundMessage.objects.filter(status=OutboundMessage.DEAD, created_at__lt=cutoff),
+    )
+    deleted = 0
+    for rows in expired:
+        while True:
+            ids = list(rows.values_list('id', flat=True)[:chunk_size])
+            if not ids:
+                break
+            deleted += OutboundMessage.objects.filter(id__in=ids).delete()[0]
+    return deleted
+
+
+# Delay before attempt number attempts + 1: exponential, capped, with jitter so
+# messages that failed together don't come back together. Never shorter than
+# Telegram's retry_after.
+def backoff(attempts, retry_after=None):
+    delay = min(settings.OUTBOX_MAX_BACKOFF_SECONDS, settings.OUTBOX_BACKOFF_SECONDS * 2 ** (attempts - 1))
+    delay *= random.uniform(0.5, 1.0)
+    return timedelta(seconds=max(delay, retry_after or 0))
+
+
+# The images of messages whose photo file was missing but that have a file now:
+# core.images replaced the image's file while the message was being sent
+def _replaced_images(messages, responses):
+    image_ids = [
+        message.image_id for message in messages
+        if message.image_id and (responses.get(message.id) or {}).get('missing_file')
+    ]
+    if not image_ids:
+        return set()
+    return {
+        image.id for image in VocabularyImage.objects.filter(id__in=image_ids)
+        if image.image and image.image.storage.exists(image.image.name)
+    }
+
+
+# Stores the outcome of sending claimed messages. responses maps message id to the
+# Bot API response (None for a network error or a message that wasn't attempted).
+# A missing photo file is a dead letter, unless the image got a new file meanwhile.
+# A 429 is Telegram's flood control, not a failure of the message: it doesn't use up
+# an attempt, and the engine has already held every worker off for retry_after.
+# Retries are scheduled from `now` (the drain's clock) or later.
+# Returns the number of messages sent, rescheduled and dead.
+def record_results(messages, responses, now=None):
+    sent_at = timezone.now()
+    now = max(now or sent_at, sent_at)
+    counts = {'sent': 0, 'retrying': 0, 'dead': 0}
+    replaced = _replaced_images(messages, responses)
+    for message in messages:
+        response = responses.get(message.id)
+        if response is None or response.get('error_code') != 429:
+            message.attempts += 1
+        message.claim_token = ''
+        message.claimed_at = None
+        if response is not None and response.get('ok'):
+            message.status = OutboundMessage.SENT
+            message.sent_at = sent_at
+            message.last_error = ''
+            counts['sent'] += 1
+            continue
+
+        if response is None:
+            message.last_error = 'Network error'
+            retryable = True
+            retry_after = None
+        elif response.get('missing_file'):
+            message.last_error = response.get('description', '')
+            retryable = message.image_id in replaced
+            retry_after = None
+        else:
+            message.last_error = f"{response.get('error_code')} {response.get('description', '')}".strip()
+            retryable = response.get('error_code') in RETRYABLE_ERROR_CODES
+            retry_after = response.get('parameters', {}).get('retry_after')
+
+        if retryable and message.attempts < settings.OUTBOX_MAX_ATTEMPTS:
+            message.status = OutboundMessage.PENDING
+            message.next_attempt_at = now + backoff(max(message.attempts, 1), retry_after)
+            counts['retrying'] += 1
+        else:
+            message.status = OutboundMessage.DEAD
+            counts['dead'] += 1
+
+    OutboundMessage.objects.bulk_update(
+        messages,
+        ['status', 'attempts', 'next_attempt_at', 'claim_token', 'claimed_at', 'last_error', 'sent_at'],
+        batch_size=500,
+    )
+    return counts
+
+
+# The DeliveryJob of a claimed message. A flashcard image is sent from the image's
+# current file, not from photo_path, which may be the upload core.images replaced.
+def message_job(message):
+    photo_path = message.photo_path or None
+    if message.image_id and message.image and message.image.image:
+        photo_path = message.image.image.path
+    return DeliveryJob(
+        message.chat_id, message.method, message.payload,
+        photo_path=photo_path, dedupe_key=message.dedupe_key, outbox_id=message.id, image_id=message.image_id,
+    )
+
+
+# Sends every due outbox row, batch by batch, with a DeliveryEngine made by
+# build_engine(on_result). Results are collected from the engine's threads and
+# written back from this thread once per batch, along with the file_ids learned.
+# Rows rescheduled during the drain are due after `now`, so they wait for a later one.
+# Rows past their retention are pruned first. Each batch's stages are timed as the
+# claim, send and record spans.
+def drain(build_engine, batch_size=None, now=None, shard=None):
+    batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+    now = now or timezone.now()
+    totals = {'pruned': prune(now), 'recovered': recover_stale(now), 'sent': 0, 'retrying': 0, 'dead': 0}
+    responses = {}
+
+    def on_result(job, response):
+        responses[job.outbox_id] = response
+
+    engine = build_engine(on_result)
+    while True:
+        with span('claim'):
+            messages = claim_batch(batch_size, now, shard)
+        if not messages:
+            break
+        responses.clear()
+        jobs = [message_job(message) for message in messages]
+        with span('send'):
+            # Cached file_ids of this batch's photos, in one query
+            file_cache.prefetch(job.photo_path for job in jobs if job.photo_path)
+            engine.run(jobs)
+        with span('record'):
+            for outcome, count in record_results(messages, responses, now).items():
+                totals[outcome] += count
+            file_cache.flush()
+    totals['engine'] = engine.stats.summary()
+    return totals
+
+
+def _percentile(ordered, pct):
+    if not ordered:
+        return 0.0
+    return ordered[max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))]
+
+
+# Queue health: rows per status, the age of the oldest due row, and the delivery
+# latency (queued to sent) of the messages sent within the last `window`
+def outbox_stats(now=None, window=timedelta(hours=24)):
+    now = now or timezone.now()
+    counts = dict(OutboundMessage.objects.values_list('status').annotate(count=Count('id')).order_by())
+    oldest_due = OutboundMessage.objects.filter(
+        status=OutboundMessage.PENDING, next_attempt_at__lte=now,
+    ).aggregate(oldest=Min('created_at'))['oldest']
+    latencies = sorted(
+        (sent_at - created_at).total_seconds()
+        for created_at, sent_at in OutboundMessage.objects.filter(
+            status=OutboundMessage.SENT, sent_at__gte=now - window,
+        ).values_list('created_at', 'sent_at')
+    )
+    return {
+        'pending': counts.get(OutboundMessage.PENDING, 0),
+        'sending': counts.get(OutboundMessage.SENDING, 0),
+        'sent': counts.get(OutboundMessage.SENT, 0),
+        'dead': counts.get(OutboundMessage.DEAD, 0),
+        'oldest_due_seconds': round((now - oldest_due).total_seconds(), 1) if oldest_due else 0.0,
+        'sent_in_window': len(latencies),
+        'latency_p50_seconds': round(_percentile(latencies, 50), 1),
+        'latency_p95_seconds': round(_percentile(latencies, 95), 1),
+        'latency_max_seconds': round(latencies[-1], 1) if latencies else 0.0,
+    }
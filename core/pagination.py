@@ -0,0 +1,56 @@
+import base64
+from datetime import datetime
+from django.db.models import F, Prefetch, Q, Window
+from django.db.models.functions import RowNumber
+from .models import VocabularyImage
+
+
+# One page of a keyset-paginated list. next_cursor is None on the last page.
+class Page:
+
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+# Cursor of the position right after a word: its (date_added, id), URL-safe
+def encode_cursor(vocab):
+    raw = f"{vocab.date_added.isoformat()}|{vocab.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+# Returns (date_added, id), or raises ValueError for a malformed cursor
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        date_added, vocab_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(date_added), int(vocab_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+
+
+# Only the first image (lowest id) of each word, stored in vocab.first_images.
+# The ranking runs in the database, so the prefetch is one query for the page.
+def first_image_prefetch():
+    first_images = VocabularyImage.objects.annotate(position=Window(
+        RowNumber(), partition_by=[F('vocabulary_id')], order_by=F('id').asc(),
+    )).filter(position=1)
+    return Prefetch('images', queryset=first_images, to_attr='first_images')
+
+
+# A page of words, newest first, after the given cursor. Seeks on (date_added, id)
+# instead of using OFFSET, so every page costs the same (it walks the
+# (user, date_added) index) and words added meanwhile don't shift the pages.
+# Costs two queries: the words and their first images.
+def vocab_page(vocabs, cursor=None, page_size=24):
+    vocabs = vocabs.order_by('-date_added', '-id')
+    if cursor:
+        date_added, vocab_id = decode_cursor(cursor)
+        vocabs = vocabs.filter(Q(date_added__lt=date_added) | Q(date_added=date_added, id__lt=vocab_id))
+    items = list(vocabs.prefetch_related(first_image_prefetch())[:page_size + 1])
+    next_cursor = encode_cursor(items[page_size - 1]) if len(items) > page_size else None
+    return Page(items[:page_size], next_cursor)
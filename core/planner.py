@@ -0,0 +1,109 @@
+from django.db.models import Case, F, FilteredRelation, Prefetch, Q, Value, When, Window, prefetch_related_objects
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+import random
+from .models import UserProfile, Vocabulary, VocabularyImage
+
+
+# Buckets of the daily selection, in priority order
+OVERDUE, SOON_DUE, NEW = 0, 1, 2
+
+
+# One user's cards for the day
+class PlannedDelivery:
+
+    def __init__(self, user_id, chat_id, cards):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        # (vocab, image) pairs; image is None when the default image should be sent
+        self.cards = cards
+
+    def __repr__(self):
+        return f"PlannedDelivery(user={self.user_id}, cards={len(self.cards)})"
+
+
+
+# Candidate words of the given users. Every word of a user is put in its bucket
+# (overdue / soon due / new) and ranked inside it with a window function, so only
+# the first num_words of each bucket per user come back from the database.
+def scheduled_candidates(user_ids, num_words, now):
+    return (
+        Vocabulary.objects.filter(user_id__in=user_ids)
+        # The owner's progress row, if the word has been reviewed already
+        .alias(progress=FilteredRelation('user_progress', condition=Q(user_progress__user=F('user'))))
+        .annotate(
+            review_at=F('progress__next_review'),
+            bucket=Case(
+                When(progress__id__isnull=True, then=Value(NEW)),
+                When(progress__next_review__lte=now, then=Value(OVERDUE)),
+                default=Value(SOON_DUE),
+            ),
+        )
+        .annotate(bucket_rank=Window(
+            RowNumber(),
+            partition_by=[F('user_id'), F('bucket')],
+            order_by=[F('review_at').asc(), F('date_added').asc(), F('id').asc()],
+        ))
+        .filter(bucket_rank__lte=num_words)
+    )
+
+
+# Applies the daily mix to one user's ranked candidates: half of the slots go to
+# overdue words, half of the rest to soon-due words and the remainder to new words.
+def select_words(candidates, num_words):
+    buckets = {OVERDUE: [], SOON_DUE: [], NEW: []}
+    for vocab in sorted(candidates, key=lambda v: v.bucket_rank):
+        buckets[vocab.bucket].append(vocab)
+
+    overdue_words = buckets[OVERDUE][:num_words // 2]
+    remaining_slots = num_words - len(overdue_words)
+    soon_due_words = buckets[SOON_DUE][:remaining_slots // 2]
+    new_words = buckets[NEW][:remaining_slots - len(soon_due_words)]
+    words = overdue_words + soon_due_words + new_words
+    random.shuffle(words)
+    return words
+
+
+def images_prefetch():
+    return Prefetch('images', queryset=VocabularyImage.objects.order_by('id'))
+
+
+# Picks the image to send for a word: the first one not yet marked as known (flag=0),
+# otherwise any image with a file. Returns None when the default image should be used.
+# Works on the prefetched images, so it doesn't query the database.
+def choose_flashcard_image(vocab):
+    images = [image for image in vocab.images.all() if image.image]
+    for image in images:
+        if not image.flag:
+            return image
+    return images[0] if images else None
+
+
+# Streams the day's delivery plan for every linked user in users (all profiles by
+# default) as lists of PlannedDelivery. Users are read in keyset-paginated chunks of
+# chunk_size; each chunk costs three queries (users, ranked candidates, images of the
+# chosen words) no matter how many users or words it holds, and only one chunk is
+# held in memory at a time.
+def iter_delivery_plan(num_words, users=None, chunk_size=500, now=None):
+    now = now or timezone.now()
+    users = (users if users is not None else UserProfile.objects.all()).filter(chat_id__isnull=False)
+    last_id = 0
+    while True:
+        chunk = list(users.filter(id__gt=last_id).order_by('id').values_list('id', 'chat_id')[:chunk_size])
+        if not chunk:
+            return
+        last_id = chunk[-1][0]
+
+        by_user = {}
+        for vocab in scheduled_candidates([user_id for user_id, _ in chunk], num_words, now):
+            by_user.setdefault(vocab.user_id, []).append(vocab)
+        selected = {user_id: select_words(candidates, num_words) for user_id, candidates in by_user.items()}
+
+        chosen = [vocab for words in selected.values() for vocab in words]
+        prefetch_related_objects(chosen, images_prefetch())
+
+        yield [
+            PlannedDelivery(user_id, chat_id, [(vocab, choose_flashcard_image(vocab)) for vocab in selected[user_id]])
+            for user_id, chat_id in chunk
+            if selected.get(user_id)
+        ]
@@ -0,0 +1,87 @@
+import logging
+import random
+import time
+from .metrics import UPDATE_LATENCY, UPDATES
+from .tasks import get_updates, handle_callback_query, handle_message
+from .telegram_client import TelegramAPIError
+
+
+logger = logging.getLogger(__name__)
+
+
+# The only update types the bot handles; everything else is filtered out by Telegram
+ALLOWED_UPDATES = ('message', 'callback_query')
+
+
+# Routes one Telegram update to its handler and records its latency and outcome
+# per update kind
+def dispatch_update(update):
+    if 'callback_query' in update:
+        kind, handler = 'callback_query', handle_callback_query
+    elif 'message' in update:
+        kind, handler = 'message', handle_message
+    else:
+        logger.debug("Ignoring update %s of type %s", update.get('update_id'), list(update.keys()))
+        UPDATES.inc(kind='other', outcome='ignored')
+        return
+    logger.debug("Handling %s update %s", kind, update.get('update_id'))
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        handler(update)
+        outcome = 'ok'
+    finally:
+        UPDATE_LATENCY.observe(time.perf_counter() - started, kind=kind)
+        UPDATES.inc(kind=kind, outcome=outcome)
+
+
+
+# Backoff after failed getUpdates calls: doubles per consecutive failure up to the cap
+POLL_BACKOFF_SECONDS = 1
+POLL_MAX_BACKOFF_SECONDS = 60
+
+
+
+# Fetches updates with getUpdates and keeps the offset bookkeeping.
+# timeout is the server-side long-poll timeout in seconds (0 means short polling).
+# A failed call raises TelegramAPIError; failures counts the consecutive ones, for backoff().
+class UpdatePoller:
+
+    def __init__(self, timeout=25, limit=100, allowed_updates=ALLOWED_UPDATES, handler=dispatch_update):
+        self.timeout = timeout
+        self.limit = limit
+        self.allowed_updates = allowed_updates
+        self.handler = handler
+        self.offset = None
+        self.failures = 0
+
+    # Runs one getUpdates call, hands every update to the handler and returns the batch.
+    # The offset moves past an update even if its handler fails, so a broken update
+    # can't be redelivered forever.
+    def poll(self):
+        try:
+            updates = get_updates(
+                offset=self.offset,
+                timeout=self.timeout,
+                limit=self.limit,
+                allowed_updates=self.allowed_updates,
+            )
+        except TelegramAPIError:
+            self.failures += 1
+            raise
+        self.failures = 0
+        for update in updates:
+            try:
+                self.handler(update)
+            except Exception:
+                logger.exception("Handling update %s failed", update.get('update_id'))
+            finally:
+                self.offset = max(self.offset or 0, update['update_id'] + 1)
+        return updates
+
+    # Seconds to wait before polling again after a failure: exponential in the
+    # consecutive failures, with jitter so restarted pollers don't retry in step,
+    # and never shorter than Telegram's retry_after
+    def backoff(self, error):
+        delay = min(POLL_MAX_BACKOFF_SECONDS, POLL_BACKOFF_SECONDS * 2 ** max(self.failures - 1, 0))
+        return max(delay * random.uniform(0.5, 1.0), error.retry_after or 0)
@@ -0,0 +1,233 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter, deque
+from contextlib import ExitStack
+from datetime import datetime, timezone as dt_timezone
+from functools import wraps
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.base import Template
+
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_file_lock = threading.Lock()
+
+# The most recent request profiles of this process (see QUERY_PROFILER_WINDOW)
+recent_profiles = deque(maxlen=settings.QUERY_PROFILER_WINDOW)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+IN_LIST_RE = re.compile(r'IN \((?:%s, )*%s\)')
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+# The shape of a query: Django passes the SQL with %s placeholders, so queries that
+# only differ in their parameters (an N+1 loop) share a signature. IN lists of any
+# length are folded together.
+def query_signature(sql):
+    return IN_LIST_RE.sub('IN (...)', WHITESPACE_RE.sub(' ', sql.strip()))
+
+
+# The queries and timings of one request. It is the execute wrapper of the request's
+# connections; queries run while a template renders are counted as render queries.
+class RequestProfile:
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.render_seconds = 0.0
+        self.render_queries = 0
+        self.rendering = False
+        self.signatures = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_seconds += time.perf_counter() - started
+            self.queries += 1
+            self.signatures[query_signature(sql)] += 1
+            if self.rendering:
+                self.render_queries += 1
+
+    # Extra runs of a query signature already seen in the request
+    @property
+    def duplicates(self):
+        return sum(count - 1 for count in self.signatures.values())
+
+    def record(self, endpoint, method, status, total_seconds):
+        repeated = [[signature, count] for signature, count in self.signatures.most_common(3) if count > 1]
+        return {
+            'at': datetime.now(dt_timezone.utc).isoformat(timespec='seconds'),
+            'endpoint': endpoint,
+            'method': method,
+            'status': status,
+            'queries': self.queries,
+            'duplicates': self.duplicates,
+            'render_queries': self.render_queries,
+            'db_ms': round(self.db_seconds * 1000, 2),
+            'render_ms': round(self.render_seconds * 1000, 2),
+            'total_ms': round(total_seconds * 1000, 2),
+            'repeated': repeated,
+        }
+
+
+# Wraps Template._render (the hook Django's own test instrumentation uses) so the
+# outermost template render of a profiled request is timed; includes and nested
+# renders count towards it
+def _timed_render(render):
+    @wraps(render)
+    def timed(self, context):
+        profile = getattr(_local, 'profile', None)
+        if profile is None or profile.rendering:
+            return render(self, context)
+        profile.rendering = True
+        started = time.perf_counter()
+        try:
+            return render(self, context)
+        finally:
+            profile.render_seconds += time.perf_counter() - started
+            profile.rendering = False
+    timed.query_profiler = True
+    return timed
+
+
+def install_render_timer():
+    if not getattr(Template._render, 'query_profiler', False):
+        Template._render = _timed_render(Template._render)
+
+
+# Appends a profile to path. Once the file reaches max_bytes
+# (QUERY_PROFILER_FILE_MAX_MB by default, 0 for no limit) it is moved to path.1,
+# replacing the previous one, so the profiles take at most twice that on disk.
+def append_profile(path, record, max_bytes=None):
+    if max_bytes is None:
+        max_bytes = settings.QUERY_PROFILER_FILE_MAX_MB * 1024 * 1024
+    with _file_lock:
+        try:
+            if max_bytes and os.path.getsize(path) >= max_bytes:
+                os.replace(path, f"{path}.1")
+        except FileNotFoundError:
+            pass
+        with open(path, 'a', encoding='utf-8') as profile_file:
+            profile_file.write(json.dumps(record) + '\n')
+
+
+# Reads the profiles written to path (and to the rotated path.1 before it),
+# skipping those recorded before `since`
+def read_profiles(path, since=None):
+    cutoff = since.isoformat(timespec='seconds') if since else None
+    for name in (f"{path}.1", path):
+        try:
+            profile_file = open(name, encoding='utf-8')
+        except FileNotFoundError:
+            if name == path:
+                raise
+            continue
+        with profile_file:
+            for line in profile_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if cutoff is None or record.get('at', '') >= cutoff:
+                    yield record
+
+
+# What a request's profile exceeded of the query budgets (a negative budget means
+# no limit)
+def budget_violations(record, max_queries, max_duplicates):
+    violations = []
+    if max_queries >= 0 and record['queries'] > max_queries:
+        violations.append(f"{record['queries']} queries (budget {max_queries})")
+    if max_duplicates >= 0 and record['duplicates'] > max_duplicates:
+        violations.append(f"{record['duplicates']} duplicate queries (budget {max_duplicates})")
+    return violations
+
+
+def _percentile(ordered, pct):
+    if not ordered:
+        return 0
+    return ordered[max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))]
+
+
+# Aggregates request profiles per endpoint, worst first by `sort` (a field of
+# the summaries)
+def summarize(records, sort='queries_p95'):
+    endpoints = {}
+    for record in records:
+        endpoints.setdefault(record['endpoint'], []).append(record)
+    summaries = []
+    for endpoint, samples in endpoints.items():
+        def pct(field, p):
+            return _percentile(sorted(sample[field] for sample in samples), p)
+        repeated = Counter()
+        for sample in samples:
+            for signature, count in sample.get('repeated', []):
+                repeated[signature] = max(repeated[signature], count)
+        summaries.append({
+            'endpoint': endpoint,
+            'requests': len(samples),
+            'queries_p50': pct('queries', 50),
+            'queries_p95': pct('queries', 95),
+            'queries_max': pct('queries', 100),
+            'duplicates_max': pct('duplicates', 100),
+            'render_queries_max': pct('render_queries', 100),
+            'db_ms_p95': pct('db_ms', 95),
+            'render_ms_p95': pct('render_ms', 95),
+            'total_ms_p95': pct('total_ms', 95),
+            'worst_repeated': repeated.most_common(1)[0] if repeated else None,
+        })
+    summaries.sort(key=lambda summary: summary[sort], reverse=True)
+    return summaries
+
+
+# Opt-in (QUERY_PROFILER): records the query count, DB time, repeated query
+# signatures and template render time of every request, keeps the latest in
+# recent_profiles and appends them to QUERY_PROFILER_FILE for the query_report
+# command. Requests over QUERY_PROFILER_MAX_QUERIES / _MAX_DUPLICATES are logged,
+# or raise QueryBudgetExceeded with QUERY_PROFILER_STRICT (for the tests).
+class QueryProfilerMiddleware:
+
+    def __init__(self, get_response):
+        if not settings.QUERY_PROFILER:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        install_render_timer()
+
+    def __call__(self, request):
+        profile = RequestProfile()
+        _local.profile = profile
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(profile))
+                response = self.get_response(request)
+        finally:
+            _local.profile = None
+        match = request.resolver_match
+        endpoint = match.view_name if match else 'unresolved'
+        record = profile.record(endpoint, request.method, response.status_code, time.perf_counter() - started)
+        recent_profiles.append(record)
+        if settings.QUERY_PROFILER_FILE:
+            append_profile(settings.QUERY_PROFILER_FILE, record)
+
+        violations = budget_violations(record, settings.QUERY_PROFILER_MAX_QUERIES, settings.QUERY_PROFILER_MAX_DUPLICATES)
+        if violations:
+            message = f"{request.method} {request.path} ({endpoint}) ran {', '.join(violations)}; most repeated: {record['repeated'][:1]}"
+            if settings.QUERY_PROFILER_STRICT:
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
@@ -0,0 +1,60 @@
+import numpy as np
+
+
+# SM2 constants, shared by the scalar sm2() in core.tasks and the batch version below
+MIN_EASE = 1.3
+FAIL_EASE_PENALTY = 0.8
+# Quality at or above which an answer counts as remembered
+PASS_QUALITY = 3
+FIRST_INTERVAL = 1
+SECOND_INTERVAL = 6
+
+MICROSECONDS_PER_DAY = 86_400_000_000
+# Longest interval sm2_replay gives, so long runs of passed answers stay within the
+# range of a datetime
+MAX_REPLAY_INTERVAL = 36500
+
+
+# Vectorized SM2 step. Takes arrays of current intervals (days), ease factors and
+# answer qualities and returns the new (intervals, ease_factors). Uses the same
+# float64 operations in the same order as the scalar sm2(), and np.rint rounds half
+# to even like Python's round(), so with the default constants the results match it
+# exactly. The constants can be overridden to try out a re-tuned scheduler.
+def sm2_batch(interval, ease_factor, quality, min_ease=MIN_EASE, fail_penalty=FAIL_EASE_PENALTY,
+              first_interval=FIRST_INTERVAL, second_interval=SECOND_INTERVAL, pass_quality=PASS_QUALITY):
+    interval = np.asarray(interval, dtype=np.int64)
+    ease_factor = np.asarray(ease_factor, dtype=np.float64)
+    quality = np.asarray(quality, dtype=np.int64)
+
+    passed = quality >= pass_quality
+    grown = np.rint(interval * ease_factor).astype(np.int64)
+    passed_interval = np.where(interval == 0, first_interval, np.where(interval == 1, second_interval, grown))
+    new_interval = np.where(passed, passed_interval, first_interval)
+
+    missed = 5 - quality
+    passed_ease = ease_factor + (0.1 - missed * (0.08 + missed * 0.02))
+    new_ease = np.where(passed, passed_ease, ease_factor - fail_penalty)
+    new_ease = np.where(new_ease < min_ease, min_ease, new_ease)
+    return new_interval, new_ease
+
+
+# next_review timestamps (as int64 microseconds since the epoch) for reviews made at
+# reviewed_at (same unit) with the given intervals in days
+def next_review_batch(reviewed_at, interval):
+    return np.asarray(reviewed_at, dtype=np.int64) + np.asarray(interval, dtype=np.int64) * MICROSECONDS_PER_DAY
+
+
+# The schedule of cards answered steps[i] times with the given quality, replayed as
+# SM2 steps from a new card (interval 0, ease initial_ease), one vectorized step at a
+# time. Depends only on its inputs, so replaying the same cards again gives the same
+# schedules. Takes the sm2_batch constants as keyword arguments.
+def sm2_replay(steps, quality, initial_ease, max_interval=MAX_REPLAY_INTERVAL, **constants):
+    steps = np.asarray(steps, dtype=np.int64)
+    interval = np.zeros(len(steps), dtype=np.int64)
+    ease_factor = np.full(len(steps), initial_ease, dtype=np.float64)
+    for step in range(int(steps.max()) if len(steps) else 0):
+        active = steps > step
+        new_interval, new_ease = sm2_batch(interval[active], ease_factor[active], np.full(int(active.sum()), quality), **constants)
+        interval[active] = np.minimum(new_interval, max_interval)
+        ease_factor[active] = new_ease
+    return interval, ease_factor
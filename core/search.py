@@ -0,0 +1,154 @@
+import re
+import unicodedata
+from django.db import connection
+from django.db.models import Q
+from .models import Vocabulary
+from .pagination import Page, first_image_prefetch
+
+
+# SQLite FTS5 table holding a normalized copy of each word (created by migration
+# 0012). Its rowid is the vocabulary id.
+FTS_TABLE = 'core_vocabulary_fts'
+
+# bm25 weight of a match in word, meaning and description
+FIELD_WEIGHTS = (10.0, 4.0, 1.0)
+
+# Persian text comes typed with Arabic letters, vowel marks and zero-width
+# non-joiners or without them; they are folded the same way when indexing and searching
+PERSIAN_FOLDING = str.maketrans({
+    'ي': 'ی', 'ى': 'ی', 'ك': 'ک', 'ۀ': 'ه', 'ة': 'ه', 'أ': 'ا', 'إ': 'ا', 'ٱ': 'ا',
+    '‌': '', '‍': '', 'ـ': '',
+    **{chr(code): '' for code in range(0x064B, 0x0660)}, 'ٰ': '',
+})
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def normalize(text):
+    return unicodedata.normalize('NFKC', text or '').casefold().translate(PERSIAN_FOLDING)
+
+
+def fts_available():
+    return connection.vendor == 'sqlite'
+
+
+# An FTS5 query matching every term of the user's text, each as a prefix (so results
+# show up while the last word is still being typed). Terms are quoted, so FTS
+# operators and punctuation in the input are searched as text. Empty if there are no terms.
+def fts_query(text):
+    terms = TOKEN_RE.findall(normalize(text))
+    return ' AND '.join(f'"{term}"*' for term in terms)
+
+
+def _fts_row(vocab):
+    return (vocab.id, normalize(vocab.word), normalize(vocab.meaning), normalize(vocab.description))
+
+
+# Adds or refreshes the index entries of the given words
+def index_vocabularies(vocabs):
+    if not fts_available():
+        return 0
+    rows = [_fts_row(vocab) for vocab in vocabs]
+    if rows:
+        with connection.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [(row[0],) for row in rows])
+            cursor.executemany(
+                f"INSERT INTO {FTS_TABLE} (rowid, word, meaning, description) VALUES (%s, %s, %s, %s)", rows,
+            )
+    return len(rows)
+
+
+def unindex_vocabularies(vocab_ids):
+    if not fts_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [(vocab_id,) for vocab_id in vocab_ids])
+
+
+# Rebuilds the whole index from the vocabulary table (or the given queryset of it),
+# chunk by chunk
+def rebuild_index(vocabularies=None, chunk_size=2000):
+    if not fts_available():
+        return 0
+    if vocabularies is None:
+        vocabularies = Vocabulary.objects.all()
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE}")
+    indexed = 0
+    last_id = 0
+    while True:
+        chunk = list(vocabularies.filter(id__gt=last_id).order_by('id')[:chunk_size])
+        if not chunk:
+            break
+        indexed += index_vocabularies(chunk)
+        last_id = chunk[-1].id
+    with connection.cursor() as cursor:
+        # Merges the segments written chunk by chunk
+        cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+    return indexed
+
+
+# Ids of the user's words matching text, best first, from offset on. The index is
+# shared by all users; matches are narrowed to the user's by primary key lookups.
+def _fts_ids(user_profile, text, offset, limit):
+    query = fts_query(text)
+    if not query:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT fts.rowid FROM {FTS_TABLE} AS fts JOIN core_vocabulary AS vocab ON vocab.id = fts.rowid "
+            f"WHERE {FTS_TABLE} MATCH %s AND vocab.user_id = %s "
+            f"ORDER BY bm25({FTS_TABLE}, {', '.join(map(str, FIELD_WEIGHTS))}), fts.rowid DESC LIMIT %s OFFSET %s",
+            [query, user_profile.id, limit, offset],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+# PostgreSQL: weighted tsvector of the three fields, ranked, with prefix terms
+def _postgres_ids(user_profile, text, offset, limit):
+    from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+    terms = TOKEN_RE.findall(normalize(text))
+    if not terms:
+        return []
+    vector = (
+        SearchVector('word', weight='A', config='simple')
+        + SearchVector('meaning', weight='B', config='simple')
+        + SearchVector('description', weight='C', config='simple')
+    )
+    query = SearchQuery(' & '.join(f"{term}:*" for term in terms), search_type='raw', config='simple')
+    return list(
+        Vocabulary.objects.filter(user=user_profile)
+        .annotate(search=vector, rank=SearchRank(vector, query))
+        .filter(search=query)
+        .order_by('-rank', '-id')
+        .values_list('id', flat=True)[offset:offset + limit]
+    )
+
+
+# Other databases: the old substring match, newest first
+def _substring_ids(user_profile, text, offset, limit):
+    return list(
+        Vocabulary.objects.filter(user=user_profile)
+        .filter(Q(word__icontains=text) | Q(meaning__icontains=text) | Q(description__icontains=text))
+        .order_by('-date_added', '-id')
+        .values_list('id', flat=True)[offset:offset + limit]
+    )
+
+
+# One page (numbered from 1) of the user's words matching text, best match first:
+# hits in the word rank above hits in the meaning, then in the description. The
+# page's next_cursor is the next page number, or None on the last page.
+def search_vocabularies(user_profile, text, page=1, page_size=24):
+    if connection.vendor == 'sqlite':
+        find_ids = _fts_ids
+    elif connection.vendor == 'postgresql':
+        find_ids = _postgres_ids
+    else:
+        find_ids = _substring_ids
+    offset = (page - 1) * page_size
+    ids = find_ids(user_profile, text, offset, page_size + 1)
+    has_next = len(ids) > page_size
+    ids = ids[:page_size]
+    by_id = Vocabulary.objects.filter(id__in=ids).prefetch_related(first_image_prefetch()).in_bulk()
+    items = [by_id[vocab_id] for vocab_id in ids if vocab_id in by_id]
+    return Page(items, str(page + 1) if has_next else None)
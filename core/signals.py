@@ -1,13 +1,24 @@
-from django.db.models.signals import post_save
+import logging
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 from django.contrib.auth.models import User
-from .models import UserProfile, VocabularyImage
+from django.db.models import Exists
+from .models import UserProfile, UserVocabularyProgress, Vocabulary, VocabularyImage
+from .dashboard import invalidate
+from .images import schedule_processing
+from .search import index_vocabularies, unindex_vocabularies
+
+
+logger = logging.getLogger(__name__)
+
 
 # To create a UserProfile automatically when a new User is created
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
-        UserProfile.objects.create(user=instance)
+        profile = UserProfile.objects.create(user=instance)
+        # Fresh cache versions, in case a cache outlived the rows of a reused id
+        invalidate(profile.id)
         
 
 #To save the UserProfile whenever the User is saved
@@ -18,15 +29,80 @@ def save_user_profile(sender, instance, **kwargs):
     except UserProfile.DoesNotExist:
         pass
 
+# Once every image of a vocabulary has been marked as known (flag=1), resets them all
+# to 0 so the rotation starts over. Scoped to the one vocabulary and done in a single
+# conditional UPDATE, so the cost doesn't depend on the size of the image table.
+def reset_image_rotation(vocabulary_id):
+    images = VocabularyImage.objects.filter(vocabulary_id=vocabulary_id)
+    return images.exclude(Exists(images.filter(flag=False))).update(flag=False)
+
+
 # To change the image flag after getting feedback from user
 @receiver(post_save, sender=VocabularyImage)
-def post_save(sender, instance, **kwargs):
-    images_queryset = VocabularyImage.objects.all()
-    if not images_queryset.exists():
+def rotate_image_flags(sender, instance, **kwargs):
+    # An image with flag=0 (this one) still remains, nothing to reset
+    if not instance.flag:
+        return
+    if reset_image_rotation(instance.vocabulary_id):
+        logger.debug("All images of vocabulary %s have flag=1. Setting them to 0.", instance.vocabulary_id)
+
+
+# A new or replaced upload has to be processed again
+@receiver(pre_save, sender=VocabularyImage)
+def mark_new_upload(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and 'image' not in update_fields:
+        return
+    if instance.pk is None:
+        instance.processed = False
         return
+    stored = VocabularyImage.objects.filter(pk=instance.pk).values_list('image', flat=True).first()
+    if stored != instance.image.name:
+        instance.processed = False
+
+
+# Downscales and recompresses uploads off the request thread (see core.images)
+@receiver(post_save, sender=VocabularyImage)
+def process_upload(sender, instance, **kwargs):
+    if instance.image and not instance.processed:
+        schedule_processing(instance.pk)
 
-    if not images_queryset.filter(flag=0).exists():
-        print(f"All images have flag=1. Setting all to 0.")
-        images_queryset.update(flag=0)
+
+# Keeps the full-text index (core.search) in step with the vocabulary. Writes that
+# skip signals (bulk_create, update) must call index_vocabularies themselves.
+@receiver(post_save, sender=Vocabulary)
+def index_vocabulary(sender, instance, **kwargs):
+    index_vocabularies([instance])
+
+
+@receiver(post_delete, sender=Vocabulary)
+def unindex_vocabulary(sender, instance, **kwargs):
+    unindex_vocabularies([instance.pk])
+
+
+# Keeps the dashboard cache (core.dashboard) in step: each write invalidates the
+# fragments of its owner built from that data. Writes that skip signals must call
+# invalidate themselves (flag-only image updates don't need to, no fragment shows it).
+@receiver(post_save, sender=Vocabulary)
+@receiver(post_delete, sender=Vocabulary)
+def invalidate_vocabulary_fragments(sender, instance, **kwargs):
+    invalidate(instance.user_id, 'vocabulary')
+
+
+@receiver(post_save, sender=VocabularyImage)
+@receiver(post_delete, sender=VocabularyImage)
+def invalidate_image_fragments(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and set(update_fields) <= {'flag'}:
+        return
+    if VocabularyImage.vocabulary.is_cached(instance):
+        user_id = instance.vocabulary.user_id
     else:
-        print(f"Not all images have flag=1. No change.")
+        # None if the word is being deleted too; its own signal invalidates
+        user_id = Vocabulary.objects.filter(id=instance.vocabulary_id).values_list('user_id', flat=True).first()
+    if user_id is not None:
+        invalidate(user_id, 'vocabulary')
+
+
+@receiver(post_save, sender=UserVocabularyProgress)
+@receiver(post_delete, sender=UserVocabularyProgress)
+def invalidate_progress_fragments(sender, instance, **kwargs):
+    invalidate(instance.user_id, 'progress')
@@ -0,0 +1,228 @@
+import numpy as np
+from itertools import islice
+from django.utils import timezone
+from .models import UserVocabularyProgress
+from .scheduling import sm2_batch
+
+
+# Answer qualities the simulated users give, like the two Telegram buttons
+KNEW_QUALITY = 4
+DIDNT_KNOW_QUALITY = 1
+
+# Cards sorted into day buckets at a time when a simulation starts
+BUCKET_CHUNK = 5_000_000
+
+
+# Card state of many users as flat arrays (one entry per card). Storage is kept
+# compact (int32/float32) so 100k users x 1k cards fits in memory; values are
+# widened to 64 bits only for the cards being reviewed.
+class CardState:
+
+    def __init__(self, user_index, interval, ease_factor, due_day, users=None):
+        self.user_index = np.asarray(user_index, dtype=np.int32)
+        self.interval = np.asarray(interval, dtype=np.int32)
+        self.ease_factor = np.asarray(ease_factor, dtype=np.float32)
+        # Day the card is due, relative to day 0 of the simulation (negative: overdue)
+        self.due_day = np.asarray(due_day, dtype=np.int32)
+        self.users = users if users is not None else int(self.user_index.max()) + 1 if len(self.user_index) else 0
+
+    def __len__(self):
+        return len(self.user_index)
+
+    def copy(self):
+        return CardState(self.user_index.copy(), self.interval.copy(), self.ease_factor.copy(), self.due_day.copy(), self.users)
+
+    # Loads every UserVocabularyProgress row. Returns the state and the profile id of
+    # each user index. The arrays are allocated once from count() and filled chunk by
+    # chunk, so the rows are never held as Python lists.
+    @classmethod
+    def from_database(cls, now=None, chunk_size=50000):
+        now = now or timezone.now()
+        today = timezone.localtime(now).replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+        rows = UserVocabularyProgress.objects.order_by('user_id').values_list('user_id', 'interval', 'ease_factor', 'next_review')
+        total = rows.count()
+        user_ids = np.empty(total, dtype=np.int64)
+        intervals = np.empty(total, dtype=np.int32)
+        eases = np.empty(total, dtype=np.float32)
+        due_days = np.empty(total, dtype=np.int32)
+        filled = 0
+        rows = rows.iterator(chunk_size=chunk_size)
+        # Rows added after count() are left out; the next run picks them up
+        while filled < total:
+            chunk = list(islice(rows, min(chunk_size, total - filled)))
+            if not chunk:
+                break
+            end = filled + len(chunk)
+            chunk_users, chunk_intervals, chunk_eases, next_reviews = zip(*chunk)
+            user_ids[filled:end] = chunk_users
+            intervals[filled:end] = chunk_intervals
+            eases[filled:end] = chunk_eases
+            seconds = np.fromiter((review.timestamp() for review in next_reviews), dtype=np.float64, count=len(chunk))
+            due_days[filled:end] = np.floor_divide(seconds - today, 86400)
+            filled = end
+        user_ids, intervals, eases, due_days = user_ids[:filled], intervals[:filled], eases[:filled], due_days[:filled]
+        profile_ids, user_index = np.unique(user_ids, return_inverse=True)
+        return cls(user_index, intervals, eases, due_days, users=len(profile_ids)), profile_ids
+
+
+
+# Picks a due day for each card in [target - f, target + f], f = round(interval * fuzz),
+# never before min_day. Days are drawn with weights 1 / (load + 1) from the forecast
+# `load` (cards due per day), so lightly loaded days are favoured and a crowd of cards
+# with the same target is spread over its neighbours instead of moving as one. Cards
+# whose window lies past the end of `load` keep their target. Works through the cards
+# in chunks of chunk_size to bound the memory of the (cards x window) weight matrix.
+def balance_due_days(target, interval, load, fuzz, min_day=1, rng=None, chunk_size=1_000_000):
+    target = np.asarray(target, dtype=np.int64)
+    if fuzz <= 0 or len(target) == 0:
+        return target
+    rng = rng or np.random.default_rng()
+    spread = np.rint(np.asarray(interval) * fuzz).astype(np.int64)
+    chosen = target.copy()
+    # Only cards whose window reaches into the forecast can move
+    movable = np.flatnonzero((spread > 0) & (target - spread < len(load)))
+    for start in range(0, len(movable), chunk_size):
+        index = movable[start:start + chunk_size]
+        chosen[index] = _balance_chunk(target[index], spread[index], load, min_day, rng)
+    return chosen
+
+
+def _balance_chunk(target, spread, load, min_day, rng):
+    max_spread = int(spread.max())
+    offsets = np.arange(-max_spread, max_spread + 1)
+    candidates = target[:, None] + offsets[None, :]
+    allowed = (np.abs(offsets)[None, :] <= spread[:, None]) & (candidates >= min_day) & (candidates < len(load))
+    weights = np.where(allowed, 1.0 / (load[np.clip(candidates, 0, len(load) - 1)] + 1.0), 0.0)
+    totals = weights.sum(axis=1)
+    # No allowed day in the window (all before min_day or past the forecast): keep the target
+    has_choice = totals > 0
+    cumulative = np.cumsum(weights[has_choice], axis=1)
+    draws = rng.random(int(has_choice.sum()))[:, None] * totals[has_choice][:, None]
+    choice = np.minimum((cumulative < draws).sum(axis=1), len(offsets) - 1)
+    chosen = target.copy()
+    chosen[has_choice] = candidates[has_choice][np.arange(len(choice)), choice]
+    return chosen
+
+
+# Returns a boolean mask over due_idx keeping at most cap cards per user, the most
+# overdue first
+def cap_per_user(user_index, due_day, due_idx, cap):
+    order = np.lexsort((due_day[due_idx], user_index[due_idx]))
+    sorted_idx = due_idx[order]
+    users = user_index[sorted_idx]
+    starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]])
+    group_sizes = np.diff(np.r_[starts, len(users)])
+    rank = np.arange(len(users)) - np.repeat(starts, group_sizes)
+    keep = np.zeros(len(due_idx), dtype=bool)
+    keep[order[rank < cap]] = True
+    return keep
+
+
+
+# Result of a simulation run: per-day totals over all users, plus per-user totals
+class Forecast:
+
+    def __init__(self, days, users):
+        self.due = np.zeros(days, dtype=np.int64)
+        self.reviewed = np.zeros(days, dtype=np.int64)
+        self.backlog = np.zeros(days, dtype=np.int64)
+        self.user_due_total = np.zeros(users, dtype=np.int64)
+        self.user_due_peak = np.zeros(users, dtype=np.int64)
+
+    # Per-user daily cap that keeps up with the average arrival of due cards
+    # (so the backlog can't grow without bound), within [minimum, maximum]. Only
+    # meaningful for an uncapped run, where every due card is counted once.
+    def suggested_caps(self, minimum=1, maximum=50):
+        days = len(self.due)
+        caps = np.ceil(self.user_due_total / max(days, 1)).astype(np.int64)
+        return np.clip(caps, minimum, maximum)
+
+    def summary(self):
+        return {
+            'days': len(self.due),
+            'due_per_day': self.due.tolist(),
+            'reviewed_per_day': self.reviewed.tolist(),
+            'backlog_per_day': self.backlog.tolist(),
+            'peak_reviews': int(self.reviewed.max()) if len(self.reviewed) else 0,
+            'mean_reviews': round(float(self.reviewed.mean()), 1) if len(self.reviewed) else 0.0,
+        }
+
+
+
+# Replays the SM2 rules forward day by day. Each simulated day every user reviews up to
+# daily_cap of their due cards (all of them if None), remembering each with probability
+# recall; capped-out cards stay due the next day. With fuzz > 0 the new due days are
+# load-balanced over +-fuzz of the interval.
+#
+# Cards are kept in per-day buckets of indexes, so a day only touches the cards due on
+# it rather than scanning every card; cards due past the forecast are never looked at.
+def simulate(state, days, daily_cap=None, recall=0.85, fuzz=0.0, seed=0):
+    rng = np.random.default_rng(seed)
+    state = state.copy()
+    forecast = Forecast(days, state.users)
+    # Cards due per future day, used to balance new due days (index 0 = overdue/today)
+    horizon = days + 1
+    start_days = np.clip(state.due_day, 0, days)
+    load = np.bincount(start_days, minlength=horizon).astype(np.int64)
+    buckets = [[] for _ in range(horizon)]
+    index_dtype = np.int32 if len(state) < np.iinfo(np.int32).max else np.int64
+    for start in range(0, len(state), BUCKET_CHUNK):
+        stop = min(start + BUCKET_CHUNK, len(state))
+        _add_to_buckets(buckets, np.arange(start, stop, dtype=index_dtype), start_days[start:stop])
+    del start_days
+
+    for day in range(days):
+        due_idx = _take_bucket(buckets, day)
+        forecast.due[day] = len(due_idx)
+        per_user = np.bincount(state.user_index[due_idx], minlength=state.users)
+        forecast.user_due_total += per_user
+        np.maximum(forecast.user_due_peak, per_user, out=forecast.user_due_peak)
+
+        if daily_cap is not None and len(due_idx):
+            keep = cap_per_user(state.user_index, state.due_day, due_idx, daily_cap)
+            carried = due_idx[~keep]
+            due_idx = due_idx[keep]
+            load[day + 1] += len(carried)
+            buckets[day + 1].append(carried)
+        forecast.reviewed[day] = len(due_idx)
+        forecast.backlog[day] = forecast.due[day] - len(due_idx)
+        if not len(due_idx):
+            continue
+
+        remembered = rng.random(len(due_idx)) < recall
+        quality = np.where(remembered, KNEW_QUALITY, DIDNT_KNOW_QUALITY)
+        interval, ease = sm2_batch(state.interval[due_idx], state.ease_factor[due_idx].astype(np.float64), quality)
+
+        target = day + interval
+        new_days = balance_due_days(target, interval, load, fuzz, min_day=day + 1, rng=rng)
+        bucket_days = np.clip(new_days, 0, days)
+        load += np.bincount(bucket_days, minlength=horizon)
+        _add_to_buckets(buckets, due_idx, bucket_days)
+
+        state.interval[due_idx] = interval
+        state.ease_factor[due_idx] = ease
+        state.due_day[due_idx] = np.minimum(new_days, np.iinfo(np.int32).max)
+
+    return forecast, state
+
+
+# Appends each card index to the bucket of its day (the last bucket holds everything
+# due past the forecast and is never read)
+def _add_to_buckets(buckets, index, bucket_days):
+    # A stable sort of 16-bit keys is a radix sort
+    bucket_days = bucket_days.astype(np.int16 if len(buckets) <= np.iinfo(np.int16).max else np.int32)
+    order = np.argsort(bucket_days, kind='stable')
+    index = index[order]
+    bounds = np.searchsorted(bucket_days[order], np.arange(len(buckets) + 1))
+    for day in range(len(buckets) - 1):
+        if bounds[day + 1] > bounds[day]:
+            buckets[day].append(index[bounds[day]:bounds[day + 1]])
+
+
+def _take_bucket(buckets, day):
+    parts = buckets[day]
+    buckets[day] = []
+    if not parts:
+        return np.zeros(0, dtype=np.int32)
+    # Sorted indexes keep the gathers and scatters over the state arrays cache friendly
+    return np.sort(np.concatenate(parts))
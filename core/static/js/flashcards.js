@@ -0,0 +1,26 @@
+// Builds a flashcard link like the ones rendered by the templates, from an item of
+// the JSON endpoints ({word, url, image}).
+function flashcardCard(item) {
+    const link = document.createElement('a');
+    link.href = item.url;
+    link.className = 'flashcard';
+    const content = document.createElement('div');
+    content.className = 'flashcard-content';
+    const inner = document.createElement('div');
+    inner.className = 'd-flex flex-column align-items-center justify-content-center p-3';
+    const word = document.createElement('h3');
+    word.className = 'word-text mb-3';
+    word.textContent = item.word;
+    inner.appendChild(word);
+    if (item.image) {
+        const image = document.createElement('img');
+        image.src = item.image;
+        image.alt = item.word;
+        image.loading = 'lazy';
+        image.className = 'flashcard-image-thumb img-fluid rounded';
+        inner.appendChild(image);
+    }
+    content.appendChild(inner);
+    link.appendChild(content);
+    return link;
+}
@@ -0,0 +1,147 @@
+from collections import defaultdict
+from datetime import timedelta
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, Count, F, Q, Sum, Value, When
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from .dashboard import review_counts
+from .delivery_schedule import profile_zone
+from .models import UserProfile, UserStats, UserStatsDaily, UserVocabularyProgress
+
+
+# The user's current date in their time zone; streaks and daily rows follow it
+def local_day(profile, now=None):
+    return (now or timezone.now()).astimezone(profile_zone(profile)).date()
+
+
+# Applies the F() updates to the row of queryset, creating the row first if it
+# doesn't exist yet (a concurrent creator wins and is updated instead)
+def _increment(queryset, create_kwargs, **updates):
+    if queryset.update(**updates):
+        return
+    try:
+        with transaction.atomic():
+            queryset.model.objects.create(**create_kwargs)
+    except IntegrityError:
+        pass
+    queryset.update(**updates)
+
+
+# Adds one answer to the user's totals and to today's row: two UPDATEs (plus an
+# INSERT for the first answer of the day). The counters are F() expressions and the
+# streak is computed from the stored last_review_date in the same UPDATE, so
+# concurrent answers of one user don't lose each other's updates.
+def record_answer(profile, knew, first_review, now=None):
+    today = local_day(profile, now)
+    streak = Case(
+        When(last_review_date=today, then=F('current_streak')),
+        When(last_review_date=today - timedelta(days=1), then=F('current_streak') + 1),
+        default=Value(1),
+        output_field=models.PositiveIntegerField(),
+    )
+    _increment(
+        UserStats.objects.filter(user=profile), {'user': profile},
+        reviews=F('reviews') + 1,
+        knew=F('knew') + int(knew),
+        didnt_know=F('didnt_know') + int(not knew),
+        cards_reviewed=F('cards_reviewed') + int(first_review),
+        current_streak=streak,
+        longest_streak=Greatest('longest_streak', streak),
+        last_review_date=Value(today),
+        updated_at=Value(timezone.now()),
+    )
+    _increment(
+        UserStatsDaily.objects.filter(user=profile, day=today), {'user': profile, 'day': today},
+        reviews=F('reviews') + 1,
+        knew=F('knew') + int(knew),
+        didnt_know=F('didnt_know') + int(not knew),
+        new_cards=F('new_cards') + int(first_review),
+    )
+
+
+# What the stats page and the bot's /stats show: the totals row, today's row and
+# the cached due counts (core.dashboard), so the cost doesn't grow with the history
+def stats_summary(profile, day=None):
+    day = day or local_day(profile)
+    stats = UserStats.objects.filter(user=profile).first() or UserStats(user=profile)
+    today = UserStatsDaily.objects.filter(user=profile, day=day).first()
+    counts = review_counts(profile, day)
+    return {
+        'reviews': stats.reviews,
+        'knew': stats.knew,
+        'didnt_know': stats.didnt_know,
+        'retention': stats.retention,
+        'cards_reviewed': stats.cards_reviewed,
+        'streak': stats.streak_on(day),
+        'longest_streak': stats.longest_streak,
+        'reviews_today': today.reviews if today else 0,
+        'words': counts['words'],
+        'due_today': counts['due'],
+        'new': counts['new'],
+    }
+
+
+# The user's daily rows of the last `days` days, oldest first, with empty days filled in
+def daily_history(profile, days=30, day=None):
+    day = day or local_day(profile)
+    first = day - timedelta(days=days - 1)
+    rows = {row.day: row for row in UserStatsDaily.objects.filter(user=profile, day__gte=first, day__lte=day)}
+    return [rows.get(first + timedelta(days=n)) or UserStatsDaily(user=profile, day=first + timedelta(days=n)) for n in range(days)]
+
+
+# (current streak, longest streak, last day) of ascending distinct days
+def streaks(days):
+    current = longest = 0
+    previous = None
+    for day in days:
+        current = current + 1 if previous and day - previous == timedelta(days=1) else 1
+        longest = max(longest, current)
+        previous = day
+    return current, longest, previous
+
+
+# Recomputes UserStats from the raw data, chunk_size users at a time: the totals
+# from the progress rows (one GROUP BY per chunk) and the streaks from the daily
+# rows, written with one bulk upsert per chunk. Reviews of deleted words are gone
+# from the progress rows, so they drop out of the totals. Returns the users rebuilt.
+def rebuild_stats(profile_ids=None, chunk_size=1000):
+    profiles = UserProfile.objects.order_by('id')
+    if profile_ids is not None:
+        profiles = profiles.filter(id__in=profile_ids)
+
+    rebuilt = 0
+    last_id = 0
+    while True:
+        ids = list(profiles.filter(id__gt=last_id).values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            return rebuilt
+        last_id = ids[-1]
+        totals = {
+            row['user_id']: row
+            for row in UserVocabularyProgress.objects.filter(user_id__in=ids).values('user_id').annotate(
+                knew=Sum('knew_count'), didnt_know=Sum('didnt_know_count'),
+                cards=Count('id', filter=Q(appeared_count__gt=0)),
+            ).order_by()
+        }
+        days = defaultdict(list)
+        for user_id, day in UserStatsDaily.objects.filter(user_id__in=ids, reviews__gt=0).order_by('user_id', 'day').values_list('user_id', 'day'):
+            days[user_id].append(day)
+
+        rows = []
+        for user_id in ids:
+            total = totals.get(user_id, {})
+            knew = total.get('knew') or 0
+            didnt_know = total.get('didnt_know') or 0
+            current, longest, last_day = streaks(days[user_id])
+            rows.append(UserStats(
+                user_id=user_id, reviews=knew + didnt_know, knew=knew, didnt_know=didnt_know,
+                cards_reviewed=total.get('cards') or 0,
+                current_streak=current, longest_streak=longest, last_review_date=last_day,
+            ))
+        with transaction.atomic():
+            UserStats.objects.bulk_create(
+                rows, update_conflicts=True, unique_fields=['user'],
+                update_fields=['reviews', 'knew', 'didnt_know', 'cards_reviewed', 'current_streak',
+                               'longest_streak', 'last_review_date', 'updated_at'],
+            )
+        rebuilt += len(rows)
@@ -1,38 +1,69 @@
 import json
 import html
-import requests
+import logging
 from .models import Vocabulary, UserVocabularyProgress, UserProfile, VocabularyImage
 from django.utils import timezone
 from datetime import timedelta
 from django.db import transaction
-from decouple import config
-import random
+from django.db.models import prefetch_related_objects
+from django.conf import settings
+from .delivery import DeliveryEngine, DeliveryJob, missing_file_response
+from .telegram_client import TelegramAPIError, get_client
+from .telegram_files import file_cache, photo_file_id
+from . import outbox
+from .coordination import shard_filter
+from .delivery_schedule import delivery_day
+from .metrics import span
+from .stats import record_answer, stats_summary
+from .signals import reset_image_rotation
+from .scheduling import FAIL_EASE_PENALTY, FIRST_INTERVAL, MIN_EASE, PASS_QUALITY, SECOND_INTERVAL
+from .planner import images_prefetch, iter_delivery_plan, scheduled_candidates, select_words
 import os
 import re
 
 
-API_KEY = config('API_KEY')
-api_url = 'https://api.telegram.org'
-#api_url ='https://myworker.hgh5310.workers.dev'
+logger = logging.getLogger(__name__)
 
-# Function to fetche updates from Telegram
-def get_updates(offset=None):
+API_KEY = settings.TELEGRAM_API_KEY
+api_url = settings.TELEGRAM_API_URL
+# Sent when a word has no image of its own
+DEFAULT_IMAGE_PATH = 'media/img/immg.jpg'
+
+# Function to fetche updates from Telegram.
+# With timeout > 0 Telegram holds the request open (long polling) until an update
+# arrives or the timeout expires. limit caps the batch size and allowed_updates
+# restricts the update types Telegram sends us.
+# Raises TelegramAPIError if the call fails, so a conflict (409: a webhook is set or
+# another process is polling), a bad token or an outage doesn't pass for an idle poll.
+def get_updates(offset=None, timeout=0, limit=None, allowed_updates=None):
     payload = {"offset": offset} if offset else {}    
-    result = send_telegram_request("getUpdates", payload)
-    if result is None:
-        return []
-    elif isinstance(result, list):
-        return result
-    else:
-        print(f"getUpdates returned unexpected type: {type(result)}. Content: {result}")
-        return []
+    if timeout:
+        payload["timeout"] = timeout
+    if limit:
+        payload["limit"] = limit
+    if allowed_updates is not None:
+        payload["allowed_updates"] = json.dumps(list(allowed_updates))
+    # The HTTP read timeout must outlast the server-side long-poll timeout
+    read_timeout = timeout + 10 if timeout else None
+    response_data = post_telegram_request("getUpdates", payload, read_timeout=read_timeout)
+    if response_data is None:
+        raise TelegramAPIError("getUpdates")
+    if not response_data.get('ok'):
+        raise TelegramAPIError(
+            "getUpdates", response_data.get('error_code'), response_data.get('description', 'Unknown error'),
+            response_data.get('parameters', {}).get('retry_after'),
+        )
+    result = response_data.get('result')
+    if not isinstance(result, list):
+        raise TelegramAPIError("getUpdates", description=f"unexpected result {result!r}")
+    return result
 
 
 # Function to handle bot's incoming text messages
 def handle_message(update):
     message = update.get('message')
     if not message:
-        print("Update does not contain a message. Skipping.")
+        logger.debug("Update %s does not contain a message. Skipping.", update.get('update_id'))
         return
 
     chat_id = message['chat']['id']
@@ -40,14 +71,10 @@ def handle_message(update):
     text = message.get('text', '').strip()
     username = message['from'].get('username', f"ID:{from_user_id}")
 
-    print(f"\n--- MESSAGE RECEIVED ---")
-    print(f"FROM: @{username} (Telegram ID: {from_user_id})")
-    print(f"CHAT ID: {chat_id}")
-    print(f"TEXT: '{text}'")
+    logger.debug("Message from @%s (Telegram ID %s) in chat %s", username, from_user_id, chat_id)
 
     # If the message is a /start command
     if text == '/start':
-        print(f"Detected /start command from {username}.")
         welcome_message = (
             "<b>Hello! Welcome to the Vocabulary Bot!</b>\n\n"
             "To get started and receive flashcards, please link your account "
@@ -55,18 +82,20 @@ def handle_message(update):
             "Then, send that token to me here."
         )
         send_text_message(chat_id, welcome_message)
-        print(f"Sent welcome message to chat {chat_id}.")
+        logger.debug("Sent the welcome message to chat %s.", chat_id)
+        return
+
+    if text == '/stats':
+        send_stats_message(chat_id)
         return
 
     # To link account using a token, if the message is a valid token
     if re.match(r'^[A-Z0-9]{12}$', text):
-        print(f"Detected potential linking token: '{text}'")
         try:
             user_profile = UserProfile.objects.get(
                 telegram_verification_token=text,
                 telegram_token_expiry__gt=timezone.now()
             )
-            print(f"Token '{text}' matched user {user_profile.user.username}.")
             user_profile.chat_id = chat_id
             user_profile.clear_telegram_token()
             user_profile.save()
@@ -77,13 +106,13 @@ def handle_message(update):
                 "You will start receiving your vocabulary flashcards through this bot soon!"
             )
             send_text_message(chat_id, success_message)
-            print(f"Successfully linked Telegram user {from_user_id} to Django user {user_profile.user.username}.")
+            logger.info("Linked Telegram user %s to user %s.", from_user_id, user_profile.user.username)
         except UserProfile.DoesNotExist:
             send_text_message(chat_id, "That linking token is invalid or expired. Please generate a new one from the website.")
-            print(f"Failed linking attempt: Token '{text}' not found or expired.")
-        except Exception as e:
+            logger.info("Telegram user %s sent an unknown or expired linking token.", from_user_id)
+        except Exception:
             send_text_message(chat_id, f"An error occurred while linking your account. Please try again later.")
-            print(f"ERROR: Error linking account for token '{text}': {e}")
+            logger.exception("Linking the account of Telegram user %s failed", from_user_id)
         return
     # Default message for unlinked users or unknown commands from linked users
     try:
@@ -92,86 +121,195 @@ def handle_message(update):
             f"Hello @{user_profile.user.username}! I'm a vocabulary bot. "
             "I'll send you flashcards automatically. I don't currently support other commands."
         )
-        print(f"User {user_profile.user.username} is linked, sent unrecognized message.")
+        logger.debug("Linked user %s sent an unrecognized message.", user_profile.user.username)
     except UserProfile.DoesNotExist:
         send_text_message(chat_id,
             "I don't recognize this message. To link your account and receive flashcards, "
             "please visit our website and generate a linking token. Then send it here.\n"
             "You can also type /start for instructions."
         )
-        print(f"Unlinked user {from_user_id} sent unrecognized message.")
-    except Exception as e:
+        logger.debug("Unlinked user %s sent an unrecognized message.", from_user_id)
+    except Exception:
         send_text_message(chat_id, f"An internal error occurred. Please try again later")
-        print(f"ERROR: Error processing message from {from_user_id}: {e}")
+        logger.exception("Processing a message from %s failed", from_user_id)
 
 
 
-# Function to send a request to the Telegram Bot API
-def send_telegram_request(method, payload, files_payload = None):
-    url = f"{api_url}/bot{API_KEY}/{method}"
+# Replies to /stats with the user's learning statistics (read from UserStats)
+def send_stats_message(chat_id):
+    user_profile = UserProfile.objects.filter(chat_id=chat_id).select_related('user').first()
+    if user_profile is None:
+        send_text_message(chat_id, "Link your account from the website first to see your statistics.")
+        return
+    stats = stats_summary(user_profile)
+    retention = f"{stats['retention']}%" if stats['retention'] is not None else "-"
+    send_text_message(chat_id,
+        f"<b>Your statistics, @{html.escape(user_profile.user.username)}</b>\n\n"
+        f"Words: {stats['words']} ({stats['new']} not reviewed yet)\n"
+        f"Reviews due today: {stats['due_today']}\n"
+        f"Answers today: {stats['reviews_today']}\n\n"
+        f"Answers: {stats['reviews']} (remembered {retention})\n"
+        f"Remembered: {stats['knew']} | Forgot: {stats['didnt_know']}\n"
+        f"Streak: {stats['streak']} days (longest {stats['longest_streak']})"
+    )
+
+
+
+# Posts a request to the Telegram Bot API and returns the decoded JSON body.
+# Error responses (4xx/429) are returned as-is so callers can inspect error_code
+# and retry_after. Returns None if the request itself failed.
+# All calls go through the shared keep-alive TelegramClient.
+def post_telegram_request(method, payload, files_payload = None, read_timeout = None):
+    return get_client().call(method, payload, files_payload, read_timeout=read_timeout)
+
+
+
+# Descriptions of the 400s Telegram answers when a file_id can't be used (any more)
+REJECTED_FILE_ID_ERRORS = ('wrong file identifier', 'file reference expired', 'wrong remote file identifier')
+
+
+def is_rejected_file_id(response_data):
+    if not response_data or response_data.get('ok') or response_data.get('error_code') != 400:
+        return False
+    description = response_data.get('description', '').lower()
+    return any(error in description for error in REJECTED_FILE_ID_ERRORS)
+
+
+
+# Sends a photo with the given sendPhoto payload and returns the raw response
+# (core.delivery.missing_file_response if the file doesn't exist).
+# A photo Telegram has already seen is sent by its cached file_id; the bytes are only
+# uploaded the first time, after the file changed, or when Telegram rejects the id.
+def post_photo_request(payload, image_path):
+    file_id = file_cache.get(image_path)
+    if file_id:
+        response_data = post_telegram_request("sendPhoto", {**payload, 'photo': file_id})
+        # Only a rejected file_id is worth an upload; other errors (a caption too long,
+        # bad markup, ...) would fail the same way and are the caller's business
+        if not is_rejected_file_id(response_data):
+            return response_data
+        logger.info("Cached file_id for %s was rejected, uploading the file again.", image_path)
+        file_cache.forget(image_path)
+
     try:
-        print(f"send_telegram_request called for method '{method}'")
-        if method == 'sendPhoto':
-            response = requests.post(url, data=payload, files=files_payload)
-        else:
-            response = requests.post(url, data=payload)
+        with open(image_path, 'rb') as image_file:
+            files_payload = {
+                'photo': (os.path.basename(image_path), image_file)
+            }
+            response_data = post_telegram_request("sendPhoto", payload, files_payload)
+    except FileNotFoundError:
+        logger.error("Image file not found: %s", image_path)
+        return missing_file_response(image_path)
+
+    if response_data and response_data.get('ok'):
+        new_file_id = photo_file_id(response_data.get('result'))
+        if new_file_id:
+            file_cache.set(image_path, new_file_id)
+    return response_data
+
 
-        response.raise_for_status()
-        response_data = response.json()
-        if response_data.get('ok'):
-            print(f"Telegram request '{method}' successful! Description: {response_data.get('description', 'OK')}")
-            return response_data.get('result')
-        else:
-            error_code = response_data.get('error_code')
-            error_description = response_data.get('description', 'Unknown error')
-            print(f"ERROR: Telegram request '{method}' FAILED: Code {error_code} - {error_description}")
-            return None
 
-    except requests.exceptions.RequestException as e:
-        print(f"ERROR: Network request '{method}' failed: {e}")
+# Function to send a request to the Telegram Bot API
+def send_telegram_request(method, payload, files_payload = None):
+    response_data = post_telegram_request(method, payload, files_payload)
+    if response_data is None:
         return None
-    except json.JSONDecodeError as e:
-        print(f"ERROR: Failed to decode JSON response for '{method}': {e}")
+    if response_data.get('ok'):
+        return response_data.get('result')
+    else:
+        error_code = response_data.get('error_code')
+        error_description = response_data.get('description', 'Unknown error')
+        logger.warning("Telegram request '%s' failed: %s - %s", method, error_code, error_description)
         return None
 
 
 
-# This function implements the SM2 algorithm to update review intervals and ease factors
+# This function implements the SM2 algorithm to update review intervals and ease factors.
+# core.scheduling.sm2_batch is the vectorized equivalent and must stay in step with it.
 def sm2(progress, quality):
     ease_factor = progress.ease_factor
     interval = progress.interval
-    if quality >= 3:
+    if quality >= PASS_QUALITY:
         # First review
         if interval == 0:  
-            interval = 1
+            interval = FIRST_INTERVAL
         # Second review
         elif interval == 1:  
-            interval = 6
+            interval = SECOND_INTERVAL
         else:
             interval = round(interval * ease_factor)
         ease_factor = ease_factor + (0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
     else:
-        interval = 1
-        ease_factor = ease_factor - 0.8
-    if ease_factor < 1.3:
-        ease_factor = 1.3
+        interval = FIRST_INTERVAL
+        ease_factor = ease_factor - FAIL_EASE_PENALTY
+    if ease_factor < MIN_EASE:
+        ease_factor = MIN_EASE
 
     progress.interval = interval
     progress.ease_factor = ease_factor
-    progress.last_appeared = timezone.now()
-    progress.next_review = timezone.now() + timedelta(days=interval)
+    now = timezone.now()
+    progress.last_appeared = now
+    progress.next_review = now + timedelta(days=interval)
     progress.appeared_count += 1
     return progress
 
 
 
+# Quality numbers of the SM2 algorithm for the two buttons
+# (4: correct response after a hesitation, 1: incorrect response; the correct one remembered)
+REVIEW_ACTIONS = {
+    'knew': (4, "Good job!"),
+    'didnt_know': (1, "It's ok, we'll review it later."),
+}
+
+
+# Applies one review to the user's progress on a word, adds it to the user's stats
+# (core.stats) and updates the shown image's flag.
+# Only the database work runs in the transaction; the progress row is locked with
+# select_for_update so concurrent updates for the same card are serialized.
+# Returns False if this message's answer was already recorded (a double-click or a
+# redelivered update), in which case nothing changes.
+def record_review(user, vocab_id, image_id, action, message_id):
+    quality, _ = REVIEW_ACTIONS[action]
+    with transaction.atomic():
+        progress, created = UserVocabularyProgress.objects.select_for_update().get_or_create(
+            user = user, vocabulary_id = vocab_id
+        )
+        if message_id is not None and progress.last_message_id == message_id:
+            return False
+
+        progress = sm2(progress, quality)
+        if action == 'knew':
+            progress.knew_count += 1
+        else:
+            progress.didnt_know_count += 1
+        progress.last_message_id = message_id
+        progress.save(update_fields=[
+            'interval', 'ease_factor', 'last_appeared', 'next_review',
+            'appeared_count', 'knew_count', 'didnt_know_count', 'last_message_id',
+        ])
+        record_answer(user, action == 'knew', first_review=progress.appeared_count == 1)
+
+        # Second, updates the image flag
+        if image_id:
+            updated = VocabularyImage.objects.filter(id=image_id, vocabulary_id=vocab_id).update(flag=(action == 'knew'))
+            if not updated:
+                logger.warning("VocabularyImage %s not found for vocabulary %s. Cannot update its flag.", image_id, vocab_id)
+            elif action == 'knew':
+                reset_image_rotation(vocab_id)
+        else:
+            logger.debug("No image id for vocabulary %s. Skipping the image flag update.", vocab_id)
+    return True
+
+
+
 def handle_callback_query(update):
     query = update['callback_query']
     message_id = query['message']['message_id']
     chat_id = query['message']['chat']['id']
     callback_data = query['data']
 
-    print(f"Received callback: {callback_data} from Chat ID: {chat_id}")
+    logger.debug("Callback %s from chat %s", callback_data, chat_id)
     try:
         parts = callback_data.split(':')
         action = parts[0]
@@ -182,82 +320,48 @@ def handle_callback_query(update):
             image_id = int(parts[2])
 
         user = UserProfile.objects.get(chat_id = chat_id)
-        vocab = Vocabulary.objects.get(id = vocab_id)
-        # transaction for atomic updates
-        with transaction.atomic():
-            # First, handles UserVocabularyProgress logic
-            try:
-                progress = UserVocabularyProgress.objects.get(user = user, vocabulary = vocab)
-            except UserVocabularyProgress.DoesNotExist:
-                progress = UserVocabularyProgress.objects.create(user = user, vocabulary = vocab)
-
-            if action == 'knew':
-                # quality number of SM2 algorithm (4: correct response after a hesitation) 
-                progress = sm2(progress, 4)
-                progress.knew_count += 1
-                feedback_text = "Good job!"
-            elif action == 'didnt_know':
-                # quality number of SM2 algorithm (1: incorrect response; the correct one remembered)
-                progress = sm2(progress, 1)
-                progress.didnt_know_count += 1
-                feedback_text = "It's ok, we'll review it later."
-            else:
-                feedback_text = "Unknown"
-            progress.save()
+        if not Vocabulary.objects.filter(id = vocab_id).exists():
+            raise Vocabulary.DoesNotExist
 
-            # Second, updates the image flag
-            if image_id: 
-                try:
-                    vocab_image = VocabularyImage.objects.get(id=image_id, vocabulary=vocab)
-                    if action == 'knew':
-                        vocab_image.flag = 1
-                        vocab_image.save()
-                        print(f"Image {vocab_image.id} flag for Vocab '{vocab.word}' set to 1 (Knew It).")
-                    elif action == 'didnt_know':
-                        vocab_image.flag = 0 
-                        vocab_image.save()
-                        print(f"Image {vocab_image.id} flag for Vocab '{vocab.word}' reset to 0 (Didn't Know).")
-               
-                except VocabularyImage.DoesNotExist:
-                    print(f"VocabularyImage with ID {image_id} not found for Vocab {vocab.id}. Cannot update flag.")
-                except Exception as e:
-                    print(f"Error updating image flag for vocab {vocab.id}, image {image_id}: {e}")
+        if action in REVIEW_ACTIONS:
+            if record_review(user, vocab_id, image_id, action, message_id):
+                feedback_text = REVIEW_ACTIONS[action][1]
             else:
-                print(f"No specific image ID provided for Vocab '{vocab.word}'. Skipping image flag update.")
-
-            # Acknowledge the callback query
-            ack_payload = {'callback_query_id': query['id'], 'text': feedback_text, 'show_alert': True}
-            send_telegram_request('answerCallbackQuery', ack_payload)
-            # Edit the original message (remove buttons)
-            edit_payload = {
-                'chat_id': chat_id,
-                'message_id': message_id,
-                'reply_markup': json.dumps({}) # Remove buttons
-            }
-            send_telegram_request('editMessageReplyMarkup', edit_payload)
+                logger.debug("Answer for message %s was already recorded. Skipping.", message_id)
+                feedback_text = "Your answer was already recorded."
+        else:
+            feedback_text = "Unknown"
+
+        # The Telegram calls happen after the commit, so no lock is held during them
+        # Acknowledge the callback query
+        ack_payload = {'callback_query_id': query['id'], 'text': feedback_text, 'show_alert': True}
+        send_telegram_request('answerCallbackQuery', ack_payload)
+        # Edit the original message (remove buttons)
+        edit_payload = {
+            'chat_id': chat_id,
+            'message_id': message_id,
+            'reply_markup': json.dumps({}) # Remove buttons
+        }
+        send_telegram_request('editMessageReplyMarkup', edit_payload)
 
     except UserProfile.DoesNotExist:
-        print(f"User with chat_id {chat_id} not found.")
+        logger.warning("No user with chat_id %s.", chat_id)
         
     except Vocabulary.DoesNotExist:
-        print(f"Vocabulary with ID {vocab_id} not found.")
+        logger.warning("Vocabulary %s not found.", vocab_id)
 
     except (ValueError, IndexError) as e:
-        print(f"Error parsing callback_data '{callback_data}': {e}")
+        logger.warning("Could not parse callback_data %r: %s", callback_data, e)
         
-    except Exception as e:
-        print(f"Unexpected error in handle_callback_query: {type(e).__name__} - {e}")
+    except Exception:
+        logger.exception("Unexpected error in handle_callback_query")
         ack_payload = {'callback_query_id': query['id'], 'text': 'An error occurred', 'show_alert': True}
         send_telegram_request('answerCallbackQuery', ack_payload)
 
 
 
-# Sends a photo with a caption, HTML parse mode, and inline buttons
-def send_photo_with_spoiler(chat_id, vocab_image_path, caption, vocab_id, callback_knew, callback_did_not_know):
-    if not vocab_image_path or not os.path.exists(vocab_image_path):
-        print(f"Error: Image file not found at path: {vocab_image_path}")
-        return None
-
+# Builds the sendPhoto payload for a flashcard: caption in HTML parse mode plus the two feedback buttons
+def build_flashcard_payload(chat_id, caption, callback_knew, callback_did_not_know):
     keyboard = {
         "inline_keyboard": [
             [
@@ -266,25 +370,33 @@ def send_photo_with_spoiler(chat_id, vocab_image_path, caption, vocab_id, callba
             ]
         ]
     }
-    data_payload = {
+    return {
         "chat_id": chat_id,
         "caption": caption,
         "parse_mode": "HTML",
         "reply_markup": json.dumps(keyboard) 
     }
-    try:
-        with open(vocab_image_path, 'rb') as image_file:
-            files_payload = {
-                'photo': (os.path.basename(vocab_image_path), image_file)
-            }
-            response = send_telegram_request("sendPhoto", data_payload, files_payload)
-            return response
 
-    except FileNotFoundError:
-        print(f"Error: Image file not found when trying to open: {vocab_image_path}")
+
+
+# Sends a photo with a caption, HTML parse mode, and inline buttons
+def send_photo_with_spoiler(chat_id, vocab_image_path, caption, vocab_id, callback_knew, callback_did_not_know):
+    if not vocab_image_path or not os.path.exists(vocab_image_path):
+        logger.error("Image file not found: %s", vocab_image_path)
+        return None
+
+    data_payload = build_flashcard_payload(chat_id, caption, callback_knew, callback_did_not_know)
+    try:
+        file_cache.prefetch([vocab_image_path])
+        response_data = post_photo_request(data_payload, vocab_image_path)
+        file_cache.flush()
+        if response_data and response_data.get('ok'):
+            return response_data.get('result')
+        if response_data:
+            logger.warning("Telegram request 'sendPhoto' failed: %s - %s", response_data.get('error_code'), response_data.get('description'))
         return None
-    except Exception as e:
-        print(f"Error in send_photo_with_spoiler (file handling or request): {e}")
+    except Exception:
+        logger.exception("Sending the photo %s failed", vocab_image_path)
         return None
 
 
@@ -301,133 +413,181 @@ def send_text_message(chat_id, text):
 
 # Gets a list of vocabulary words scheduled for review for a given user, 
 # prioritizing those due soonest and including some new words. Uses SM2 algorithm.
+# Costs two queries: the ranked candidates and their images (see core.planner).
 def get_scheduled_words(user, num_words):
-    now = timezone.now()
-    # Get overdue words (highest priority)
-    overdue_progress = UserVocabularyProgress.objects.filter(
-        user=user, next_review__lte=now
-    ).order_by('next_review')[:num_words // 2]
-    overdue_words = [p.vocabulary for p in overdue_progress]
-  
-    remaining_slots = num_words - len(overdue_words)
-    # Fill remaining slots with new or soon-to-be-due words
-    soon_due_progress = UserVocabularyProgress.objects.filter(
-        user=user, next_review__gt=now
-    ).order_by('next_review')[:remaining_slots // 2]
-    soon_due_words = [p.vocabulary for p in soon_due_progress]
-  
-    new_words = remaining_slots - len(soon_due_words)
-    # Get new words (not in UserVocabularyProgress for this user yet)
-    # This query needs to find Vocabulary objects that DON'T have a corresponding UserVocabularyProgress entry yet
-    existing_progress_vocab_ids = UserVocabularyProgress.objects.filter(user=user).values_list('vocabulary_id', flat=True)
-
-    new_words = Vocabulary.objects.filter(user=user).exclude(
-        id__in=existing_progress_vocab_ids
-    ).order_by('date_added')[:new_words]
-    
-    # Combine the words
-    words = list(overdue_words) + list(soon_due_words) + list(new_words)
+    words = select_words(scheduled_candidates([user.id], num_words, timezone.now()), num_words)
+    prefetch_related_objects(words, images_prefetch())
 
     if not words:
-         print(f"No scheduled or new words found for user {user}.")
-
-    random.shuffle(words)
+         logger.debug("No scheduled or new words found for user %s.", user)
     return words
 
 
 
-def send_vocabulary_batch():
-    print("Preparing a vocabulary batch...")
-    users = UserProfile.objects.all()
-    NUM_WORDS_TO_SEND = 5
+# Builds the HTML caption of a flashcard. The image caption (where the word was seen)
+# takes precedence over the vocabulary description.
+def build_flashcard_caption(vocab, image_obj=None):
+    word_escaped = html.escape(vocab.word)
+    meaning_escaped = html.escape(vocab.meaning)
+    if image_obj and image_obj.caption:
+        description_escaped = html.escape(image_obj.caption)
+    else:
+        description_escaped = html.escape(vocab.description)
 
-    if not users.exists():
-        print("No users found in UserProfile model")
-        return
+    return (
+        f"Word: <b>{word_escaped}</b>\n\n"
+        f"Meaning: <tg-spoiler>{meaning_escaped}</tg-spoiler>\n\n"
+        + (f"Description: <tg-spoiler>{description_escaped}</tg-spoiler>" if description_escaped else "")
+    )
 
-    for user in users:
-        print(f"Processing user: {user} (Chat ID: {user.chat_id})")
-        chat_id = user.chat_id
-        if not chat_id or chat_id == None:
-            print(f"{user} is not connected to the telegram bot. There is no chat_id")
-            continue
-        words = get_scheduled_words(user, NUM_WORDS_TO_SEND)
-        if not words:
-            print(f"No words scheduled for review or new words available for user {user}.")
-            continue
-        for vocab in words:
-            image_to_send_obj = None
-            # Try to get the first image that has flag=0
-            first_flag_zero_image = vocab.images.filter(flag=0, image__isnull=False).first()
-            if first_flag_zero_image:
-                image_to_send_obj = first_flag_zero_image
-                print(f"Found image with flag=0 for '{vocab.word}'.")
-            else:
-                # If no image with flag=0, try to get any image that has a file
-                any_available_image = vocab.images.filter(image__isnull=False).first()
-                if any_available_image:
-                    image_to_send_obj = any_available_image
-                    print(f"No flag=0 image found for '{vocab.word}'. Falling back to first available image.")
-                else:
-                    print(f"No suitable image found for '{vocab.word}'. Sending default image.")
-
-            vocab_id = vocab.id
-            # Using 'none' as a string if no image is sent, so callback data format is consistent
-            image_id_for_callback = str(image_to_send_obj.id) if image_to_send_obj else 'none'
-            # Construct callback data strings for buttons
-            callback_knew = f"knew:{vocab_id}:{image_id_for_callback}"
-            callback_did_not_know = f"didnt_know:{vocab_id}:{image_id_for_callback}"
-
-            if image_to_send_obj:
-                try:
-                    image_path = image_to_send_obj.image.path
-                    word_escaped = html.escape(vocab.word)
-                    meaning_escaped = html.escape(vocab.meaning)
-
-                    if image_to_send_obj.caption:
-                        description_escaped = html.escape(image_to_send_obj.caption)
-                    elif vocab.description:
-                        description_escaped = html.escape(vocab.description)
-                    else:
-                        description_escaped = html.escape('')
-
-                    caption = (
-                        f"Word: <b>{word_escaped}</b>\n\n"
-                        f"Meaning: <tg-spoiler>{meaning_escaped}</tg-spoiler>\n\n"
-                        + (f"Description: <tg-spoiler>{description_escaped}</tg-spoiler>" if description_escaped else "")
-                    )
-
-                    print(f"Sending Vocab: {vocab.word} (ID: {vocab.id}) with image from path: {image_path}. Callback knew: {callback_knew}")
-               
-                    send_photo_with_spoiler(chat_id, image_path, caption, vocab_id, callback_knew, callback_did_not_know)
-
-                except AttributeError as e:
-                    print(f"Error accessing image path or other attributes for '{vocab.word}': {e}. Check if vocab object is correct.")
-                except Exception as e:
-                    print(f"Error sending flashcard for '{vocab.word}': {type(e).__name__} - {e}")
 
-            else:
-                #sending the vocab with the default image
-                print(f"No image for '{vocab.word}'. Sending the default image. Callback knew: {callback_knew}")
-                image_path = 'media/img/immg.jpg'
-                word_escaped = html.escape(vocab.word)
-                meaning_escaped = html.escape(vocab.meaning)
-                description_escaped = html.escape(vocab.description)
 
-                caption = (
-                        f"Word: <b>{word_escaped}</b>\n\n"
-                        f"Meaning: <tg-spoiler>{meaning_escaped}</tg-spoiler>\n\n"
-                        + (f"Description: <tg-spoiler>{description_escaped}</tg-spoiler>" if vocab.description else "")
-                    )
-                send_photo_with_spoiler(chat_id, image_path, caption, vocab_id, callback_knew, callback_did_not_know)
+# Builds the DeliveryJob that sends one flashcard to a chat
+def build_flashcard_job(chat_id, vocab, image_obj=None, dedupe_key=None):
+    # Using 'none' as a string if no image is sent, so callback data format is consistent
+    image_id_for_callback = str(image_obj.id) if image_obj else 'none'
+    callback_knew = f"knew:{vocab.id}:{image_id_for_callback}"
+    callback_did_not_know = f"didnt_know:{vocab.id}:{image_id_for_callback}"
 
-    print("Vocabulary batch processing finished.")
+    image_path = image_obj.image.path if image_obj else DEFAULT_IMAGE_PATH
+    caption = build_flashcard_caption(vocab, image_obj)
+    payload = build_flashcard_payload(chat_id, caption, callback_knew, callback_did_not_know)
+    return DeliveryJob(
+        chat_id, 'sendPhoto', payload, photo_path=image_path, dedupe_key=dedupe_key,
+        image_id=image_obj.id if image_obj else None,
+    )
 
 
 
+# Performs the Bot API call of a DeliveryJob and returns the raw response
+def send_delivery_job(job):
+    if job.photo_path:
+        return post_photo_request(job.payload, job.photo_path)
+    return post_telegram_request(job.method, job.payload)
 
 
 
+# Yields the flashcard jobs of the day's delivery plan, grouped by chat. With a
+# batch_key each job gets a dedupe key, so the outbox queues a card once per batch.
+def iter_flashcard_jobs(users, num_words, batch_key=None):
+    for chunk in iter_delivery_plan(num_words, users=users):
+        for delivery in chunk:
+            for vocab, image in delivery.cards:
+                dedupe_key = f"flashcard:{delivery.user_id}:{vocab.id}:{batch_key}" if batch_key else None
+                try:
+                    yield build_flashcard_job(delivery.chat_id, vocab, image, dedupe_key=dedupe_key)
+                except Exception:
+                    logger.exception("Preparing the flashcard of vocabulary %s failed", vocab.id)
 
 
 
+# Creates a DeliveryEngine configured from the TELEGRAM_* delivery settings. With
+# shard_count processes sending at once, each gets its share of the global rate
+# limit, which Telegram applies per bot. The engine makes a single attempt per
+# message: failures go back to the outbox, which owns the retries (backoff,
+# OUTBOX_MAX_ATTEMPTS), so a message isn't re-sent on top of them.
+def build_delivery_engine(on_result=None, shard_count=1):
+    return DeliveryEngine(
+        send_delivery_job,
+        workers=settings.DELIVERY_WORKERS,
+        global_rate=settings.TELEGRAM_GLOBAL_RATE / shard_count,
+        chat_rate=settings.TELEGRAM_CHAT_RATE,
+        max_retries=0,
+        on_result=on_result,
+    )
+
+
+
+NUM_WORDS_TO_SEND = 5
+
+
+# Sends everything due in the outbox (the shard's chats only, if shard is given)
+def deliver_outbox(shard=None):
+    shard_count = shard[1] if shard else 1
+    with span('deliver'):
+        totals = outbox.drain(lambda on_result: build_delivery_engine(on_result, shard_count), shard=shard)
+    if totals['sent'] or totals['retrying'] or totals['dead']:
+        logger.info("Outbox drained: %s", totals)
+    return totals
+
+
+# Sends to every user at once, ignoring delivery windows (manual runs). The cards
+# are queued in the outbox first; running it again the same day only sends what
+# wasn't queued yet. Its stages are timed as the send_vocabulary_batch spans.
+@span('send_vocabulary_batch')
+def send_vocabulary_batch():
+    users = UserProfile.objects.all()
+    batch_key = f"batch-{timezone.localdate()}"
+    # Planning is lazy, so this span covers building the cards and writing them
+    with span('enqueue'):
+        queued = outbox.enqueue(iter_flashcard_jobs(users, NUM_WORDS_TO_SEND, batch_key=batch_key))
+    logger.info("Queued %s flashcards.", queued)
+    totals = deliver_outbox()
+    logger.info("Vocabulary batch finished. Stats: %s", totals['engine'])
+    return totals
+
+
+
+# Gives linked users that have no delivery slot yet (new links, or profiles from
+# before delivery windows) their next slot
+def schedule_new_profiles(now, shard=None):
+    profiles = list(shard_filter(UserProfile.objects.filter(chat_id__isnull=False, next_delivery_at__isnull=True), 'id', shard))
+    for profile in profiles:
+        profile.schedule_next_delivery(now)
+    UserProfile.objects.bulk_update(profiles, ['next_delivery_at'], batch_size=500)
+    return len(profiles)
+
+
+# Claims the slots that are due (next_delivery_at <= now), oldest first, up to
+# slice_size of them, by moving each to the user's next slot after now. The move is
+# conditional on the slot being unchanged, so a slot is only ever claimed once.
+# Returns the number of due slots read and the ids of the users to send to now:
+# slots missed by more than DELIVERY_MAX_LATENESS_MINUTES are moved on without sending.
+def claim_due_deliveries(now, slice_size, shard=None):
+    max_lateness = timedelta(minutes=settings.DELIVERY_MAX_LATENESS_MINUTES)
+    due = UserProfile.objects.filter(chat_id__isnull=False, next_delivery_at__lte=now)
+    due = list(shard_filter(due, 'id', shard).order_by('next_delivery_at')[:slice_size])
+    user_ids = []
+    for profile in due:
+        slot = profile.next_delivery_at
+        on_time = now - slot <= max_lateness
+        if on_time:
+            profile.last_delivery_date = delivery_day(profile, slot)
+        claimed = UserProfile.objects.filter(id=profile.id, next_delivery_at=slot).update(
+            next_delivery_at=profile.schedule_next_delivery(now),
+            last_delivery_date=profile.last_delivery_date,
+        )
+        if claimed and on_time:
+            user_ids.append(profile.id)
+        elif claimed:
+            logger.info("Skipping the missed delivery of user %s due at %s.", profile.id, slot)
+    return len(due), user_ids
+
+
+# One scheduler tick: queues the cards of every user whose delivery slot has come,
+# then drains the outbox (which also retries earlier failures). Due users are read
+# from the next_delivery_at index in slices, so each tick only touches the users
+# due now. A slice's slots are claimed and its cards queued in one transaction, so
+# a crash can't lose a claimed slot or queue a slot twice. After a restart the
+# first tick catches up the slots missed while the scheduler was down, once per user.
+# With shard=(index, count) only users with id % count == index are handled, so
+# count processes can share the work (see core.coordination).
+@span('deliver_due_profiles')
+def deliver_due_profiles(now=None, slice_size=None, num_words=NUM_WORDS_TO_SEND, shard=None):
+    now = now or timezone.now()
+    slice_size = slice_size or settings.DELIVERY_SLICE_SIZE
+    schedule_new_profiles(now, shard)
+    delivered = 0
+    while True:
+        with span('enqueue'), transaction.atomic():
+            seen, user_ids = claim_due_deliveries(now, slice_size, shard)
+            if user_ids:
+                batch_key = f"slot-{now:%Y%m%d%H%M}"
+                outbox.enqueue(iter_flashcard_jobs(UserProfile.objects.filter(id__in=user_ids), num_words, batch_key=batch_key))
+                delivered += len(user_ids)
+        if seen < slice_size:
+            break
+    if delivered:
+        logger.info("Queued the cards of %s users.", delivered)
+    deliver_outbox(shard)
+    return delivered
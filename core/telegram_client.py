@@ -0,0 +1,205 @@
+import asyncio
+import importlib.util
+import logging
+import random
+import threading
+import time
+import httpx
+from django.conf import settings
+from .metrics import TELEGRAM_LATENCY, TELEGRAM_REQUESTS, telegram_outcome
+
+
+logger = logging.getLogger(__name__)
+
+
+# Status codes of a Telegram-side hiccup. 429 is not retried here, the caller decides
+# how to honour retry_after.
+RETRY_STATUS_CODES = {500, 502, 503, 504}
+
+# Errors raised before the request left this process, so it can be retried safely
+# whatever the method
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+# Methods that only read. sendMessage, sendPhoto, answerCallbackQuery etc. are not
+# idempotent: after a read timeout or a 5xx Telegram may have acted on the request
+# already, so only these are retried in that case.
+IDEMPOTENT_METHODS = {'getUpdates', 'getMe', 'getFile', 'getChat', 'getWebhookInfo'}
+
+
+# A Bot API call that failed: error_code and description come from Telegram's error
+# response, or are None if the request itself failed (network error)
+class TelegramAPIError(Exception):
+
+    def __init__(self, method, error_code=None, description=None, retry_after=None):
+        self.method = method
+        self.error_code = error_code
+        self.description = description
+        self.retry_after = retry_after
+        super().__init__(f"{method} failed: {error_code or 'network error'} - {description or 'no response'}")
+
+
+# A reusable Telegram Bot API client. It keeps one keep-alive connection pool for
+# synchronous calls (shared by the poller and the delivery threads) and one for async
+# calls, with connect/read timeouts and jittered retries (see should_retry).
+class TelegramClient:
+
+    def __init__(self, token, base_url='https://api.telegram.org', pool_size=32,
+                 connect_timeout=5.0, read_timeout=30.0, retries=2, backoff=0.5, http2=None):
+        self.token = token
+        self.base_url = base_url.rstrip('/')
+        self.retries = retries
+        self.backoff = backoff
+        # HTTP/2 needs the optional h2 package
+        if http2 is None:
+            http2 = importlib.util.find_spec('h2') is not None
+        self.http2 = http2
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self._client = None
+        self._async_client = None
+        self._lock = threading.Lock()
+
+    def method_url(self, method):
+        return f"{self.base_url}/bot{self.token}/{method}"
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = httpx.Client(limits=self.limits, timeout=self.timeout, http2=self.http2)
+        return self._client
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout, http2=self.http2)
+        return self._async_client
+
+    # Whether a failed attempt may be repeated: always if the request was never sent,
+    # otherwise (a timeout or error after sending, or a 5xx) only for read-only methods
+    @staticmethod
+    def should_retry(method, error=None, status_code=None):
+        if isinstance(error, UNSENT_ERRORS):
+            return True
+        if error is None and status_code not in RETRY_STATUS_CODES:
+            return False
+        return method in IDEMPOTENT_METHODS
+
+    # Full-jitter exponential backoff
+    def _retry_delay(self, attempt):
+        return random.uniform(0, self.backoff * (2 ** attempt))
+
+    def _request_timeout(self, read_timeout):
+        if read_timeout is None:
+            return self.timeout
+        return httpx.Timeout(read_timeout, connect=self.timeout.connect)
+
+    @staticmethod
+    def _rewind(files):
+        for value in (files or {}).values():
+            file_obj = value[1] if isinstance(value, tuple) else value
+            if hasattr(file_obj, 'seek'):
+                file_obj.seek(0)
+
+    @staticmethod
+    def _decode(method, response):
+        try:
+            return response.json()
+        except ValueError as e:
+            logger.error("Failed to decode the JSON response of '%s': %s", method, e)
+            return None
+
+    # Records a finished call in the per-method metrics
+    @staticmethod
+    def _observe(method, started, response):
+        TELEGRAM_LATENCY.observe(time.perf_counter() - started, method=method)
+        TELEGRAM_REQUESTS.inc(method=method, outcome=telegram_outcome(response))
+        return response
+
+    # Calls a Bot API method and returns the decoded JSON body (including error bodies),
+    # or None if the request could not be completed. read_timeout overrides the default
+    # read timeout, e.g. for long polling.
+    def call(self, method, payload=None, files=None, read_timeout=None):
+        started = time.perf_counter()
+        return self._observe(method, started, self._call(method, payload, files, read_timeout))
+
+    def _call(self, method, payload, files, read_timeout):
+        timeout = self._request_timeout(read_timeout)
+        for attempt in range(self.retries + 1):
+            try:
+                self._rewind(files)
+                response = self.client.post(self.method_url(method), data=payload, files=files, timeout=timeout)
+                if attempt < self.retries and self.should_retry(method, status_code=response.status_code):
+                    time.sleep(self._retry_delay(attempt))
+                    continue
+                return self._decode(method, response)
+            except httpx.HTTPError as e:
+                if attempt < self.retries and self.should_retry(method, error=e):
+                    time.sleep(self._retry_delay(attempt))
+                    continue
+                logger.error("Network request '%s' failed: %s", method, e)
+                return None
+
+    # Async counterpart of call()
+    async def acall(self, method, payload=None, files=None, read_timeout=None):
+        started = time.perf_counter()
+        return self._observe(method, started, await self._acall(method, payload, files, read_timeout))
+
+    async def _acall(self, method, payload, files, read_timeout):
+        timeout = self._request_timeout(read_timeout)
+        for attempt in range(self.retries + 1):
+            try:
+                self._rewind(files)
+                response = await self.async_client.post(self.method_url(method), data=payload, files=files, timeout=timeout)
+                if attempt < self.retries and self.should_retry(method, status_code=response.status_code):
+                    await asyncio.sleep(self._retry_delay(attempt))
+                    continue
+                return self._decode(method, response)
+            except httpx.HTTPError as e:
+                if attempt < self.retries and self.should_retry(method, error=e):
+                    await asyncio.sleep(self._retry_delay(attempt))
+                    continue
+                logger.error("Network request '%s' failed: %s", method, e)
+                return None
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+# Returns the process-wide TelegramClient configured from the TELEGRAM_* settings
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = TelegramClient(
+                    settings.TELEGRAM_API_KEY,
+                    base_url=settings.TELEGRAM_API_URL,
+                    pool_size=settings.TELEGRAM_POOL_SIZE,
+                    connect_timeout=settings.TELEGRAM_CONNECT_TIMEOUT,
+                    read_timeout=settings.TELEGRAM_READ_TIMEOUT,
+                    retries=settings.TELEGRAM_RETRIES,
+                )
+    return _client
+
+
+# Closes the shared client; the next get_client() call builds a fresh one from settings
+def reset_client():
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = None
@@ -0,0 +1,103 @@
+import os
+import threading
+from .models import TelegramFile
+
+
+# Size and modification time of a file, or None if it doesn't exist
+def file_fingerprint(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime
+
+
+
+# In-memory view of the TelegramFile table. Lookups and new ids are thread-safe and
+# never touch the database, so delivery threads can use it freely; prefetch() and
+# flush() do the database work in batches from the calling thread.
+class TelegramFileCache:
+
+    def __init__(self):
+        self.entries = {}
+        self.dirty = set()
+        self.removed = set()
+        self.loaded = set()
+        self.lock = threading.Lock()
+
+    # Loads the cached ids of the given files with one query
+    def prefetch(self, paths):
+        with self.lock:
+            missing = {os.path.abspath(p) for p in paths if p} - self.loaded
+        if not missing:
+            return
+        rows = TelegramFile.objects.filter(path__in=missing)
+        with self.lock:
+            for row in rows:
+                if row.path not in self.dirty and row.path not in self.removed:
+                    self.entries[row.path] = (row.file_id, (row.size, row.modified_at))
+            self.loaded |= missing
+
+    # Returns the file_id for the file if it was uploaded and hasn't changed since
+    def get(self, path):
+        path = os.path.abspath(path)
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry is None:
+            return None
+        file_id, fingerprint = entry
+        if file_fingerprint(path) != fingerprint:
+            self.forget(path)
+            return None
+        return file_id
+
+    def set(self, path, file_id):
+        path = os.path.abspath(path)
+        fingerprint = file_fingerprint(path)
+        if fingerprint is None:
+            return
+        with self.lock:
+            self.entries[path] = (file_id, fingerprint)
+            self.dirty.add(path)
+            self.removed.discard(path)
+            self.loaded.add(path)
+
+    # Drops an id Telegram rejected or that belongs to an outdated file
+    def forget(self, path):
+        path = os.path.abspath(path)
+        with self.lock:
+            self.entries.pop(path, None)
+            self.dirty.discard(path)
+            self.removed.add(path)
+
+    # Persists new and dropped ids
+    def flush(self):
+        with self.lock:
+            dirty = {path: self.entries[path] for path in self.dirty if path in self.entries}
+            removed = set(self.removed)
+            self.dirty.clear()
+            self.removed.clear()
+        if removed:
+            TelegramFile.objects.filter(path__in=removed).delete()
+        if dirty:
+            TelegramFile.objects.bulk_create(
+                [
+                    TelegramFile(path=path, file_id=file_id, size=fingerprint[0], modified_at=fingerprint[1])
+                    for path, (file_id, fingerprint) in dirty.items()
+                ],
+                update_conflicts=True,
+                unique_fields=['path'],
+                update_fields=['file_id', 'size', 'modified_at', 'updated_at'],
+            )
+
+
+
+# The largest rendition's file_id from a sendPhoto result
+def photo_file_id(message):
+    photos = (message or {}).get('photo') or []
+    if not photos:
+        return None
+    return photos[-1].get('file_id')
+
+
+file_cache = TelegramFileCache()
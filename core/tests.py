@@ -1,3 +1,1705 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import queue
+import tempfile
+import random
+import shutil
+import sqlite3
+import threading
+import time
+import zipfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from datetime import date, datetime, time as dt_time, timedelta, timezone as dt_timezone
+import httpx
+import numpy as np
+import schedule
+from zoneinfo import ZoneInfo
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase, override_settings
+from PIL import Image
+from django.utils import timezone
+from django.urls import reverse
+from .benchmarks.harness import count_queries, latency_summary
+from .dispatch import UpdateDispatcher
+from .fake_telegram import FakeTelegramServer
+from .polling import UpdatePoller, dispatch_update
+from .telegram_client import TelegramAPIError, TelegramClient, reset_client
+from .telegram_files import TelegramFileCache
+from .models import (
+    OutboundMessage, SchedulerLease, TelegramFile, UserStats, UserStatsDaily, UserVocabularyProgress, Vocabulary,
+    VocabularyImage, VocabularyImport,
+)
+from . import outbox
+from . import tasks
+from .planner import choose_flashcard_image, iter_delivery_plan
+from .signals import reset_image_rotation
+from .scheduling import MAX_REPLAY_INTERVAL, sm2_batch, sm2_replay
+from .delivery import DeliveryEngine, DeliveryJob, TokenBucket, missing_file_response
+from .coordination import POLLER_LEASE, acquire_lease, release_lease
+from .delivery_schedule import delivery_offset, next_delivery_time
+from .images import process_image
+from .importers import ImportRecord, fail_stale_imports, import_records, parse_file
+from . import metrics
+from .dashboard import DASHBOARD_CACHE, cached_fragment, get_cache, invalidate_all
+from .stats import local_day, rebuild_stats, record_answer
+from .profiling import QueryBudgetExceeded, RequestProfile, append_profile, read_profiles, recent_profiles
+from .pagination import vocab_page
+from .search import search_vocabularies
+from .simulation import CardState, balance_due_days, simulate
+from .forms import DeliveryPreferencesForm
+from .management.commands import run_scheduler
 
-# Create your tests here.
+
+# Runs each test against a local FakeTelegramServer instead of api.telegram.org
+class FakeTelegramTestCase(TestCase):
+
+    def setUp(self):
+        self.telegram = FakeTelegramServer().start()
+        self.addCleanup(self.telegram.stop)
+        settings_override = override_settings(TELEGRAM_API_URL=self.telegram.url, TELEGRAM_RETRIES=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        reset_client()
+        self.addCleanup(reset_client)
+
+
+
+class TelegramClientTests(TestCase):
+
+    def setUp(self):
+        self.telegram = FakeTelegramServer().start()
+        self.addCleanup(self.telegram.stop)
+
+    def make_client(self, **kwargs):
+        client = TelegramClient('token', base_url=self.telegram.url, http2=False, **kwargs)
+        client._retry_delay = lambda attempt: 0
+        self.addCleanup(client.close)
+        return client
+
+    def test_only_unsent_requests_and_read_only_methods_are_retried(self):
+        client = self.make_client(retries=2)
+        message = {'chat_id': 1, 'text': 'hi'}
+        self.telegram.failure_rate = 1.0
+        self.assertEqual(client.call('sendMessage', message)['error_code'], 502)
+        self.assertEqual(client.call('getMe')['error_code'], 502)
+        self.assertEqual((self.telegram.count('sendMessage'), self.telegram.count('getMe')), (1, 3))
+
+        async def send():
+            try:
+                return await client.acall('sendMessage', message)
+            finally:
+                await client.aclose()
+        self.assertEqual(asyncio.run(send())['error_code'], 502)
+        self.assertEqual(self.telegram.count('sendMessage'), 2)
+
+        # A reply slower than the read timeout: Telegram may have sent the message
+        self.telegram.failure_rate = 0.0
+        self.telegram.latency = 0.5
+        self.assertIsNone(self.make_client(retries=2, read_timeout=0.2).call('sendMessage', message))
+        self.assertEqual(self.telegram.count('sendMessage'), 3)
+
+        # A refused connection never reached Telegram
+        with mock.patch.object(httpx.Client, 'post', side_effect=httpx.ConnectError('refused')) as post:
+            self.assertIsNone(client.call('sendMessage', message))
+        self.assertEqual(post.call_count, 3)
+
+    def test_long_poll_outlasts_the_default_read_timeout(self):
+        with override_settings(TELEGRAM_API_URL=self.telegram.url, TELEGRAM_READ_TIMEOUT=0.3, TELEGRAM_RETRIES=0):
+            reset_client()
+            self.addCleanup(reset_client)
+            started = time.monotonic()
+            self.assertEqual(tasks.get_updates(timeout=1), [])
+        self.assertGreaterEqual(time.monotonic() - started, 0.9)
+
+    def test_calls_reuse_pooled_connections(self):
+        client = self.make_client(pool_size=8)
+        for _ in range(5):
+            self.assertTrue(client.call('getMe')['ok'])
+        self.assertEqual(self.telegram.connections, 1)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda i: client.call('sendMessage', {'chat_id': i, 'text': 'hi'}), range(40)))
+        self.assertTrue(all(result['ok'] for result in results))
+        self.assertLessEqual(self.telegram.connections, 8)
+
+
+
+class UpdatePollerTests(FakeTelegramTestCase):
+
+    def run_idle(self, poller, seconds, pause=0.0):
+        started_wall = time.monotonic()
+        started_cpu = time.process_time()
+        while time.monotonic() - started_wall < seconds:
+            poller.poll()
+            time.sleep(pause)
+        return time.process_time() - started_cpu
+
+    def test_offset_advances_past_handled_updates(self):
+        handled = []
+        poller = UpdatePoller(timeout=1, handler=handled.append)
+        for update_id in (7, 8, 9):
+            self.telegram.push_update({'update_id': update_id, 'message': {}})
+
+        poller.poll()
+        self.assertEqual([u['update_id'] for u in handled], [7, 8, 9])
+        self.assertEqual(poller.offset, 10)
+
+        poller.poll()
+        self.assertEqual(len(handled), 3)
+        method, params = self.telegram.requests[-1]
+        self.assertEqual(params['offset'], '10')
+        self.assertEqual(params['timeout'], '1')
+        self.assertEqual(params['allowed_updates'], '["message", "callback_query"]')
+
+    def test_failing_handler_does_not_block_the_offset(self):
+        def handler(update):
+            raise ValueError('boom')
+        poller = UpdatePoller(timeout=1, handler=handler)
+        self.telegram.push_update({'update_id': 3, 'message': {}})
+        poller.poll()
+        self.assertEqual(poller.offset, 4)
+
+    def test_failed_polls_raise_and_back_off(self):
+        poller = UpdatePoller(timeout=1, handler=lambda update: None)
+        self.telegram.updates_error = 409
+        for failures in (1, 2, 3):
+            with self.assertRaises(TelegramAPIError) as raised:
+                poller.poll()
+            self.assertEqual((raised.exception.error_code, poller.failures), (409, failures))
+        self.assertTrue(2 <= poller.backoff(raised.exception) <= 4)
+        self.assertEqual(poller.backoff(TelegramAPIError('getUpdates', 429, retry_after=30)), 30)
+        self.telegram.updates_error = None
+        self.assertEqual(poller.poll(), [])
+        self.assertEqual(poller.failures, 0)
+        # A network error is a failure too, not an empty batch
+        with mock.patch.object(tasks, 'post_telegram_request', return_value=None):
+            with self.assertRaises(TelegramAPIError) as raised:
+                tasks.get_updates()
+        self.assertIsNone(raised.exception.error_code)
+
+    def test_run_scheduler_stops_on_a_rejected_token(self):
+        self.addCleanup(schedule.clear)
+        self.telegram.updates_error = 401
+        with self.assertRaisesMessage(CommandError, 'rejected the bot token'):
+            call_command('run_scheduler', poll_timeout=0, stdout=io.StringIO(), stderr=io.StringIO())
+        self.assertEqual(self.telegram.count('getUpdates'), 1)
+
+    def test_polling_goes_on_during_a_long_delivery(self):
+        self.addCleanup(schedule.clear)
+        delivering, finished = threading.Event(), threading.Event()
+        stored, waited = [], []
+
+        def deliver(shard=None):
+            delivering.set()
+            waited.append(finished.wait(5))
+            return 0
+
+        def poll(poller):
+            delivering.wait(5)
+            stored.append(SchedulerLease.objects.get(name=POLLER_LEASE).value)
+            if len(stored) == 3:
+                finished.set()
+                raise KeyboardInterrupt
+            poller.offset = len(stored) * 10
+            return [{'update_id': poller.offset - 1}]
+
+        with mock.patch.object(run_scheduler, 'deliver_due_profiles', side_effect=deliver), \
+                mock.patch.object(UpdatePoller, 'poll', autospec=True, side_effect=poll):
+            call_command('run_scheduler', stdout=io.StringIO(), stderr=io.StringIO())
+        # Three polls while the catch-up delivery was still running, each seeing the
+        # offset stored after the previous one
+        self.assertEqual(stored, [None, 10, 20])
+        self.assertEqual(waited, [True])
+        self.assertNotIn('scheduler-jobs', [thread.name for thread in threading.enumerate()])
+
+    def test_a_full_queue_renews_the_lease_until_the_update_fits(self):
+        command = run_scheduler.Command()
+        command.holder, command.lease_seconds, command.lease_lost = 'poller', 60, False
+        command.poller = UpdatePoller()
+        command.poller.offset = 7
+        command.dispatcher = mock.Mock()
+        command.dispatcher.submit.side_effect = [queue.Full, None]
+        command.submit_update({'update_id': 7})
+        self.assertEqual(command.dispatcher.submit.call_count, 2)
+        self.assertEqual(SchedulerLease.objects.get(name=POLLER_LEASE).value, 7)
+
+        # Another process took the lease: the rest of the batch is left to it
+        release_lease(POLLER_LEASE, 'poller')
+        acquire_lease(POLLER_LEASE, 'other', 60)
+        command.dispatcher.submit.side_effect = queue.Full
+        command.submit_update({'update_id': 7})
+        command.submit_update({'update_id': 8})
+        self.assertTrue(command.lease_lost)
+        self.assertEqual(command.dispatcher.submit.call_count, 3)
+
+    def test_long_polling_returns_as_soon_as_an_update_arrives(self):
+        poller = UpdatePoller(timeout=5, handler=lambda update: None)
+        started = time.monotonic()
+        threading.Timer(0.2, self.telegram.push_update, [{'update_id': 1, 'message': {}}]).start()
+        updates = poller.poll()
+        self.assertEqual(len(updates), 1)
+        self.assertLess(time.monotonic() - started, 2)
+
+    def test_idle_long_polling_collapses_request_count_and_cpu(self):
+        short_cpu = self.run_idle(UpdatePoller(timeout=0, handler=lambda u: None), 1.0, pause=0.02)
+        short_requests = self.telegram.count('getUpdates')
+
+        long_cpu = self.run_idle(UpdatePoller(timeout=1, handler=lambda u: None), 1.0)
+        long_requests = self.telegram.count('getUpdates') - short_requests
+
+        self.assertGreaterEqual(short_requests, 10)
+        self.assertLessEqual(long_requests, 2)
+        self.assertLess(long_cpu, short_cpu)
+
+
+
+@override_settings(TELEGRAM_WEBHOOK_SECRET='s3cret')
+class TelegramWebhookTests(TestCase):
+
+    def setUp(self):
+        self.handled = []
+        self.dispatcher = UpdateDispatcher(handler=self.handled.append).start()
+        patcher = mock.patch('core.views.get_dispatcher', return_value=self.dispatcher)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post_update(self, update, secret='s3cret'):
+        headers = {'HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN': secret} if secret else {}
+        return self.client.post(reverse('telegram_webhook'), data=update, content_type='application/json', **headers)
+
+    def test_update_is_acknowledged_and_queued(self):
+        response = self.post_update({'update_id': 5, 'message': {'text': 'hi'}})
+        self.assertEqual(response.status_code, 200)
+        self.dispatcher.join()
+        self.assertEqual(self.handled, [{'update_id': 5, 'message': {'text': 'hi'}}])
+
+    def test_wrong_or_missing_secret_is_rejected(self):
+        self.assertEqual(self.post_update({'update_id': 5}, secret='nope').status_code, 403)
+        self.assertEqual(self.post_update({'update_id': 5}, secret=None).status_code, 403)
+        self.assertEqual(self.handled, [])
+
+    def test_malformed_body_is_rejected(self):
+        self.assertEqual(self.post_update('not json').status_code, 400)
+
+
+
+class UpdateDispatcherTests(TestCase):
+
+    def callback_update(self, update_id, chat_id):
+        return {'update_id': update_id, 'callback_query': {'id': str(update_id), 'message': {'chat': {'id': chat_id}}}}
+
+    def test_updates_of_one_chat_stay_in_order(self):
+        handled = []
+        lock = threading.Lock()
+        def handler(update):
+            time.sleep(random.random() / 500)
+            with lock:
+                handled.append(update)
+        dispatcher = UpdateDispatcher(handler=handler, workers=4).start()
+        for update_id in range(200):
+            dispatcher.submit(self.callback_update(update_id, chat_id=update_id % 7))
+        dispatcher.join()
+
+        self.assertEqual(len(handled), 200)
+        for chat_id in range(7):
+            ids = [u['update_id'] for u in handled if u['callback_query']['message']['chat']['id'] == chat_id]
+            self.assertEqual(ids, sorted(ids))
+
+    def test_full_queue_pushes_back_on_the_producer(self):
+        release = threading.Event()
+        dispatcher = UpdateDispatcher(handler=lambda update: release.wait(), workers=1, queue_size=2).start()
+        for update_id in range(3):
+            dispatcher.submit(self.callback_update(update_id, chat_id=1), timeout=1)
+        with self.assertRaises(queue.Full):
+            dispatcher.submit(self.callback_update(3, chat_id=1), timeout=0.1)
+        self.assertEqual(dispatcher.depth, 2)
+
+        release.set()
+        dispatcher.join()
+        stats = dispatcher.stats()
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['handlers']['callback_query']['count'], 3)
+
+
+
+class TelegramFileCacheTests(FakeTelegramTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(tasks, 'file_cache', TelegramFileCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        handle, self.path = tempfile.mkstemp(suffix='.jpg')
+        os.write(handle, b'first version')
+        os.close(handle)
+        self.addCleanup(os.remove, self.path)
+
+    def send(self, caption='caption'):
+        return tasks.send_photo_with_spoiler(1, self.path, caption, 1, 'knew:1:none', 'didnt_know:1:none')
+
+    def test_photo_is_uploaded_once_then_sent_by_file_id(self):
+        self.send()
+        self.send()
+        self.assertEqual(self.telegram.uploads, 1)
+        self.assertEqual(self.telegram.requests[-1][1]['photo'], 'photo-1')
+        self.assertEqual(TelegramFile.objects.get(path=self.path).file_id, 'photo-1')
+
+    def test_cached_id_survives_a_restart(self):
+        self.send()
+        with mock.patch.object(tasks, 'file_cache', TelegramFileCache()):
+            self.send()
+        self.assertEqual(self.telegram.uploads, 1)
+
+    def test_changed_file_is_uploaded_again(self):
+        self.send()
+        with open(self.path, 'ab') as image_file:
+            image_file.write(b' and more')
+        self.send()
+        self.assertEqual(self.telegram.uploads, 2)
+        self.assertEqual(TelegramFile.objects.get(path=self.path).file_id, 'photo-2')
+
+    def test_rejected_file_id_falls_back_to_upload(self):
+        self.send()
+        self.telegram.file_ids.clear()
+        self.assertIsNotNone(self.send())
+        self.assertEqual(self.telegram.uploads, 2)
+
+    def test_other_bad_requests_keep_the_cached_id(self):
+        self.send()
+        # A caption over Telegram's limit fails whatever the photo; no upload is tried
+        self.assertIsNone(self.send(caption='x' * 1100))
+        self.assertEqual((self.telegram.count('sendPhoto'), self.telegram.uploads), (2, 1))
+        self.assertEqual(TelegramFile.objects.get(path=self.path).file_id, 'photo-1')
+
+
+
+class GetScheduledWordsTests(TestCase):
+
+    def setUp(self):
+        self.profile = User.objects.create_user('learner', password='pass12345').userprofile
+        now = timezone.now()
+        self.overdue = [self.word(f"overdue{i}", next_review=now - timedelta(days=i + 1)) for i in range(4)]
+        self.soon_due = [self.word(f"soon{i}", next_review=now + timedelta(days=i + 1)) for i in range(4)]
+        self.new = [self.word(f"new{i}", added=now - timedelta(days=10 - i)) for i in range(4)]
+
+    def word(self, text, next_review=None, added=None):
+        vocab = Vocabulary.objects.create(user=self.profile, word=text, meaning='m')
+        if added:
+            Vocabulary.objects.filter(pk=vocab.pk).update(date_added=added)
+        if next_review:
+            UserVocabularyProgress.objects.create(user=self.profile, vocabulary=vocab, next_review=next_review)
+        VocabularyImage.objects.create(vocabulary=vocab, image=f"img/{text}.jpg")
+        return vocab
+
+    def test_mix_of_overdue_soon_due_and_new_words(self):
+        words = {v.word for v in tasks.get_scheduled_words(self.profile, 5)}
+        # 5 // 2 most overdue, then (5 - 2) // 2 soonest due, then the oldest new words
+        self.assertEqual(words, {'overdue3', 'overdue2', 'soon0', 'new0', 'new1'})
+
+    def test_missing_overdue_words_leave_more_slots_for_the_rest(self):
+        UserVocabularyProgress.objects.filter(vocabulary__in=self.overdue).delete()
+        Vocabulary.objects.filter(pk__in=[v.pk for v in self.overdue]).delete()
+        words = {v.word for v in tasks.get_scheduled_words(self.profile, 5)}
+        self.assertEqual(words, {'soon0', 'soon1', 'new0', 'new1', 'new2'})
+
+    def test_query_count_does_not_depend_on_the_number_of_words(self):
+        with self.assertNumQueries(2):
+            words = tasks.get_scheduled_words(self.profile, 5)
+            for vocab in words:
+                tasks.build_flashcard_caption(vocab, choose_flashcard_image(vocab))
+        for i in range(20):
+            self.word(f"extra{i}", next_review=timezone.now() - timedelta(hours=i))
+        with self.assertNumQueries(2):
+            words = tasks.get_scheduled_words(self.profile, 10)
+            for vocab in words:
+                choose_flashcard_image(vocab)
+
+
+
+class DeliveryPlanTests(TestCase):
+
+    def linked_user(self, name, chat_id, words=6):
+        profile = User.objects.create_user(name, password='pass12345').userprofile
+        profile.chat_id = chat_id
+        profile.save()
+        for i in range(words):
+            vocab = Vocabulary.objects.create(user=profile, word=f"{name}-{i}", meaning='m')
+            VocabularyImage.objects.create(vocabulary=vocab, image=f"img/{name}-{i}.jpg", flag=i % 2 == 0)
+            if i % 3 == 0:
+                UserVocabularyProgress.objects.create(user=profile, vocabulary=vocab, next_review=timezone.now() - timedelta(days=i))
+        return profile
+
+    def plan(self, **kwargs):
+        return [delivery for chunk in iter_delivery_plan(5, **kwargs) for delivery in chunk]
+
+    def test_plan_covers_linked_users_only(self):
+        linked = [self.linked_user(f"u{i}", chat_id=100 + i) for i in range(3)]
+        unlinked = self.linked_user('nochat', chat_id=None)
+        plan = self.plan()
+        self.assertEqual([d.user_id for d in plan], [p.id for p in linked])
+        for delivery in plan:
+            self.assertEqual(len(delivery.cards), 5)
+            for vocab, image in delivery.cards:
+                self.assertEqual(vocab.user_id, delivery.user_id)
+                self.assertEqual(image.vocabulary_id, vocab.id)
+        self.assertNotIn(unlinked.id, [d.user_id for d in plan])
+
+    def test_plan_matches_per_user_selection(self):
+        profile = self.linked_user('solo', chat_id=1)
+        planned = {vocab.id for vocab, image in self.plan()[0].cards}
+        self.assertEqual(planned, {vocab.id for vocab in tasks.get_scheduled_words(profile, 5)})
+
+    def test_query_count_is_independent_of_user_count(self):
+        for i in range(3):
+            self.linked_user(f"a{i}", chat_id=200 + i)
+        # users, candidates, images, then the empty chunk that ends the stream
+        with self.assertNumQueries(4):
+            self.plan()
+        for i in range(5):
+            self.linked_user(f"b{i}", chat_id=300 + i)
+        with self.assertNumQueries(4):
+            self.assertEqual(len(self.plan()), 8)
+        with self.assertNumQueries(10):
+            self.assertEqual(len(self.plan(chunk_size=3)), 8)
+
+
+
+class ImageRotationTests(TestCase):
+
+    def setUp(self):
+        profile = User.objects.create_user('rotator', password='pass12345').userprofile
+        self.vocab = Vocabulary.objects.create(user=profile, word='w', meaning='m')
+        self.other = Vocabulary.objects.create(user=profile, word='o', meaning='m')
+        self.images = [VocabularyImage.objects.create(vocabulary=self.vocab, image=f"img/{i}.jpg") for i in range(2)]
+        self.other_image = VocabularyImage.objects.create(vocabulary=self.other, image='img/o.jpg')
+        VocabularyImage.objects.filter(pk=self.other_image.pk).update(flag=True)
+
+    def flags(self, vocab):
+        return list(vocab.images.order_by('id').values_list('flag', flat=True))
+
+    def test_flags_reset_once_every_image_of_the_vocab_is_known(self):
+        self.images[0].flag = True
+        self.images[0].save()
+        self.assertEqual(self.flags(self.vocab), [True, False])
+
+        self.images[1].flag = True
+        self.images[1].save()
+        self.assertEqual(self.flags(self.vocab), [False, False])
+
+    def test_reset_is_scoped_to_the_vocab(self):
+        VocabularyImage.objects.filter(vocabulary=self.vocab).update(flag=True)
+        self.images[0].flag = True
+        self.images[0].save()
+        self.assertEqual(self.flags(self.vocab), [False, False])
+        self.assertEqual(self.flags(self.other), [True])
+
+    def test_reset_is_a_single_statement(self):
+        VocabularyImage.objects.filter(vocabulary=self.vocab).update(flag=True)
+        with self.assertNumQueries(1):
+            self.assertEqual(reset_image_rotation(self.vocab.id), 2)
+        with self.assertNumQueries(1):
+            self.assertEqual(reset_image_rotation(self.vocab.id), 0)
+
+
+
+class HandleCallbackQueryTests(FakeTelegramTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.profile = User.objects.create_user('clicker', password='pass12345').userprofile
+        self.profile.chat_id = 42
+        self.profile.save()
+        self.vocab = Vocabulary.objects.create(user=self.profile, word='w', meaning='m')
+        self.image = VocabularyImage.objects.create(vocabulary=self.vocab, image='img/w.jpg')
+        VocabularyImage.objects.create(vocabulary=self.vocab, image='img/w2.jpg')
+
+    def click(self, action, message_id=7, query_id='q1'):
+        tasks.handle_callback_query({'update_id': 1, 'callback_query': {
+            'id': query_id,
+            'data': f"{action}:{self.vocab.id}:{self.image.id}",
+            'message': {'message_id': message_id, 'chat': {'id': 42}},
+        }})
+
+    def progress(self):
+        return UserVocabularyProgress.objects.get(user=self.profile, vocabulary=self.vocab)
+
+    def test_knew_updates_progress_and_image_then_acknowledges(self):
+        self.click('knew')
+        progress = self.progress()
+        self.assertEqual((progress.interval, progress.knew_count, progress.appeared_count), (1, 1, 1))
+        self.assertTrue(VocabularyImage.objects.get(pk=self.image.pk).flag)
+        self.assertEqual(self.telegram.count('answerCallbackQuery'), 1)
+        self.assertEqual(self.telegram.count('editMessageReplyMarkup'), 1)
+
+    def test_double_click_is_recorded_once(self):
+        self.click('knew')
+        self.click('knew', query_id='q2')
+        self.click('didnt_know', query_id='q3')
+        progress = self.progress()
+        self.assertEqual((progress.knew_count, progress.didnt_know_count, progress.appeared_count), (1, 0, 1))
+        self.assertEqual(self.telegram.count('answerCallbackQuery'), 3)
+
+    def test_each_new_message_is_a_new_review(self):
+        self.click('knew', message_id=7)
+        self.click('knew', message_id=8)
+        progress = self.progress()
+        self.assertEqual((progress.interval, progress.knew_count), (6, 2))
+
+    def test_didnt_know_resets_the_interval(self):
+        self.click('knew', message_id=7)
+        self.click('didnt_know', message_id=8)
+        progress = self.progress()
+        self.assertEqual((progress.interval, progress.didnt_know_count), (1, 1))
+        self.assertFalse(VocabularyImage.objects.get(pk=self.image.pk).flag)
+
+
+
+class SM2BatchTests(TestCase):
+
+    def test_batch_matches_scalar_sm2_exactly(self):
+        rng = random.Random(3)
+        rows = [(rng.choice([0, 1, 2, 6, 15, rng.randint(0, 400)]), rng.uniform(1.3, 3.5), rng.randint(0, 5)) for _ in range(5000)]
+        # Exact .5 products exercise the half-to-even rounding
+        rows += [(5, 2.5, 4), (3, 2.5, 5), (7, 1.5, 3), (0, 1.3, 0), (1, 1.35, 2)]
+        intervals, eases = sm2_batch(*zip(*rows))
+        for (interval, ease, quality), new_interval, new_ease in zip(rows, intervals, eases):
+            progress = tasks.sm2(UserVocabularyProgress(interval=interval, ease_factor=ease), quality)
+            self.assertEqual((progress.interval, progress.ease_factor), (int(new_interval), float(new_ease)))
+
+    def test_recompute_command_rebuilds_next_review(self):
+        profile = User.objects.create_user('sched', password='pass12345').userprofile
+        reviewed = timezone.now() - timedelta(days=3)
+        rows = []
+        for i in range(5):
+            vocab = Vocabulary.objects.create(user=profile, word=f"w{i}", meaning='m')
+            rows.append(UserVocabularyProgress.objects.create(
+                user=profile, vocabulary=vocab, interval=i, ease_factor=1.1 + i * 0.1,
+                last_appeared=reviewed if i else None, next_review=reviewed - timedelta(days=1),
+            ))
+
+        call_command('recompute_schedules', chunk_size=2, stdout=io.StringIO())
+        for row in rows:
+            updated = UserVocabularyProgress.objects.get(pk=row.pk)
+            self.assertEqual(updated.ease_factor, max(row.ease_factor, 1.3))
+            if row.last_appeared:
+                self.assertEqual(updated.next_review, reviewed + timedelta(days=row.interval))
+            else:
+                self.assertEqual(updated.next_review, row.next_review)
+
+    def test_recompute_ignores_microsecond_drift(self):
+        profile = User.objects.create_user('drift', password='pass12345').userprofile
+        vocab = Vocabulary.objects.create(user=profile, word='w', meaning='m')
+        progress = tasks.sm2(UserVocabularyProgress(user=profile, vocabulary=vocab, interval=1), 4)
+        self.assertEqual(progress.next_review, progress.last_appeared + timedelta(days=progress.interval))
+        progress.next_review += timedelta(microseconds=7)
+        progress.save()
+        out = io.StringIO()
+        call_command('recompute_schedules', stdout=out)
+        self.assertIn('1 rows scanned, 0 updated', out.getvalue())
+
+    def test_apply_quality_matches_scalar_sm2(self):
+        profile = User.objects.create_user('sched2', password='pass12345').userprofile
+        reviewed = timezone.now() - timedelta(days=2)
+        vocab, fresh = (Vocabulary.objects.create(user=profile, word=word, meaning='m') for word in ('w', 'fresh'))
+        row = UserVocabularyProgress.objects.create(
+            user=profile, vocabulary=vocab, interval=6, ease_factor=2.36, last_appeared=reviewed,
+            appeared_count=2, knew_count=2,
+        )
+        new = UserVocabularyProgress.objects.create(user=profile, vocabulary=fresh)
+        call_command('recompute_schedules', apply_quality=4, stdout=io.StringIO())
+        updated = UserVocabularyProgress.objects.get(pk=row.pk)
+        # Two answers of quality 4, replayed from a new card
+        expected = tasks.sm2(tasks.sm2(UserVocabularyProgress(), 4), 4)
+        self.assertEqual((updated.interval, updated.ease_factor), (expected.interval, expected.ease_factor))
+        self.assertEqual(updated.next_review, reviewed + timedelta(days=expected.interval))
+        # The review history is left alone, and so are cards never reviewed
+        self.assertEqual((updated.last_appeared, updated.appeared_count, updated.knew_count, updated.didnt_know_count),
+                         (reviewed, 2, 2, 0))
+        self.assertEqual(UserVocabularyProgress.objects.get(pk=new.pk).next_review, new.next_review)
+
+        # Running it again changes nothing
+        out = io.StringIO()
+        call_command('recompute_schedules', apply_quality=4, stdout=out)
+        self.assertIn('0 updated', out.getvalue())
+        again = UserVocabularyProgress.objects.get(pk=row.pk)
+        self.assertEqual((again.interval, again.ease_factor, again.next_review),
+                         (updated.interval, updated.ease_factor, updated.next_review))
+
+        # Re-tuned constants
+        call_command('recompute_schedules', apply_quality=1, fail_penalty=0.5, first_interval=2, stdout=io.StringIO())
+        updated.refresh_from_db()
+        self.assertEqual(updated.interval, 2)
+        self.assertAlmostEqual(updated.ease_factor, 2.5 - 2 * 0.5)
+        self.assertEqual(updated.next_review, reviewed + timedelta(days=2))
+
+    def test_replay_caps_long_runs_of_passed_answers(self):
+        interval, ease = sm2_replay([0, 3, 200], 5, 2.5)
+        self.assertEqual(interval.tolist(), [0, 16, MAX_REPLAY_INTERVAL])
+        self.assertAlmostEqual(ease[1], 2.8)
+
+
+class ReviewSimulationTests(TestCase):
+
+    def random_state(self, users=20, cards=50):
+        rng = np.random.default_rng(1)
+        n = users * cards
+        return CardState(np.repeat(np.arange(users), cards), rng.integers(0, 30, n),
+                         rng.uniform(1.3, 3.0, n), rng.integers(-5, 20, n), users=users)
+
+    def test_uncapped_run_matches_a_card_by_card_replay(self):
+        state = self.random_state()
+        forecast, final = simulate(state, 20, recall=1.0)
+        due_day = state.due_day.astype(int).tolist()
+        interval = state.interval.astype(int).tolist()
+        for day in range(20):
+            due = [i for i in range(len(state)) if due_day[i] <= day]
+            self.assertEqual(forecast.due[day], len(due))
+            for i in due:
+                progress = tasks.sm2(UserVocabularyProgress(interval=interval[i], ease_factor=float(state.ease_factor[i])), 4)
+                interval[i] = progress.interval
+                state.ease_factor[i] = progress.ease_factor
+                due_day[i] = day + progress.interval
+        self.assertEqual(final.due_day.tolist(), due_day)
+
+    def test_cap_limits_reviews_and_keeps_the_rest_due(self):
+        state = self.random_state()
+        forecast, final = simulate(state, 10, daily_cap=5)
+        uncapped, _ = simulate(state, 10)
+        self.assertTrue((forecast.reviewed <= 5 * state.users).all())
+        self.assertTrue((forecast.due == forecast.reviewed + forecast.backlog).all())
+        self.assertGreater(forecast.backlog[-1], 0)
+        self.assertTrue((uncapped.backlog == 0).all())
+        caps = uncapped.suggested_caps()
+        self.assertTrue(((caps >= 1) & (caps <= 50)).all())
+
+    def test_fuzz_spreads_a_crowd_within_the_window(self):
+        target = np.full(1000, 10)
+        interval = np.full(1000, 10)
+        chosen = balance_due_days(target, interval, np.zeros(31, dtype=np.int64), 0.2, rng=np.random.default_rng(0))
+        self.assertTrue(((chosen >= 8) & (chosen <= 12)).all())
+        self.assertEqual(len(set(chosen.tolist())), 5)
+        # Past the end of the forecast there is no load to balance against
+        far = balance_due_days(np.array([100]), np.array([10]), np.zeros(31, dtype=np.int64), 0.2)
+        self.assertEqual(far.tolist(), [100])
+
+    def test_loading_state_reads_every_row_across_chunks(self):
+        now = timezone.now()
+        today = timezone.localtime(now).replace(hour=0, minute=0, second=0, microsecond=0)
+        expected = {}
+        for name, offsets in (('load-a', (-3, 0, 2)), ('load-b', (5, -1))):
+            profile = User.objects.create_user(name, password='pass12345').userprofile
+            for i, offset in enumerate(offsets):
+                vocab = Vocabulary.objects.create(user=profile, word=f"{name}{i}", meaning='m')
+                next_review = today + timedelta(days=offset, hours=6)
+                UserVocabularyProgress.objects.create(user=profile, vocabulary=vocab, interval=i + 1,
+                                                      ease_factor=2.0 + i / 10, next_review=next_review)
+                expected.setdefault(profile.id, []).append((i + 1, offset))
+        state, profile_ids = CardState.from_database(now=now, chunk_size=2)
+        self.assertEqual(len(state), 5)
+        self.assertEqual(state.users, 2)
+        loaded = {}
+        for index, interval, due_day in zip(state.user_index, state.interval, state.due_day):
+            loaded.setdefault(int(profile_ids[index]), []).append((int(interval), int(due_day)))
+        self.assertEqual({key: sorted(value) for key, value in loaded.items()},
+                         {key: sorted(value) for key, value in expected.items()})
+
+    def test_forecast_command_reads_progress_rows(self):
+        profile = User.objects.create_user('forecast', password='pass12345').userprofile
+        for i in range(3):
+            vocab = Vocabulary.objects.create(user=profile, word=f"w{i}", meaning='m')
+            UserVocabularyProgress.objects.create(user=profile, vocabulary=vocab, interval=i,
+                                                  next_review=timezone.now() + timedelta(days=i))
+        out = io.StringIO()
+        call_command('forecast_reviews', days=5, cap=1, fuzz=0.1, json=True, stdout=out, stderr=io.StringIO())
+        results = json.loads(out.getvalue())
+        self.assertEqual((results['cards'], results['users']), (3, 1))
+        self.assertEqual(results['baseline']['due_per_day'][0], 1)
+        self.assertEqual(set(results), {'cards', 'users', 'baseline', 'suggested_caps', 'capped', 'fuzzed', 'seconds'})
+
+
+
+class DeliveryScheduleTests(TestCase):
+
+    def linked_profile(self, name, next_delivery_at=None, **fields):
+        profile = User.objects.create_user(name, password='pass12345').userprofile
+        profile.chat_id = 500 + profile.id
+        profile.next_delivery_at = next_delivery_at
+        for field, value in fields.items():
+            setattr(profile, field, value)
+        profile.save()
+        return profile
+
+    def test_next_slot_uses_the_local_time_across_dst(self):
+        profile = self.linked_profile('berlin', timezone='Europe/Berlin', delivery_time=dt_time(8, 0), delivery_window_minutes=0)
+        after = datetime(2026, 3, 28, 10, 0, tzinfo=dt_timezone.utc)
+        # Central European Time (UTC+1) before the switch, summer time (UTC+2) after it
+        self.assertEqual(next_delivery_time(profile, after), datetime(2026, 3, 29, 6, 0, tzinfo=dt_timezone.utc))
+        self.assertEqual(next_delivery_time(profile, datetime(2026, 3, 28, 6, 0, tzinfo=dt_timezone.utc)),
+                         datetime(2026, 3, 28, 7, 0, tzinfo=dt_timezone.utc))
+
+    def test_users_are_spread_evenly_over_the_window(self):
+        minutes = [delivery_offset(user_id, 60) // timedelta(minutes=1) for user_id in range(1, 601)]
+        per_ten_minutes = [sum(1 for m in minutes if start <= m < start + 10) for start in range(0, 60, 10)]
+        self.assertTrue(all(90 <= count <= 110 for count in per_ten_minutes), per_ten_minutes)
+
+    def test_missed_slots_are_caught_up_once(self):
+        now = timezone.now()
+        late = self.linked_profile('late', now - timedelta(hours=1))
+        later = self.linked_profile('later', now - timedelta(minutes=5))
+        stale = self.linked_profile('stale', now - timedelta(days=2))
+        future = self.linked_profile('future', now + timedelta(hours=1))
+        new = self.linked_profile('new')
+        sent = []
+
+        def fake_jobs(users, num_words, batch_key=None):
+            sent.extend(users.values_list('id', flat=True))
+            return iter(())
+
+        with mock.patch.object(tasks, 'iter_flashcard_jobs', fake_jobs):
+            self.assertEqual(tasks.deliver_due_profiles(now=now, slice_size=1), 2)
+            self.assertEqual(tasks.deliver_due_profiles(now=now, slice_size=1), 0)
+        self.assertEqual(sorted(sent), sorted([late.id, later.id]))
+        for profile in (late, later, stale, new):
+            profile.refresh_from_db()
+            self.assertGreater(profile.next_delivery_at, now)
+            self.assertLessEqual(profile.next_delivery_at, now + timedelta(days=1, hours=1))
+        future.refresh_from_db()
+        self.assertEqual(future.next_delivery_at, now + timedelta(hours=1))
+
+    def test_saving_preferences_reschedules(self):
+        profile = self.linked_profile('prefs', timezone.now() - timedelta(days=1))
+        self.client.force_login(profile.user)
+        response = self.client.post(reverse('link_telegram'), {
+            'save_delivery': '1', 'timezone': 'Asia/Tokyo', 'delivery_time': '07:30', 'delivery_window_minutes': 30,
+        })
+        self.assertEqual(response.status_code, 302)
+        profile.refresh_from_db()
+        self.assertEqual(profile.timezone, 'Asia/Tokyo')
+        local = profile.next_delivery_at.astimezone(ZoneInfo('Asia/Tokyo'))
+        self.assertTrue(dt_time(7, 30) <= local.time() < dt_time(8, 0))
+
+    def test_moving_the_window_later_keeps_one_delivery_a_day(self):
+        morning = datetime(2026, 5, 4, 8, 0, 30, tzinfo=dt_timezone.utc)
+        profile = self.linked_profile('once', morning, timezone='UTC', delivery_time=dt_time(8, 0), delivery_window_minutes=1)
+        self.assertEqual(tasks.claim_due_deliveries(morning, 10), (1, [profile.id]))
+        profile.refresh_from_db()
+        self.assertEqual(profile.last_delivery_date, date(2026, 5, 4))
+        form = DeliveryPreferencesForm({'timezone': 'UTC', 'delivery_time': '20:00', 'delivery_window_minutes': 1}, instance=profile)
+        self.assertTrue(form.is_valid(), form.errors)
+        with mock.patch.object(timezone, 'now', return_value=morning + timedelta(hours=1)):
+            profile = form.save()
+        self.assertEqual(profile.next_delivery_at.date(), date(2026, 5, 5))
+        self.assertEqual(profile.next_delivery_at.time().replace(second=0), dt_time(20, 0))
+
+
+
+class DeliveryEngineTests(TestCase):
+
+    def run_engine(self, jobs, send, **kwargs):
+        results = []
+        options = {'workers': 4, 'global_rate': 1000, 'chat_rate': 1000, 'max_retries': 3}
+        options.update(kwargs)
+        engine = DeliveryEngine(send, on_result=lambda job, response: results.append((job, response)), **options)
+        return engine.run(jobs), results
+
+    def test_token_bucket_limits_the_rate_and_pauses(self):
+        bucket = TokenBucket(20, capacity=2)
+        started = time.monotonic()
+        for _ in range(4):
+            bucket.acquire()
+        # Two tokens of burst, then one every 50 ms
+        self.assertTrue(0.08 <= time.monotonic() - started < 0.5)
+        bucket.pause(0.3)
+        started = time.monotonic()
+        bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.28)
+
+    def test_messages_of_a_chat_are_sent_in_order(self):
+        sent = []
+        lock = threading.Lock()
+
+        def send(job):
+            time.sleep(random.uniform(0, 0.01))
+            with lock:
+                sent.append((job.chat_id, job.payload['n']))
+            return {'ok': True}
+        jobs = [DeliveryJob(chat, 'sendMessage', {'n': n}) for chat in range(6) for n in range(5)]
+        stats, results = self.run_engine(jobs, send)
+        self.assertEqual((stats.sent, stats.failed, len(results)), (30, 0, 30))
+        for chat in range(6):
+            self.assertEqual([n for chat_id, n in sent if chat_id == chat], list(range(5)))
+
+    def test_rate_limit_pauses_every_chat(self):
+        calls = []
+
+        def send(job):
+            calls.append((job.chat_id, time.monotonic()))
+            if job.chat_id == 1 and len([c for c in calls if c[0] == 1]) == 1:
+                return {'ok': False, 'error_code': 429, 'parameters': {'retry_after': 0.5}}
+            if job.payload['n'] == 0:
+                # Chat 2's first message is still in flight when chat 1 is rate limited
+                time.sleep(0.1)
+            return {'ok': True}
+        jobs = [DeliveryJob(1, 'sendMessage', {'n': 0}), DeliveryJob(2, 'sendMessage', {'n': 0}), DeliveryJob(2, 'sendMessage', {'n': 1})]
+        stats, results = self.run_engine(jobs, send)
+        self.assertEqual((stats.sent, stats.rate_limited), (3, 1))
+        limited_at = calls[[chat for chat, at in calls].index(1)][1]
+        self.assertGreaterEqual(calls[-1][1] - limited_at, 0.45)
+        self.assertTrue(all(at - limited_at >= 0.45 for chat, at in calls[2:]))
+
+    def test_rate_limit_pauses_every_chat_without_retries(self):
+        calls = []
+
+        def send(job):
+            calls.append((job.chat_id, time.monotonic()))
+            if job.chat_id == 1:
+                return {'ok': False, 'error_code': 429, 'parameters': {'retry_after': 0.5}}
+            return {'ok': True}
+        jobs = [DeliveryJob(1, 'sendMessage', {})] + [DeliveryJob(chat, 'sendMessage', {}) for chat in range(2, 5)]
+        stats, results = self.run_engine(jobs, send, workers=1, max_retries=0)
+        self.assertEqual((stats.sent, stats.failed, stats.rate_limited, stats.retried), (3, 1, 1, 0))
+        self.assertEqual([chat for chat, at in calls], [1, 2, 3, 4])
+        self.assertTrue(all(at - calls[0][1] >= 0.45 for chat, at in calls[1:]))
+
+    def test_network_errors_are_retried_but_missing_files_are_not(self):
+        responses = {1: [None, {'ok': True}], 2: [missing_file_response('gone.jpg')]}
+        attempts = Counter()
+
+        def send(job):
+            attempts[job.chat_id] += 1
+            return responses[job.chat_id].pop(0)
+        stats, results = self.run_engine([DeliveryJob(1, 'sendPhoto', {}), DeliveryJob(2, 'sendPhoto', {})], send)
+        self.assertEqual((stats.sent, stats.failed, stats.retried), (1, 1, 1))
+        self.assertEqual(attempts, {1: 2, 2: 1})
+        self.assertTrue(dict((job.chat_id, response) for job, response in results)[2]['missing_file'])
+
+
+
+@override_settings(OUTBOX_MAX_ATTEMPTS=3, OUTBOX_BACKOFF_SECONDS=10)
+class OutboxTests(FakeTelegramTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(tasks, 'file_cache', TelegramFileCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_override = override_settings(MEDIA_ROOT=media.name)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+        self.media = media.name
+        os.makedirs(os.path.join(media.name, 'img'))
+        with open(os.path.join(media.name, 'img', 'card.jpg'), 'wb') as image_file:
+            image_file.write(b'image')
+        self.profile = User.objects.create_user('outbox', password='pass12345').userprofile
+        self.profile.chat_id = 42
+        self.profile.save()
+        for i in range(3):
+            vocab = Vocabulary.objects.create(user=self.profile, word=f"w{i}", meaning='m')
+            VocabularyImage.objects.create(vocabulary=vocab, image='img/card.jpg')
+
+    def scripted_engine(self, responses):
+        def send(job):
+            return responses.pop(0)
+        return lambda on_result: DeliveryEngine(send, workers=2, global_rate=1000, chat_rate=1000, max_retries=0, on_result=on_result)
+
+    def test_batch_is_queued_once_and_sent(self):
+        tasks.send_vocabulary_batch()
+        tasks.send_vocabulary_batch()
+        self.assertEqual(OutboundMessage.objects.filter(status=OutboundMessage.SENT).count(), 3)
+        self.assertEqual(self.telegram.count('sendPhoto'), 3)
+        self.assertEqual(self.telegram.uploads, 1)
+        stats = outbox.outbox_stats()
+        self.assertEqual((stats['sent'], stats['pending'], stats['dead'], stats['sent_in_window']), (3, 0, 0, 3))
+
+    def test_failures_are_retried_with_backoff_then_dead_lettered(self):
+        jobs = list(tasks.iter_flashcard_jobs(tasks.UserProfile.objects.all(), 3))
+        outbox.enqueue(jobs)
+        rate_limited = {'ok': False, 'error_code': 429, 'parameters': {'retry_after': 120}}
+        blocked = {'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'}
+        now = timezone.now()
+        # The 429 comes last: the engine holds every chat off for retry_after after it
+        totals = outbox.drain(self.scripted_engine([blocked, None, rate_limited]), now=now)
+        self.assertEqual((totals['sent'], totals['retrying'], totals['dead']), (0, 2, 1))
+        self.assertEqual(totals['engine']['rate_limited'], 1)
+        first, second, third = OutboundMessage.objects.order_by('id')
+        self.assertEqual(first.status, OutboundMessage.DEAD)
+        self.assertIn('403', first.last_error)
+        self.assertTrue(now + timedelta(seconds=5) <= second.next_attempt_at <= now + timedelta(seconds=11))
+        self.assertGreaterEqual(third.next_attempt_at, now + timedelta(seconds=120))
+        self.assertEqual([row.attempts for row in (first, second, third)], [1, 1, 0])
+
+        # Network errors until the attempts run out (the rate-limited row has one more)
+        for attempt in range(3):
+            totals = outbox.drain(self.scripted_engine([None, None]), now=timezone.now() + timedelta(hours=attempt + 1))
+        self.assertEqual(OutboundMessage.objects.filter(status=OutboundMessage.DEAD).count(), 3)
+        self.assertEqual(outbox.outbox_stats()['dead'], 3)
+
+    @override_settings(OUTBOX_RETENTION_DAYS=7)
+    def test_old_sent_and_dead_rows_are_pruned(self):
+        now = timezone.now()
+        old, recent, dead, pending = (
+            OutboundMessage.objects.create(chat_id=42, method='sendMessage', payload={}, status=status,
+                                           created_at=now - timedelta(days=age), sent_at=sent_at)
+            for status, age, sent_at in (
+                (OutboundMessage.SENT, 10, now - timedelta(days=8)),
+                (OutboundMessage.SENT, 10, now - timedelta(days=6)),
+                (OutboundMessage.DEAD, 8, None),
+                (OutboundMessage.PENDING, 30, None),
+            )
+        )
+        self.assertEqual(outbox.prune(now, chunk_size=1), 2)
+        self.assertEqual(set(OutboundMessage.objects.values_list('id', flat=True)), {recent.id, pending.id})
+        with override_settings(OUTBOX_RETENTION_DAYS=0):
+            self.assertEqual(outbox.prune(now + timedelta(days=365)), 0)
+
+    def test_rows_of_a_crashed_drain_are_recovered(self):
+        outbox.enqueue(tasks.iter_flashcard_jobs(tasks.UserProfile.objects.all(), 3))
+        claimed = outbox.claim_batch(2)
+        self.assertEqual(len(claimed), 2)
+        # A second drain doesn't get the rows claimed by the first
+        self.assertEqual(len(outbox.claim_batch(10)), 1)
+        self.assertEqual(outbox.recover_stale(), 0)
+        later = timezone.now() + timedelta(hours=1)
+        totals = outbox.drain(tasks.build_delivery_engine, now=later)
+        self.assertEqual((totals['recovered'], totals['sent']), (3, 3))
+        self.assertEqual(self.telegram.count('sendPhoto'), 3)
+
+    def test_photos_follow_the_images_replaced_file(self):
+        outbox.enqueue(tasks.iter_flashcard_jobs(tasks.UserProfile.objects.all(), 3))
+        # core.images replaces the upload with a new file while the cards are queued
+        os.rename(os.path.join(self.media, 'img', 'card.jpg'), os.path.join(self.media, 'img', 'card-new.jpg'))
+        VocabularyImage.objects.update(image='img/card-new.jpg')
+        totals = outbox.drain(tasks.build_delivery_engine)
+        self.assertEqual((totals['sent'], totals['dead']), (3, 0))
+        self.assertEqual(self.telegram.uploads, 1)
+
+        # A file replaced during the send is retried from the new file; one that is
+        # gone for good is a dead letter without a retry
+        outbox.enqueue(tasks.iter_flashcard_jobs(tasks.UserProfile.objects.all(), 1))
+        missing = tasks.missing_file_response('img/card-new.jpg')
+        totals = outbox.drain(self.scripted_engine([missing]))
+        self.assertEqual(totals['retrying'], 1)
+        os.remove(os.path.join(self.media, 'img', 'card-new.jpg'))
+        totals = outbox.drain(tasks.build_delivery_engine, now=timezone.now() + timedelta(hours=1))
+        self.assertEqual(totals['dead'], 1)
+        self.assertEqual(self.telegram.count('sendPhoto'), 3)
+        self.assertIn('Image file not found', OutboundMessage.objects.get(status=OutboundMessage.DEAD).last_error)
+
+    def test_drain_makes_one_attempt_per_message(self):
+        outbox.enqueue(tasks.iter_flashcard_jobs(tasks.UserProfile.objects.all(), 3))
+        self.telegram.failure_rate = 1.0
+        totals = outbox.drain(tasks.build_delivery_engine)
+        # The engine doesn't retry on its own; the outbox schedules the next attempt
+        self.assertEqual((totals['retrying'], totals['engine']['retried']), (3, 0))
+        self.assertEqual(self.telegram.count('sendPhoto'), 3)
+        self.assertEqual(set(OutboundMessage.objects.values_list('attempts', flat=True)), {1})
+
+
+
+class SchedulerCoordinationTests(FakeTelegramTestCase):
+
+    def test_only_one_process_holds_the_poller_lease(self):
+        self.assertIsNotNone(acquire_lease(POLLER_LEASE, 'a', 60))
+        self.assertIsNone(acquire_lease(POLLER_LEASE, 'b', 60))
+        # Renewals store the offset for the next holder
+        renewed = acquire_lease(POLLER_LEASE, 'a', 60, value=17)
+        self.assertEqual((renewed.holder, renewed.value), ('a', 17))
+        SchedulerLease.objects.filter(name=POLLER_LEASE).update(expires_at=timezone.now() - timedelta(seconds=1))
+        taken = acquire_lease(POLLER_LEASE, 'b', 60)
+        self.assertEqual((taken.holder, taken.value), ('b', 17))
+        self.assertIsNone(acquire_lease(POLLER_LEASE, 'a', 60))
+        release_lease(POLLER_LEASE, 'b', value=20)
+        self.assertEqual(acquire_lease(POLLER_LEASE, 'a', 60).value, 20)
+
+    def test_shards_split_the_users_and_send_each_card_once(self):
+        handle, image_path = tempfile.mkstemp(suffix='.jpg')
+        os.write(handle, b'image')
+        os.close(handle)
+        self.addCleanup(os.remove, image_path)
+        now = timezone.now()
+        chats = set()
+        for i in range(7):
+            profile = User.objects.create_user(f"shard{i}", password='pass12345').userprofile
+            # Group chats have negative ids
+            profile.chat_id = -1000 - i if i % 3 == 0 else 100 + i
+            profile.next_delivery_at = now - timedelta(minutes=1)
+            profile.save()
+            chats.add(str(profile.chat_id))
+            for k in range(2):
+                Vocabulary.objects.create(user=profile, word=f"s{i}-{k}", meaning='m')
+
+        with mock.patch.object(tasks, 'DEFAULT_IMAGE_PATH', image_path), \
+                mock.patch.object(tasks, 'file_cache', TelegramFileCache()):
+            delivered = [tasks.deliver_due_profiles(now=now, shard=(index, 3)) for index in range(3)]
+            self.assertEqual(tasks.deliver_due_profiles(now=now), 0)
+        self.assertEqual(sum(delivered), 7)
+        self.assertTrue(all(delivered))
+        sent = [params['chat_id'] for method, params in self.telegram.requests if method == 'sendPhoto' and params]
+        self.assertEqual(self.telegram.count('sendPhoto'), 14)
+        self.assertEqual(set(sent), chats)
+        self.assertEqual(OutboundMessage.objects.filter(status=OutboundMessage.SENT).count(), 14)
+
+    def test_run_scheduler_rejects_a_bad_shard(self):
+        with self.assertRaises(CommandError):
+            call_command('run_scheduler', once=True, shard_index=2, shard_count=2)
+
+    @override_settings(SCHEDULER_LEASE_SECONDS=20)
+    def test_short_lease_only_matters_when_polling(self):
+        with self.assertRaises(CommandError):
+            call_command('run_scheduler', poll_timeout=25, stdout=io.StringIO())
+        with mock.patch.object(run_scheduler, 'deliver_due_profiles', return_value=0) as deliver:
+            call_command('run_scheduler', once=True, poll_timeout=25, stdout=io.StringIO())
+        deliver.assert_called_once_with(shard=None)
+
+
+
+@override_settings(IMAGE_PROCESSING_ASYNC=False, IMAGE_MAX_DIMENSION=200, THUMBNAIL_DIMENSION=40)
+class ImagePipelineTests(TestCase):
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_override = override_settings(MEDIA_ROOT=media.name)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+        self.media = media.name
+        profile = User.objects.create_user('images', password='pass12345').userprofile
+        self.vocab = Vocabulary.objects.create(user=profile, word='w', meaning='m')
+
+    # A 600x300 photo taken with the camera rotated (EXIF orientation 6)
+    def upload(self, name='photo.png', mode='RGBA'):
+        image = Image.new(mode, (600, 300), (200, 10, 10, 128) if mode == 'RGBA' else (200, 10, 10))
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        exif[0x010F] = 'PhoneMaker'
+        output = io.BytesIO()
+        image.save(output, 'PNG' if mode == 'RGBA' else 'JPEG', exif=exif)
+        return SimpleUploadedFile(name, output.getvalue())
+
+    def test_upload_is_downscaled_stripped_and_thumbnailed_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            vocab_image = VocabularyImage.objects.create(vocabulary=self.vocab, image=self.upload())
+            original = os.path.join(self.media, vocab_image.image.name)
+        vocab_image.refresh_from_db()
+        self.assertTrue(vocab_image.processed)
+        self.assertTrue(vocab_image.image.name.endswith('.jpg'))
+        self.assertFalse(os.path.exists(original))
+        with Image.open(vocab_image.image.path) as stored:
+            # Rotated upright by the EXIF orientation, then fitted in 200 px
+            self.assertEqual((stored.format, stored.size), ('JPEG', (100, 200)))
+            self.assertEqual(len(stored.getexif()), 0)
+        with Image.open(vocab_image.thumbnail.path) as thumbnail:
+            self.assertEqual(thumbnail.size, (20, 40))
+        self.assertEqual(vocab_image.display_url, vocab_image.thumbnail.url)
+
+    def test_replacing_the_file_processes_it_again(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            vocab_image = VocabularyImage.objects.create(vocabulary=self.vocab, image=self.upload())
+        vocab_image.refresh_from_db()
+        first_thumbnail = vocab_image.thumbnail.path
+        # Saving other fields doesn't reprocess
+        with mock.patch('core.signals.schedule_processing') as schedule, self.captureOnCommitCallbacks(execute=True):
+            vocab_image.caption = 'seen in a book'
+            vocab_image.save()
+        schedule.assert_not_called()
+        with self.captureOnCommitCallbacks(execute=True):
+            vocab_image.image = self.upload('second.jpg', mode='RGB')
+            vocab_image.save()
+        vocab_image.refresh_from_db()
+        self.assertTrue(vocab_image.processed)
+        self.assertIn('second', vocab_image.image.name)
+        self.assertFalse(os.path.exists(first_thumbnail))
+        self.assertFalse(process_image(vocab_image.id))
+
+
+class AllVocabsPaginationTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('pages', password='pass12345')
+        profile = self.user.userprofile
+        added = timezone.now()
+        # Pairs of words added at the same instant, so the id breaks the tie
+        for i in range(9):
+            vocab = Vocabulary.objects.create(user=profile, word=f'w{i}', meaning='m')
+            Vocabulary.objects.filter(id=vocab.id).update(date_added=added - timedelta(minutes=i // 2))
+            for n in range(i % 3):
+                VocabularyImage.objects.create(vocabulary=vocab, image=f'img/w{i}-{n}.jpg')
+        self.client.force_login(self.user)
+
+    def words(self, response):
+        return [vocab.word for vocab in response.context['vocabs']]
+
+    @override_settings(VOCAB_PAGE_SIZE=4)
+    def test_pages_cover_every_word_once_newest_first(self):
+        seen = []
+        response = self.client.get(reverse('allvocabs'))
+        seen += self.words(response)
+        data = self.client.get(reverse('allvocabs_page'), {'after': response.context['next_cursor']}).json()
+        seen += [item['word'] for item in data['items']]
+        response = self.client.get(reverse('allvocabs'), {'after': data['next']})
+        seen += self.words(response)
+        self.assertIsNone(response.context['next_cursor'])
+        expected = list(Vocabulary.objects.order_by('-date_added', '-id').values_list('word', flat=True))
+        self.assertEqual(seen, expected)
+        # Each word shows its first image only
+        first = VocabularyImage.objects.filter(vocabulary__word='w4').order_by('id').first()
+        item = next(item for item in data['items'] if item['word'] == 'w4')
+        self.assertEqual(item['image'], first.display_url)
+
+    @override_settings(VOCAB_PAGE_SIZE=4)
+    def test_query_count_does_not_grow_with_words_or_images(self):
+        with self.assertNumQueries(2):
+            page = vocab_page(self.user.userprofile.vocabs.all(), page_size=4)
+            images = [vocab.cover_image for vocab in page.items]
+        self.assertEqual(len(images), 4)
+        # Session, user, profile, words, first images: a page of one word costs the same
+        with self.assertNumQueries(5):
+            self.client.get(reverse('allvocabs'))
+        Vocabulary.objects.filter(user=self.user.userprofile).exclude(word='w1').delete()
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('allvocabs'))
+        self.assertEqual(self.words(response), ['w1'])
+
+    def test_bad_cursor(self):
+        self.assertEqual(self.client.get(reverse('allvocabs_page'), {'after': 'nope'}).status_code, 400)
+        self.assertRedirects(self.client.get(reverse('allvocabs'), {'after': 'nope'}), reverse('allvocabs'))
+
+
+class VocabularySearchTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('search', password='pass12345')
+        self.profile = self.user.userprofile
+        self.other = User.objects.create_user('other', password='pass12345').userprofile
+
+    def add(self, word, meaning='', description='', user=None):
+        return Vocabulary.objects.create(user=user or self.profile, word=word, meaning=meaning, description=description)
+
+    def words(self, text, **kwargs):
+        return [vocab.word for vocab in search_vocabularies(self.profile, text, **kwargs).items]
+
+    def test_ranks_word_over_meaning_over_description_and_matches_prefixes(self):
+        self.add('notes', description='a record of something')
+        self.add('record', meaning='a documented account')
+        self.add('register', meaning='an official record')
+        self.add('record', user=self.other)
+        self.assertEqual(self.words('record'), ['record', 'register', 'notes'])
+        # While typing
+        self.assertEqual(self.words('rec'), ['record', 'register', 'notes'])
+        self.assertEqual(self.words('official rec'), ['register'])
+        # Punctuation and FTS syntax are searched as text
+        self.assertEqual(self.words('"rec" OR *'), [])
+        self.assertEqual(self.words(''), [])
+
+    def test_persian_spelling_variants_match(self):
+        self.add('کتاب', meaning='book')
+        self.add('می‌روم', meaning='I go')
+        self.assertEqual(self.words('كتاب'), ['کتاب'])
+        self.assertEqual(self.words('کِتا'), ['کتاب'])
+        self.assertEqual(self.words('میرو'), ['می‌روم'])
+
+    def test_index_follows_edits_and_deletes_and_pages(self):
+        vocab = self.add('apple')
+        vocab.word = 'banana'
+        vocab.save()
+        self.assertEqual(self.words('apple'), [])
+        self.assertEqual(self.words('ban'), ['banana'])
+        vocab.delete()
+        self.assertEqual(self.words('ban'), [])
+
+        for i in range(5):
+            self.add(f'bat{i}')
+        first = search_vocabularies(self.profile, 'bat', page=1, page_size=3)
+        second = search_vocabularies(self.profile, 'bat', page=2, page_size=3)
+        self.assertEqual(first.next_cursor, '2')
+        self.assertIsNone(second.next_cursor)
+        self.assertEqual(len({vocab.id for vocab in first.items + second.items}), 5)
+
+        # Rebuilding from the table gives the same results
+        call_command('rebuild_search_index', stdout=io.StringIO())
+        self.assertEqual(len(self.words('bat')), 5)
+
+    def test_search_views(self):
+        self.add('record', meaning='a documented account')
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('home'), {'q': 'reco'})
+        self.assertEqual([vocab.word for vocab in response.context['vocabs']], ['record'])
+        data = self.client.get(reverse('search_vocabs'), {'q': 'acc'}).json()
+        self.assertEqual([item['word'] for item in data['items']], ['record'])
+        self.assertIsNone(data['next'])
+        self.assertEqual(self.client.get(reverse('search_vocabs'), {'q': 'a', 'page': 'x'}).status_code, 400)
+
+
+@override_settings(IMAGE_PROCESSING_ASYNC=False, IMPORT_ASYNC=False)
+class VocabularyImportTests(TestCase):
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_override = override_settings(MEDIA_ROOT=media.name)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+        self.user = User.objects.create_user('importer', password='pass12345')
+        self.profile = self.user.userprofile
+        Vocabulary.objects.create(user=self.profile, word='Apple', meaning='سیب')
+
+    def words(self):
+        return list(Vocabulary.objects.filter(user=self.profile).order_by('id').values_list('word', flat=True))
+
+    # A minimal Anki 2.1 package: two notes (one reviewed, with an image) and a media map
+    def anki_package(self):
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        path = os.path.join(workdir, 'collection.anki21')
+        database = sqlite3.connect(path)
+        database.executescript(
+            'CREATE TABLE col (crt INTEGER);'
+            'CREATE TABLE notes (id INTEGER PRIMARY KEY, flds TEXT);'
+            'CREATE TABLE cards (id INTEGER PRIMARY KEY, nid INTEGER, ord INTEGER, type INTEGER, due INTEGER,'
+            ' ivl INTEGER, factor INTEGER, reps INTEGER, lapses INTEGER);'
+        )
+        database.execute('INSERT INTO col VALUES (?)', [int(datetime(2026, 1, 1, tzinfo=dt_timezone.utc).timestamp())])
+        database.execute('INSERT INTO notes VALUES (1, ?)', ['ephemeral<br>[sound:e.mp3]\x1fزودگذر <img src="e.png">\x1fLasting a <b>short</b> time'])
+        database.execute('INSERT INTO notes VALUES (2, ?)', ['apple\x1fسیب'])
+        database.execute('INSERT INTO notes VALUES (3, ?)', ['novel\x1fرمان'])
+        database.execute('INSERT INTO cards VALUES (10, 1, 0, 2, 30, 12, 2300, 5, 1)')
+        database.execute('INSERT INTO cards VALUES (11, 3, 0, 0, 3, 0, 0, 0, 0)')
+        database.commit()
+        database.close()
+        image = io.BytesIO()
+        Image.new('RGB', (40, 20), (0, 90, 200)).save(image, 'PNG')
+        package = io.BytesIO()
+        with zipfile.ZipFile(package, 'w') as archive:
+            archive.write(path, 'collection.anki21')
+            archive.writestr('media', json.dumps({'0': 'e.png'}))
+            archive.writestr('0', image.getvalue())
+        package.seek(0)
+        return package
+
+    def test_csv_with_header_skips_duplicates_and_invalid_rows(self):
+        data = (
+            'word,meaning,interval,next_review\n'
+            'apple,سیب,,\n'
+            'Dog,سگ,6,2026-11-01T09:00:00\n'
+            'dog,سگ دوباره,,\n'
+            ',no word,,\n'
+            'کتاب,book,,\n'
+        ).encode()
+        progress_calls = []
+        stats = import_records(self.profile, parse_file(io.BytesIO(data), 'csv'), chunk_size=1, on_progress=progress_calls.append)
+        self.assertEqual(stats.as_dict(), {'rows_read': 5, 'created': 2, 'duplicates': 2, 'invalid': 1, 'images': 0})
+        self.assertEqual(len(progress_calls), 3)
+        self.assertEqual(self.words(), ['Apple', 'Dog', 'کتاب'])
+        progress = UserVocabularyProgress.objects.get(vocabulary__word='Dog')
+        self.assertEqual((progress.interval, progress.next_review.date().isoformat()), (6, '2026-11-01'))
+        self.assertFalse(UserVocabularyProgress.objects.filter(vocabulary__word='کتاب').exists())
+        # Imported words are searchable
+        self.assertEqual([vocab.word for vocab in search_vocabularies(self.profile, 'كتا').items], ['کتاب'])
+
+    def test_json_array_lines_and_headerless_tsv(self):
+        array = json.dumps([{'word': 'one', 'meaning': 'یک'}, 'junk', {'Word': 'two', 'Meaning': 'دو', 'description': 'x'}])
+        stats = import_records(self.profile, parse_file(io.BytesIO(array.encode()), 'json'))
+        self.assertEqual((stats.created, stats.invalid), (2, 1))
+        lines = b'{"word": "three", "meaning": "\xd8\xb3\xd9\x87"}\n\nnot json\n'
+        stats = import_records(self.profile, parse_file(io.BytesIO(lines), 'jsonl'))
+        self.assertEqual((stats.created, stats.invalid), (1, 1))
+        tsv = '#separator:tab\nfour\tچهار\tthe number\n'.encode()
+        import_records(self.profile, parse_file(io.BytesIO(tsv), 'tsv'))
+        self.assertEqual(self.words(), ['Apple', 'one', 'two', 'three', 'four'])
+        self.assertEqual(Vocabulary.objects.get(word='four').description, 'the number')
+        with self.assertRaises(ValueError):
+            list(parse_file(io.BytesIO(b'{"word": "x"}'), 'json'))
+
+    def test_anki_package_brings_images_and_review_history(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            stats = import_records(self.profile, parse_file(self.anki_package(), 'apkg'))
+        self.assertEqual(stats.as_dict(), {'rows_read': 3, 'created': 2, 'duplicates': 1, 'invalid': 0, 'images': 1})
+        vocab = Vocabulary.objects.get(word='ephemeral')
+        self.assertEqual((vocab.meaning, vocab.description), ('زودگذر', 'Lasting a short time'))
+        image = vocab.images.get()
+        # Processed like an upload (inline here)
+        image.refresh_from_db()
+        self.assertTrue(image.processed)
+        progress = UserVocabularyProgress.objects.get(vocabulary=vocab)
+        self.assertEqual((progress.interval, progress.ease_factor, progress.appeared_count, progress.didnt_know_count), (12, 2.3, 5, 1))
+        self.assertEqual(progress.next_review.date().isoformat(), '2026-01-31')
+        # The new card has no history and stays a new word
+        self.assertFalse(UserVocabularyProgress.objects.filter(vocabulary__word='novel').exists())
+
+    @override_settings(IMPORT_MAX_RECORD_KB=1, IMPORT_MAX_COLLECTION_MB=0)
+    def test_oversized_entries_and_collections_are_refused(self):
+        stream = io.BytesIO(b'[{"word": "' + b'x' * 1024 * 1024)
+        with self.assertRaisesMessage(ValueError, 'longer than 1 KB'):
+            list(parse_file(stream, 'json'))
+        # Refused after the first chunk instead of buffering the whole file
+        self.assertLess(stream.tell(), 256 * 1024)
+        with self.assertRaisesMessage(ValueError, 'larger than 0 MB'):
+            list(parse_file(self.anki_package(), 'apkg'))
+
+    def test_interrupted_imports_are_marked_failed(self):
+        now = timezone.now()
+        stale, running = (
+            VocabularyImport.objects.create(
+                user=self.profile, file=SimpleUploadedFile(f"{name}.csv", b'a,b\n'), format='csv',
+                status=VocabularyImport.RUNNING, progress_at=progress_at,
+            )
+            for name, progress_at in (('stale', now - timedelta(hours=1)), ('running', now - timedelta(minutes=1)))
+        )
+        self.client.force_login(self.user)
+        status = self.client.get(reverse('import_status', args=[stale.pk])).json()
+        self.assertEqual(status['status'], 'failed')
+        self.assertIn('interrupted', status['error'])
+        self.assertFalse(stale.file.storage.exists(stale.file.name))
+        self.assertEqual(VocabularyImport.objects.get(pk=running.pk).status, VocabularyImport.RUNNING)
+        self.assertEqual(fail_stale_imports(now=now + timedelta(hours=1)), 1)
+
+    def test_upload_view_and_command(self):
+        self.client.force_login(self.user)
+        upload = SimpleUploadedFile('words.csv', 'pear,گلابی\nplum,آلو\n'.encode())
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('import_vocabulary'), {'file': upload})
+        self.assertRedirects(response, reverse('import_vocabulary'))
+        vocabulary_import = VocabularyImport.objects.get()
+        status = self.client.get(reverse('import_status', args=[vocabulary_import.pk])).json()
+        self.assertEqual((status['status'], status['created']), ('done', 2))
+        self.assertFalse(vocabulary_import.file.storage.exists(vocabulary_import.file.name))
+        response = self.client.post(reverse('import_vocabulary'), {'file': SimpleUploadedFile('words.xlsx', b'x')})
+        self.assertFormError(response.context['form'], 'file', "Unsupported file type '.xlsx'; use CSV, TSV, JSON, JSON Lines or an Anki .apkg.")
+
+        path = os.path.join(tempfile.mkdtemp(), 'more.jsonl')
+        self.addCleanup(os.remove, path)
+        with open(path, 'w') as export:
+            export.write('{"word": "fig", "meaning": "انجیر"}\n')
+        out = io.StringIO()
+        call_command('import_vocabulary', 'importer', path, stdout=out)
+        self.assertIn('1 words and 0 images added', out.getvalue())
+        self.assertIn('fig', self.words())
+
+
+class BenchmarkHarnessTests(TestCase):
+
+    def test_fake_server_injects_rate_limits_and_failures(self):
+        with FakeTelegramServer(rate_limit_rate=0.3, failure_rate=0.2, retry_after=7, seed=3) as telegram:
+            with override_settings(TELEGRAM_API_URL=telegram.url, TELEGRAM_RETRIES=0):
+                reset_client()
+                self.addCleanup(reset_client)
+                responses = [tasks.post_telegram_request('sendMessage', {'chat_id': 1, 'text': 'x'}) for _ in range(200)]
+                # getUpdates is never failed on purpose
+                self.assertEqual(tasks.get_updates(timeout=0), [])
+        codes = [response.get('error_code') for response in responses]
+        self.assertEqual(codes.count(429), telegram.injected[429])
+        self.assertEqual(codes.count(502), telegram.injected[502])
+        self.assertTrue(40 <= codes.count(429) <= 80 and 20 <= codes.count(502) <= 60, codes)
+        self.assertEqual(next(r for r in responses if r.get('error_code') == 429)['parameters'], {'retry_after': 7})
+
+    def test_query_counter_sees_other_threads(self):
+        with count_queries() as queries:
+            list(User.objects.all())
+            worker = threading.Thread(target=lambda: (list(User.objects.all()), connection.close()))
+            worker.start()
+            worker.join()
+        self.assertEqual(queries.count, 2)
+        summary = latency_summary([0.001 * i for i in range(1, 101)], elapsed=2.0)
+        self.assertEqual((summary['per_second'], summary['latency_p50_ms'], summary['latency_p99_ms']), (50.0, 50.0, 99.0))
+
+
+
+class MetricsTests(FakeTelegramTestCase):
+
+    def setUp(self):
+        super().setUp()
+        metrics.registry.reset()
+
+    def test_registry_renders_prometheus_text(self):
+        registry = metrics.Registry()
+        calls = registry.counter('calls_total', 'Calls.', ('method',))
+        latency = registry.histogram('latency_seconds', 'Latency.', ('method',), buckets=(0.1, 1.0))
+        calls.inc(method='sendPhoto')
+        calls.inc(2, method='say "hi"')
+        for seconds in (0.05, 0.5, 3.0):
+            latency.observe(seconds, method='sendPhoto')
+        text = registry.render()
+        self.assertIn('# TYPE calls_total counter\ncalls_total{method="say \\"hi\\""} 2\ncalls_total{method="sendPhoto"} 1\n', text)
+        self.assertIn('latency_seconds_bucket{method="sendPhoto",le="0.1"} 1\n', text)
+        self.assertIn('latency_seconds_bucket{method="sendPhoto",le="1"} 2\n', text)
+        self.assertIn('latency_seconds_bucket{method="sendPhoto",le="+Inf"} 3\n', text)
+        self.assertIn('latency_seconds_count{method="sendPhoto"} 3\n', text)
+        with self.assertRaises(ValueError):
+            calls.inc(chat='1')
+
+        with metrics.span('batch'):
+            with metrics.span('send'):
+                pass
+        self.assertEqual(metrics.SPAN_LATENCY.count(span='batch/send'), 1)
+        self.assertEqual(metrics.SPAN_LATENCY.count(span='batch'), 1)
+
+    def test_bot_pipeline_is_instrumented(self):
+        dispatch_update({'update_id': 1, 'message': {'message_id': 1, 'chat': {'id': 5}, 'from': {'id': 5}, 'text': 'hi'}})
+        dispatch_update({'update_id': 2, 'edited_message': {}})
+        # An unknown file_id is answered with a 400
+        tasks.post_telegram_request('sendPhoto', {'chat_id': 5, 'photo': 'unknown'})
+        self.assertEqual(metrics.UPDATES.value(kind='message', outcome='ok'), 1)
+        self.assertEqual(metrics.UPDATES.value(kind='other', outcome='ignored'), 1)
+        self.assertEqual(metrics.UPDATE_LATENCY.count(kind='message'), 1)
+        self.assertEqual(metrics.TELEGRAM_REQUESTS.value(method='sendMessage', outcome='ok'), 1)
+        self.assertEqual(metrics.TELEGRAM_REQUESTS.value(method='sendPhoto', outcome='400'), 1)
+        self.assertEqual(metrics.TELEGRAM_LATENCY.count(method='sendPhoto'), 1)
+        # Looking up the sender's profile is one query on the profile table
+        self.assertEqual(metrics.DB_QUERY_LATENCY.count(group='SELECT core_userprofile'), 1)
+        self.assertEqual(metrics.query_group('UPDATE "core_outboundmessage" SET "status" = %s'), 'UPDATE core_outboundmessage')
+
+    def test_metrics_endpoint_needs_a_token_or_an_opt_in(self):
+        tasks.send_text_message(5, 'hello')
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        with override_settings(METRICS_ALLOW_LOCAL=True):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('vocabbot_telegram_requests_total{method="sendMessage",outcome="ok"} 1', response.content.decode())
+            self.assertEqual(self.client.get(url, REMOTE_ADDR='10.0.0.8').status_code, 403)
+            # A reverse proxy connects from localhost on behalf of anyone
+            self.assertEqual(self.client.get(url, HTTP_X_FORWARDED_FOR='203.0.113.9').status_code, 403)
+        with override_settings(METRICS_TOKEN='s3cret'):
+            self.assertEqual(self.client.get(url).status_code, 403)
+            self.assertEqual(self.client.get(url, REMOTE_ADDR='10.0.0.8', HTTP_AUTHORIZATION='Bearer s3cret').status_code, 200)
+
+
+
+@override_settings(QUERY_PROFILER=True, QUERY_PROFILER_STRICT=True, QUERY_PROFILER_MAX_QUERIES=8, QUERY_PROFILER_MAX_DUPLICATES=0)
+class QueryProfilerTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('profiled', password='pass12345')
+        for i in range(3):
+            self.vocab = Vocabulary.objects.create(user=self.user.userprofile, word=f'word{i}', meaning='m')
+            for n in range(2):
+                VocabularyImage.objects.create(vocabulary=self.vocab, image=f'img/w{i}-{n}.jpg')
+        self.client.force_login(self.user)
+        recent_profiles.clear()
+        self.profile_file = os.path.join(tempfile.mkdtemp(), 'profiles.jsonl')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.profile_file))
+
+    # Strict mode: a view that starts repeating queries (an N+1 in its template) fails here
+    def test_pages_stay_within_the_query_budget(self):
+        pages = [
+            ('home', reverse('home'), {}),
+            ('home', reverse('home'), {'q': 'word'}),
+            ('allvocabs', reverse('allvocabs'), {}),
+            ('vocab_detail', reverse('vocab_detail', args=[self.vocab.id]), {}),
+            ('search_vocabs', reverse('search_vocabs'), {'q': 'wo'}),
+        ]
+        with override_settings(QUERY_PROFILER_FILE=self.profile_file):
+            for _, url, params in pages:
+                self.assertEqual(self.client.get(url, params).status_code, 200)
+        self.assertEqual([record['endpoint'] for record in recent_profiles], [name for name, _, _ in pages])
+        self.assertTrue(all(record['duplicates'] == 0 for record in recent_profiles))
+        detail = recent_profiles[3]
+        self.assertGreater(detail['render_ms'], 0)
+        # The image formset is read while the template renders
+        self.assertGreaterEqual(detail['render_queries'], 1)
+
+        output = io.StringIO()
+        call_command('query_report', '--file', self.profile_file, '--json', '--max-queries', '8', stdout=output)
+        self.assertEqual({summary['endpoint'] for summary in json.loads(output.getvalue())},
+                         {'home', 'allvocabs', 'vocab_detail', 'search_vocabs'})
+
+        with override_settings(QUERY_PROFILER_MAX_QUERIES=3):
+            with self.assertRaises(QueryBudgetExceeded):
+                self.client.get(reverse('allvocabs'))
+
+    def test_repeated_queries_are_reported(self):
+        profile = RequestProfile()
+        with connection.execute_wrapper(profile):
+            # An N+1: one query per word for its profile
+            owners = [vocab.user for vocab in Vocabulary.objects.all()]
+            list(VocabularyImage.objects.filter(id__in=[1, 2, 3]))
+            list(VocabularyImage.objects.filter(id__in=[4]))
+        self.assertEqual((len(owners), profile.queries, profile.duplicates), (3, 6, 3))
+        record = profile.record('n_plus_one', 'GET', 200, 0.01)
+        self.assertEqual([count for _, count in record['repeated']], [3, 2])
+        self.assertIn('IN (...)', record['repeated'][1][0])
+
+        append_profile(self.profile_file, record)
+        output = io.StringIO()
+        call_command('query_report', '--file', self.profile_file, stdout=output)
+        self.assertIn('n_plus_one', output.getvalue())
+        with self.assertRaisesMessage(CommandError, 'n_plus_one: 3 duplicate queries > 0'):
+            call_command('query_report', '--file', self.profile_file, '--max-duplicates', '0', stdout=io.StringIO())
+
+    def test_profile_file_is_rotated_at_its_size_limit(self):
+        for i in range(5):
+            append_profile(self.profile_file, {'endpoint': f"page{i}", 'padding': 'x' * 40}, max_bytes=150)
+        sizes = [os.path.getsize(name) for name in (self.profile_file, f"{self.profile_file}.1")]
+        self.assertTrue(all(size < 300 for size in sizes), sizes)
+        # The report reads the rotated file first, then the current one
+        self.assertEqual([record['endpoint'] for record in read_profiles(self.profile_file)], ['page2', 'page3', 'page4'])
+
+
+
+class DashboardCacheTests(TestCase):
+
+    def setUp(self):
+        # A cache the bot's process shares, as in production
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        cache_override = override_settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': cache_dir.name,
+        }})
+        cache_override.enable()
+        self.addCleanup(cache_override.disable)
+        get_cache().clear()
+        metrics.registry.reset()
+        self.user = User.objects.create_user('dashboard', password='pass12345')
+        self.profile = self.user.userprofile
+        self.vocabs = [Vocabulary.objects.create(user=self.profile, word=f'word{i}', meaning='m') for i in range(4)]
+        self.image = VocabularyImage.objects.create(vocabulary=self.vocabs[-1], image='img/cover.jpg')
+        self.client.force_login(self.user)
+
+    def home(self):
+        response = self.client.get(reverse('home'))
+        return [vocab.word for vocab in response.context['vocabs']], response.context['counts']
+
+    def lookups(self, fragment):
+        return (DASHBOARD_CACHE.value(fragment=fragment, result='hit'), DASHBOARD_CACHE.value(fragment=fragment, result='miss'))
+
+    def test_fragments_are_cached_until_their_data_changes(self):
+        self.assertEqual(self.home(), (['word3', 'word2', 'word1'], {'words': 4, 'new': 4, 'due': 0}))
+        # Session, user and profile only: both fragments come from the cache
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('home'))
+        self.assertContains(response, self.image.display_url)
+        self.assertEqual((self.lookups('latest_words'), self.lookups('review_counts')), ((1, 1), (1, 1)))
+
+        # A review only invalidates the fragments built from the progress (the
+        # card is due again tomorrow)
+        tasks.record_review(self.profile, self.vocabs[0].id, None, 'didnt_know', message_id=1)
+        self.assertEqual(self.home(), (['word3', 'word2', 'word1'], {'words': 4, 'new': 3, 'due': 0}))
+        self.assertEqual((self.lookups('latest_words'), self.lookups('review_counts')), ((2, 1), (1, 2)))
+
+        Vocabulary.objects.create(user=self.profile, word='fresh', meaning='m')
+        self.assertEqual(self.home(), (['fresh', 'word3', 'word2'], {'words': 5, 'new': 4, 'due': 0}))
+        self.image.delete()
+        self.assertNotContains(self.client.get(reverse('home')), 'cover.jpg')
+        self.vocabs[3].delete()
+        self.assertEqual(self.home(), (['fresh', 'word2', 'word1'], {'words': 4, 'new': 3, 'due': 0}))
+
+        # Writes that skip signals invalidate explicitly
+        records = [ImportRecord('imported', 'm')]
+        import_records(self.profile, records)
+        self.assertEqual(self.home()[0][0], 'imported')
+        misses = self.lookups('review_counts')[1]
+        invalidate_all()
+        self.home()
+        self.assertEqual(self.lookups('review_counts')[1], misses + 1)
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'eviction',
+        'OPTIONS': {'MAX_ENTRIES': 20, 'CULL_FREQUENCY': 2},
+    }})
+    def test_entries_are_culled_past_max_entries(self):
+        cache = get_cache()
+        for user_id in range(100):
+            self.assertEqual(cached_fragment(user_id, 'answer', ('vocabulary',), lambda: user_id * 2), user_id * 2)
+        self.assertLessEqual(len(cache._cache), 20)
+        # Culled version tokens only cause misses, never stale values
+        for user_id in range(100):
+            self.assertEqual(cached_fragment(user_id, 'answer', ('vocabulary',), lambda: user_id * 2), user_id * 2)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'local'}})
+    def test_progress_fragments_are_not_cached_per_process(self):
+        # The bot's process records answers, and its invalidations can't reach this cache
+        self.home()
+        with self.assertNumQueries(5):
+            self.home()
+        tasks.record_review(self.profile, self.vocabs[0].id, None, 'knew', message_id=1)
+        self.assertEqual(self.home()[1]['new'], 3)
+        self.assertEqual((self.lookups('latest_words'), self.lookups('review_counts')), ((2, 1), (0, 0)))
+        self.assertEqual(DASHBOARD_CACHE.value(fragment='review_counts', result='uncached'), 3)
+
+
+
+class UserStatsTests(FakeTelegramTestCase):
+
+    def setUp(self):
+        super().setUp()
+        get_cache().clear()
+        self.user = User.objects.create_user('learner', password='pass12345')
+        self.profile = self.user.userprofile
+        self.profile.chat_id = 4242
+        self.profile.timezone = 'Asia/Tehran'
+        self.profile.save()
+        self.vocabs = [Vocabulary.objects.create(user=self.profile, word=f'word{i}', meaning='m') for i in range(3)]
+
+    def answer(self, vocab, action, message_id):
+        tasks.handle_callback_query({'update_id': message_id, 'callback_query': {
+            'id': f'cb{message_id}', 'from': {'id': 4242}, 'data': f'{action}:{vocab.id}:none',
+            'message': {'message_id': message_id, 'chat': {'id': 4242}},
+        }})
+
+    def test_answers_update_the_totals_and_todays_row(self):
+        self.answer(self.vocabs[0], 'knew', 1)
+        self.answer(self.vocabs[0], 'knew', 1)  # a double click counts once
+        self.answer(self.vocabs[0], 'didnt_know', 2)
+        self.answer(self.vocabs[1], 'knew', 3)
+        stats = UserStats.objects.get(user=self.profile)
+        self.assertEqual((stats.reviews, stats.knew, stats.didnt_know, stats.cards_reviewed), (3, 2, 1, 2))
+        self.assertEqual((stats.retention, stats.current_streak, stats.last_review_date), (66.7, 1, local_day(self.profile)))
+        daily = UserStatsDaily.objects.get(user=self.profile)
+        self.assertEqual((daily.day, daily.reviews, daily.knew, daily.didnt_know, daily.new_cards), (local_day(self.profile), 3, 2, 1, 2))
+
+        # The rebuild from the progress rows agrees with the incremental totals
+        UserStats.objects.all().delete()
+        # A page of ids, the totals, the days, the upsert (in a savepoint) and the empty next page
+        with self.assertNumQueries(7):
+            self.assertEqual(rebuild_stats(chunk_size=10), 1)
+        rebuilt = UserStats.objects.get(user=self.profile)
+        self.assertEqual(
+            (rebuilt.reviews, rebuilt.knew, rebuilt.didnt_know, rebuilt.cards_reviewed, rebuilt.current_streak, rebuilt.last_review_date),
+            (3, 2, 1, 2, 1, local_day(self.profile)),
+        )
+
+    def test_streaks_follow_the_users_days(self):
+        # 21:00 UTC is already the next day in Tehran
+        start = datetime(2026, 3, 1, 21, 0, tzinfo=dt_timezone.utc)
+        for days in (0, 0, 1, 2, 4):
+            record_answer(self.profile, True, first_review=False, now=start + timedelta(days=days))
+        stats = UserStats.objects.get(user=self.profile)
+        self.assertEqual((stats.current_streak, stats.longest_streak), (1, 3))
+        self.assertEqual(stats.last_review_date, datetime(2026, 3, 6).date())
+        self.assertEqual(stats.streak_on(datetime(2026, 3, 7).date()), 1)
+        self.assertEqual(stats.streak_on(datetime(2026, 3, 8).date()), 0)
+        self.assertEqual(list(UserStatsDaily.objects.order_by('day').values_list('reviews', flat=True)), [2, 1, 1, 1])
+        # Streaks are rebuilt from the daily rows
+        UserStats.objects.filter(user=self.profile).update(current_streak=0, longest_streak=0)
+        call_command('rebuild_stats', 'learner', stdout=io.StringIO())
+        stats.refresh_from_db()
+        self.assertEqual((stats.current_streak, stats.longest_streak), (1, 3))
+
+    def test_stats_page_and_bot_command(self):
+        self.answer(self.vocabs[0], 'knew', 1)
+        self.answer(self.vocabs[1], 'didnt_know', 2)
+        self.client.force_login(self.user)
+        self.client.get(reverse('stats'))
+        # Session, user, profile, totals, today's row, the 30-day history and the due
+        # counts (two queries: the default locmem cache doesn't keep them)
+        with self.assertNumQueries(8):
+            response = self.client.get(reverse('stats'))
+        self.assertEqual(response.context['stats']['reviews'], 2)
+        self.assertEqual(response.context['stats']['new'], 1)
+        self.assertEqual(len(response.context['history']), 30)
+        self.assertEqual(response.context['history'][-1].reviews, 2)
+        self.assertContains(response, '50.0%')
+
+        tasks.handle_message({'update_id': 3, 'message': {'message_id': 3, 'chat': {'id': 4242}, 'from': {'id': 4242}, 'text': '/stats'}})
+        method, params = self.telegram.requests[-1]
+        self.assertEqual(method, 'sendMessage')
+        self.assertIn('Answers: 2 (remembered 50.0%)', params['text'])
+        self.assertIn('Streak: 1 days', params['text'])
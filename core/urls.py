@@ -4,12 +4,19 @@ from . import views
 urlpatterns = [
     path('', views.home , name = 'home'),
     path('add/', views.add_vocabulary, name='add_vocabulary'),
+    path('import/', views.import_vocabulary, name='import_vocabulary'),
+    path('import/<int:pk>/status/', views.import_status, name='import_status'),
     path('login/', views.login_view, name='login'),
     path('logout/', views.logout_view, name='logout'),
     path('register/', views.register_view, name='register'),
     path('link-telegram/', views.link_telegram, name='link_telegram'),
     path('vocab_detail/<int:pk>', views.vocab_detail, name = 'vocab_detail'),
     path('allvocabs/' , views.allvocabs, name = 'allvocabs'),
+    path('allvocabs/page/', views.allvocabs_page, name = 'allvocabs_page'),
+    path('search/', views.search_vocabs, name = 'search_vocabs'),
+    path('stats/', views.stats, name = 'stats'),
     path('delete_vocab/<int:pk>', views.delete_vocab, name = 'delete_vocab'),
+    path('telegram/webhook/', views.telegram_webhook, name = 'telegram_webhook'),
+    path('metrics/', views.metrics, name = 'metrics'),
   
 ]
\ No newline at end of file
@@ -4,18 +4,39 @@ from django.contrib.auth.forms import AuthenticationForm
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from .forms import VocabularyForm, CustomRegistrationForm, VocabularyImageFormSet
-from .models import Vocabulary, UserProfile , UserVocabularyProgress
+from .models import Vocabulary, UserProfile , UserVocabularyProgress, VocabularyImport
 from django.utils import timezone
 from django.db import transaction
-from django.db.models import Q
-from .forms import CustomLoginForm
+from .forms import CustomLoginForm, DeliveryPreferencesForm, VocabularyImportForm
 from django.contrib.auth.models import User
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from .dispatch import get_dispatcher
+from .pagination import vocab_page
+from .search import search_vocabularies
+from .importers import fail_stale_imports, schedule_import
+from .dashboard import latest_words, review_counts
+from .stats import daily_history, stats_summary
+from .metrics import registry
+import hmac
+import json
+import logging
+import queue
+
+
+logger = logging.getLogger(__name__)
 
 
 @login_required
 def home(request):
     user = request.user
     chat_id = None
+    search_query = None
+    next_page = None
+    counts = None
     vocabs = Vocabulary.objects.none()
     if user.is_authenticated:
         try:
@@ -24,46 +45,90 @@ def home(request):
             # Get the search query from the URL parameter 'q'
             search_query = request.GET.get('q') 
             if search_query:
-                search_conditions = (
-                    Q(word__icontains=search_query) |
-                    Q(meaning__icontains=search_query) |
-                    Q(description__icontains=search_query)
-                )
-                # Combine user filter with search conditions
-                vocabs = Vocabulary.objects.filter(
-                    Q(user=user_profile) & search_conditions
-                ).order_by('-date_added')
+                # Ranked full-text search of the user's words (core.search)
+                try:
+                    page_number = max(1, int(request.GET.get('page', 1)))
+                except ValueError:
+                    page_number = 1
+                results = search_vocabularies(user_profile, search_query, page_number, settings.VOCAB_PAGE_SIZE)
+                vocabs = results.items
+                next_page = results.next_cursor
             else:
-                vocabs = Vocabulary.objects.filter(user=user_profile).order_by('-date_added')[:3]
+                # Cached per user, see core.dashboard
+                vocabs = latest_words(user_profile)
+                counts = review_counts(user_profile)
                 
         except UserProfile.DoesNotExist:
-            print(f"UserProfile for user {user.username} not found.")   
-            pass
-    else:
-        print("User is not authenticated.")
+            logger.warning("UserProfile for user %s not found.", user.username)
 
     context = {
         'chat_id': chat_id,
         'vocabs': vocabs,  
-        'search_query': search_query
+        'search_query': search_query,
+        'next_page': next_page,
+        'counts': counts,
     }
     return render(request, 'core/home.html', context)
 
 
 
+# Lists the user's words, newest first, one keyset page at a time (?after=<cursor>)
 @login_required
 def allvocabs(request):
     user = request.user
     user_profile = UserProfile.objects.get(user = user)
-    # access the vocabs through the related_name vocabs
-    vocabs = user_profile.vocabs.all().order_by('-date_added')
+    try:
+        page = vocab_page(user_profile.vocabs.all(), request.GET.get('after'), settings.VOCAB_PAGE_SIZE)
+    except ValueError:
+        return redirect('allvocabs')
     context = {
-        'vocabs': vocabs
+        'vocabs': page.items,
+        'next_cursor': page.next_cursor,
     }
     return render(request, 'core/allvocabs.html', context)
 
 
 
+# A word as listed by the JSON endpoints
+def vocab_json(vocab):
+    image = vocab.cover_image
+    return {
+        'id': vocab.id,
+        'word': vocab.word,
+        'url': reverse('vocab_detail', args=[vocab.id]),
+        'image': image.display_url if image else None,
+    }
+
+
+
+# The next page of allvocabs as JSON, for infinite scrolling
+@login_required
+def allvocabs_page(request):
+    user_profile = get_object_or_404(UserProfile, user=request.user)
+    try:
+        page = vocab_page(user_profile.vocabs.all(), request.GET.get('after'), settings.VOCAB_PAGE_SIZE)
+    except ValueError:
+        return HttpResponseBadRequest('Invalid cursor')
+    items = [vocab_json(vocab) for vocab in page.items]
+    return JsonResponse({'items': items, 'next': page.next_cursor})
+
+
+
+# Search results as JSON (?q=&page=), for showing matches while the user types
+@login_required
+def search_vocabs(request):
+    user_profile = get_object_or_404(UserProfile, user=request.user)
+    try:
+        page_number = int(request.GET.get('page', 1))
+    except ValueError:
+        return HttpResponseBadRequest('Invalid page')
+    if page_number < 1:
+        return HttpResponseBadRequest('Invalid page')
+    results = search_vocabularies(user_profile, request.GET.get('q', ''), page_number, settings.VOCAB_PAGE_SIZE)
+    return JsonResponse({'items': [vocab_json(vocab) for vocab in results.items], 'next': results.next_cursor})
+
+
+
 @login_required
 def vocab_detail(request, pk):
     vocab = get_object_or_404(Vocabulary, pk=pk)
@@ -95,6 +160,18 @@ def vocab_detail(request, pk):
 
 
 
+# The user's learning statistics, read from the precomputed UserStats rows
+@login_required
+def stats(request):
+    user_profile = get_object_or_404(UserProfile, user=request.user)
+    context = {
+        'stats': stats_summary(user_profile),
+        'history': daily_history(user_profile),
+    }
+    return render(request, 'core/stats.html', context)
+
+
+
 @login_required
 def link_telegram(request):
     user_profile, created = UserProfile.objects.get_or_create(user=request.user)
@@ -103,6 +180,17 @@ def link_telegram(request):
         if 'generate_token' in request.POST:
             token = user_profile.generate_telegram_token()
       
+        elif 'save_delivery' in request.POST:
+            delivery_form = DeliveryPreferencesForm(request.POST, instance=user_profile)
+            if not delivery_form.is_valid():
+                return render(request, 'core/link_telegram.html', {
+                    'user_profile': user_profile,
+                    'current_token': None,
+                    'delivery_form': delivery_form,
+                })
+            delivery_form.save()
+            messages.success(request, 'زمان ارسال لغات ذخیره شد.')
+
         elif 'clear_link' in request.POST:
             user_profile.clear_telegram_token()
             user_profile.telegram_id = None
@@ -119,7 +207,8 @@ def link_telegram(request):
 
     context = {
         'user_profile': user_profile,
-        'current_token': token
+        'current_token': token,
+        'delivery_form': DeliveryPreferencesForm(instance=user_profile),
     }
     return render(request, 'core/link_telegram.html', context)
 
@@ -140,7 +229,7 @@ def add_vocabulary(request):
                 vocabulary_item.user = user_profile 
 
             except UserProfile.DoesNotExist:
-                print("Could not find the associated UserProfile for account. Cannot save word.")
+                logger.warning("UserProfile for user %s not found. Cannot save the word.", request.user.username)
                 return render(request, 'core/add_vocabulary.html', {'form': form})
       
             vocabulary_item.save()
@@ -159,6 +248,46 @@ def add_vocabulary(request):
 
 
 
+# Upload form for importing words from a file, and the user's recent imports
+@login_required
+def import_vocabulary(request):
+    user_profile = get_object_or_404(UserProfile, user=request.user)
+    if request.method == 'POST':
+        form = VocabularyImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            with transaction.atomic():
+                vocabulary_import = VocabularyImport.objects.create(
+                    user=user_profile, file=form.cleaned_data['file'], format=form.cleaned_data['format'],
+                )
+                schedule_import(vocabulary_import.id)
+            messages.success(request, "Your file is being imported.")
+            return redirect('import_vocabulary')
+    else:
+        form = VocabularyImportForm()
+    fail_stale_imports(user_profile)
+    imports = user_profile.imports.order_by('-created_at')[:10]
+    return render(request, 'core/import_vocabulary.html', {'form': form, 'imports': imports})
+
+
+
+# Progress of one of the user's imports as JSON, polled by the import page
+@login_required
+def import_status(request, pk):
+    vocabulary_import = get_object_or_404(VocabularyImport, pk=pk, user__user=request.user)
+    if vocabulary_import.status == VocabularyImport.RUNNING and fail_stale_imports(vocabulary_import.user):
+        vocabulary_import.refresh_from_db()
+    return JsonResponse({
+        'status': vocabulary_import.status,
+        'rows_read': vocabulary_import.rows_read,
+        'created': vocabulary_import.created_count,
+        'duplicates': vocabulary_import.duplicate_count,
+        'invalid': vocabulary_import.invalid_count,
+        'images': vocabulary_import.image_count,
+        'error': vocabulary_import.error,
+    })
+
+
+
 @login_required
 def delete_vocab(request, pk):
     vocab = Vocabulary.objects.get(pk = pk)
@@ -178,7 +307,6 @@ def login_view(request):
             password = form.cleaned_data.get('password')
             # Django's authenticate function
             user = authenticate(request, username=username, password=password)
-            print('Authentication result:', user)
 
             if user is not None:
                 # Log the user in to establish a session
@@ -223,11 +351,60 @@ def register_view(request):
                
             except Exception as e:
                 messages.error(request, f"خطایی در ثبت نام رخ داده است")
-                print(f"An error occurred during registration: {e}")
+                logger.exception("Registration of %s failed", username)
     else: 
         form = CustomRegistrationForm()
     return render(request, 'core/register.html', {'form': form})
 
 
 
+PROXY_HEADERS = ('X-Forwarded-For', 'X-Real-IP', 'Forwarded')
+
+
+def is_proxied(request):
+    return any(header in request.headers for header in PROXY_HEADERS)
+
+
+# This process's metrics in the Prometheus text format. With METRICS_TOKEN set the
+# scraper must send it as a bearer token. Without one they are only served if
+# METRICS_ALLOW_LOCAL opts in, to local requests that didn't come through a proxy
+# (behind nginx every request comes from localhost).
+def metrics(request):
+    token = settings.METRICS_TOKEN
+    if token:
+        received = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        if not hmac.compare_digest(received, token):
+            return HttpResponseForbidden()
+    elif not settings.METRICS_ALLOW_LOCAL:
+        return HttpResponseForbidden('Set METRICS_TOKEN to scrape the metrics.')
+    elif request.META.get('REMOTE_ADDR') not in ('127.0.0.1', '::1') or is_proxied(request):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+
+# Receives Telegram updates when the bot runs in webhook mode.
+# Telegram echoes the secret given to setWebhook in the X-Telegram-Bot-Api-Secret-Token
+# header; anything else is rejected. The update is queued for the background
+# dispatcher and acknowledged right away so Telegram never waits on the handlers.
+@csrf_exempt
+@require_POST
+def telegram_webhook(request):
+    secret = settings.TELEGRAM_WEBHOOK_SECRET
+    received = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not secret or not hmac.compare_digest(received, secret):
+        return HttpResponseForbidden()
+    try:
+        update = json.loads(request.body)
+    except ValueError:
+        return HttpResponseBadRequest()
+    if not isinstance(update, dict) or 'update_id' not in update:
+        return HttpResponseBadRequest()
+
+    try:
+        get_dispatcher().submit(update, timeout=settings.UPDATE_QUEUE_PUT_TIMEOUT)
+    except queue.Full:
+        # Backpressure: Telegram redelivers the update later
+        return HttpResponse(status=503)
+    return HttpResponse(status=200)
 
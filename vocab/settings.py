@@ -31,6 +31,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Opt-in, see QUERY_PROFILER below
+    'core.profiling.QueryProfilerMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -64,7 +66,13 @@ WSGI_APPLICATION = 'vocab.wsgi.application'
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': config('DATABASE_NAME', default=str(BASE_DIR / 'db.sqlite3')),
+        'OPTIONS': {
+            # Several scheduler processes write at once: wait for the lock instead of
+            # failing, and take it at BEGIN so a transaction can't deadlock on upgrade
+            'timeout': 20,
+            'transaction_mode': 'IMMEDIATE',
+        },
     }
 }
 
@@ -98,5 +106,156 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Telegram Bot API client
+TELEGRAM_API_KEY = config('API_KEY', default='')
+TELEGRAM_API_URL = config('TELEGRAM_API_URL', default='https://api.telegram.org')
+#TELEGRAM_API_URL ='https://myworker.hgh5310.workers.dev'
+# Webhook mode (see 'manage.py set_update_mode'): public HTTPS URL of the
+# telegram_webhook view and the secret Telegram must send back with every update
+TELEGRAM_WEBHOOK_URL = config('TELEGRAM_WEBHOOK_URL', default='')
+TELEGRAM_WEBHOOK_SECRET = config('TELEGRAM_WEBHOOK_SECRET', default='')
+# Keep-alive connections shared by the poller and the delivery workers; keep it above
+# DELIVERY_WORKERS so workers don't queue for a connection
+TELEGRAM_POOL_SIZE = config('TELEGRAM_POOL_SIZE', default=32, cast=int)
+TELEGRAM_CONNECT_TIMEOUT = config('TELEGRAM_CONNECT_TIMEOUT', default=5, cast=float)
+TELEGRAM_READ_TIMEOUT = config('TELEGRAM_READ_TIMEOUT', default=30, cast=float)
+# Retries (with jittered backoff) of requests that never got sent, and of read-only
+# methods after a timeout or a 5xx response (see core.telegram_client)
+TELEGRAM_RETRIES = config('TELEGRAM_RETRIES', default=2, cast=int)
+
+# Incoming updates: handler threads and the bounded per-worker queue size.
+# The webhook answers 503 (Telegram retries later) if a queue stays full this long;
+# the poller renews its lease this often while it waits for room.
+UPDATE_WORKERS = config('UPDATE_WORKERS', default=4, cast=int)
+UPDATE_QUEUE_SIZE = config('UPDATE_QUEUE_SIZE', default=100, cast=int)
+UPDATE_QUEUE_PUT_TIMEOUT = config('UPDATE_QUEUE_PUT_TIMEOUT', default=2, cast=float)
+
+# Telegram delivery: concurrency and rate limits of the daily flashcard batch.
+# Telegram allows about 30 messages per second overall and 1 per second per chat.
+DELIVERY_WORKERS = config('DELIVERY_WORKERS', default=16, cast=int)
+TELEGRAM_GLOBAL_RATE = config('TELEGRAM_GLOBAL_RATE', default=30, cast=float)
+TELEGRAM_CHAT_RATE = config('TELEGRAM_CHAT_RATE', default=1, cast=float)
+
+# Per-user delivery windows (see core.delivery_schedule): the scheduler wakes up
+# every DELIVERY_TICK_SECONDS and sends to the users whose slot has come, at most
+# DELIVERY_SLICE_SIZE users per query. A slot missed by more than
+# DELIVERY_MAX_LATENESS_MINUTES (e.g. the scheduler was down overnight) is skipped.
+DELIVERY_TICK_SECONDS = config('DELIVERY_TICK_SECONDS', default=60, cast=int)
+DELIVERY_SLICE_SIZE = config('DELIVERY_SLICE_SIZE', default=200, cast=int)
+DELIVERY_MAX_LATENESS_MINUTES = config('DELIVERY_MAX_LATENESS_MINUTES', default=720, cast=int)
+
+# Several run_scheduler processes: the getUpdates poller is elected through a lease
+# of this many seconds, renewed on every poll (so it must exceed the poll timeout)
+SCHEDULER_LEASE_SECONDS = config('SCHEDULER_LEASE_SECONDS', default=60, cast=int)
+
+# Outbox (core.outbox): rows claimed per batch, attempts before a message is moved
+# to the dead letters, the exponential backoff between attempts, how long a
+# claimed row may stay unsent before it is assumed its drain crashed, and the days
+# sent and dead rows are kept (0 keeps them forever).
+OUTBOX_BATCH_SIZE = config('OUTBOX_BATCH_SIZE', default=200, cast=int)
+OUTBOX_MAX_ATTEMPTS = config('OUTBOX_MAX_ATTEMPTS', default=5, cast=int)
+OUTBOX_BACKOFF_SECONDS = config('OUTBOX_BACKOFF_SECONDS', default=30, cast=float)
+OUTBOX_MAX_BACKOFF_SECONDS = config('OUTBOX_MAX_BACKOFF_SECONDS', default=3600, cast=float)
+OUTBOX_CLAIM_TIMEOUT_SECONDS = config('OUTBOX_CLAIM_TIMEOUT_SECONDS', default=300, cast=float)
+OUTBOX_RETENTION_DAYS = config('OUTBOX_RETENTION_DAYS', default=30, cast=int)
+
+# Words per page of the vocabulary list (and per infinite-scroll request)
+VOCAB_PAGE_SIZE = config('VOCAB_PAGE_SIZE', default=24, cast=int)
+
+# Uploaded vocabulary images (core.images): the stored rendition is downscaled to
+# IMAGE_MAX_DIMENSION (Telegram shows photos at up to 1280 px), re-encoded as
+# IMAGE_FORMAT (JPEG or WEBP) at IMAGE_QUALITY without EXIF, and a
+# THUMBNAIL_DIMENSION px thumbnail is made for the vocabulary pages. This runs on
+# IMAGE_PROCESSING_WORKERS background threads unless IMAGE_PROCESSING_ASYNC is off.
+IMAGE_MAX_DIMENSION = config('IMAGE_MAX_DIMENSION', default=1280, cast=int)
+IMAGE_FORMAT = config('IMAGE_FORMAT', default='JPEG')
+IMAGE_QUALITY = config('IMAGE_QUALITY', default=82, cast=int)
+THUMBNAIL_DIMENSION = config('THUMBNAIL_DIMENSION', default=320, cast=int)
+IMAGE_PROCESSING_WORKERS = config('IMAGE_PROCESSING_WORKERS', default=2, cast=int)
+IMAGE_PROCESSING_ASYNC = config('IMAGE_PROCESSING_ASYNC', default=True, cast=bool)
+
+# Vocabulary imports (core.importers): rows are inserted IMPORT_CHUNK_SIZE at a time,
+# each chunk in its own transaction. Uploads larger than IMPORT_MAX_UPLOAD_MB are
+# refused; uploaded files are imported on a background thread unless IMPORT_ASYNC is off.
+# A JSON entry longer than IMPORT_MAX_RECORD_KB or an Anki collection larger than
+# IMPORT_MAX_COLLECTION_MB once extracted fails the import, and a running import
+# that reported no progress for IMPORT_STALE_MINUTES is marked failed (its process died).
+IMPORT_CHUNK_SIZE = config('IMPORT_CHUNK_SIZE', default=1000, cast=int)
+IMPORT_MAX_UPLOAD_MB = config('IMPORT_MAX_UPLOAD_MB', default=200, cast=int)
+IMPORT_ASYNC = config('IMPORT_ASYNC', default=True, cast=bool)
+IMPORT_MAX_RECORD_KB = config('IMPORT_MAX_RECORD_KB', default=1024, cast=int)
+IMPORT_MAX_COLLECTION_MB = config('IMPORT_MAX_COLLECTION_MB', default=1024, cast=int)
+IMPORT_STALE_MINUTES = config('IMPORT_STALE_MINUTES', default=30, cast=int)
+
+# Caches. CACHE_BACKEND is locmem (per process, the default), file (CACHE_LOCATION
+# is a directory the processes of a host share) or db (CACHE_LOCATION is a table,
+# create it with 'manage.py createcachetable'). Past CACHE_MAX_ENTRIES entries a
+# third of them are culled. The dashboard fragments (core.dashboard) live in the
+# DASHBOARD_CACHE alias for DASHBOARD_CACHE_TIMEOUT seconds at most. Review counts
+# change in the bot's process, so they are only cached with file or db; use one of
+# those too when the site runs in several web processes.
+CACHE_BACKENDS = {
+    'locmem': ('django.core.cache.backends.locmem.LocMemCache', 'vocabbot'),
+    'file': ('django.core.cache.backends.filebased.FileBasedCache', str(BASE_DIR / 'cache')),
+    'db': ('django.core.cache.backends.db.DatabaseCache', 'vocabbot_cache'),
+}
+CACHE_BACKEND = config('CACHE_BACKEND', default='locmem')
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKENDS[CACHE_BACKEND][0],
+        'LOCATION': config('CACHE_LOCATION', default=CACHE_BACKENDS[CACHE_BACKEND][1]),
+        'OPTIONS': {
+            'MAX_ENTRIES': config('CACHE_MAX_ENTRIES', default=10000, cast=int),
+            'CULL_FREQUENCY': 3,
+        },
+    },
+}
+DASHBOARD_CACHE = 'default'
+DASHBOARD_CACHE_TIMEOUT = config('DASHBOARD_CACHE_TIMEOUT', default=600, cast=int)
+
+# Metrics (core.metrics) in the Prometheus text format. The web process serves its
+# own at /metrics/ to requests sending METRICS_TOKEN as a bearer token. Without a
+# token nobody may scrape, unless METRICS_ALLOW_LOCAL lets in direct (not proxied)
+# requests from localhost. run_scheduler writes its own to METRICS_FILE (for
+# node_exporter's textfile collector) every METRICS_FILE_INTERVAL seconds.
+# METRICS_DB_QUERIES times every SQL query by statement and table.
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+METRICS_ALLOW_LOCAL = config('METRICS_ALLOW_LOCAL', default=False, cast=bool)
+METRICS_FILE = config('METRICS_FILE', default='')
+METRICS_FILE_INTERVAL = config('METRICS_FILE_INTERVAL', default=15, cast=int)
+METRICS_DB_QUERIES = config('METRICS_DB_QUERIES', default=True, cast=bool)
+
+# Per-request query profiler (core.profiling), off by default. It keeps the last
+# QUERY_PROFILER_WINDOW request profiles in memory and appends them to
+# QUERY_PROFILER_FILE (JSON lines, read by 'manage.py query_report') if set. The file
+# is rotated to QUERY_PROFILER_FILE.1 at QUERY_PROFILER_FILE_MAX_MB (0: never).
+# Requests running more queries or duplicate queries than the budgets (negative for
+# no limit) are logged, or fail with QUERY_PROFILER_STRICT.
+QUERY_PROFILER = config('QUERY_PROFILER', default=False, cast=bool)
+QUERY_PROFILER_FILE = config('QUERY_PROFILER_FILE', default='')
+QUERY_PROFILER_FILE_MAX_MB = config('QUERY_PROFILER_FILE_MAX_MB', default=50, cast=int)
+QUERY_PROFILER_WINDOW = config('QUERY_PROFILER_WINDOW', default=1000, cast=int)
+QUERY_PROFILER_MAX_QUERIES = config('QUERY_PROFILER_MAX_QUERIES', default=50, cast=int)
+QUERY_PROFILER_MAX_DUPLICATES = config('QUERY_PROFILER_MAX_DUPLICATES', default=5, cast=int)
+QUERY_PROFILER_STRICT = config('QUERY_PROFILER_STRICT', default=False, cast=bool)
+
+# Logging goes to stderr. At the default INFO level the per-update and per-message
+# lines (DEBUG) are skipped, so the hot path stays quiet.
+LOG_LEVEL = config('LOG_LEVEL', default='INFO')
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'default': {'format': '%(asctime)s %(levelname)s %(name)s: %(message)s'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'default'},
+    },
+    'root': {'handlers': ['console'], 'level': 'WARNING'},
+    'loggers': {
+        'core': {'level': LOG_LEVEL},
+    },
+}
+
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'